@@ -0,0 +1,245 @@
+"""
+dedup: minhash signatures of article text, lsh buckets to find near-duplicates
+"""
+
+import hashlib
+import re
+import zlib
+
+import numpy as np
+from psycopg2 import extras, sql
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+class ArticleDeduplicator:
+
+    table_id = 'stock_article_clusters'
+    lsh_table_id = 'stock_article_lsh'
+
+    def __init__(self, num_perm=128, bands=16, threshold=0.7, shingle_size=3,
+                 seed=1):
+        if num_perm % bands != 0:
+            raise ValueError('num_perm must be a multiple of bands')
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+        # The permutations must not change between runs, stored signatures
+        # and buckets depend on them
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 32, num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        tokens = re.findall(r'\w+', text.lower())
+        if len(tokens) < self.shingle_size:
+            return {' '.join(tokens)} if tokens else set()
+
+        return {
+            ' '.join(tokens[i:i + self.shingle_size])
+            for i in range(len(tokens) - self.shingle_size + 1)
+        }
+
+    def signature(self, text):
+        shingles = self.shingles(text)
+        if len(shingles) == 0:
+            return None
+
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode('utf-8')) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # One row per permutation, the minimum over the shingles
+        permuted = (
+            np.outer(self.a, hashes) + self.b[:, None]
+        ) % MERSENNE_PRIME & MAX_HASH
+
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def buckets(self, signature):
+        return [
+            int.from_bytes(
+                hashlib.blake2b(
+                    band.tobytes(), digest_size=8
+                ).digest(),
+                'big',
+                signed=True,
+            )
+            for band in signature.reshape(self.bands, self.rows)
+        ]
+
+    def similarity(self, signature, other):
+        return float(np.mean(signature == other))
+
+    def new_articles(self, cur, symbol=None, from_time=None, to_time=None):
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT a.id, b.headline || ' ' || b.summary
+                FROM stock_articles a
+                JOIN article_contents b USING (content_hash)
+                LEFT JOIN {} c ON c.id = a.id
+                WHERE c.id IS NULL
+                    AND (a.symbol = %(symbol)s OR %(symbol)s IS NULL)
+                    AND (
+                        a.date >= %(from_time)s::DATE
+                        OR %(from_time)s IS NULL
+                    )
+                    AND (
+                        a.date <= %(to_time)s::DATE
+                        OR %(to_time)s IS NULL
+                    )
+                ORDER BY a.id;
+                """
+            ).format(sql.Identifier(self.table_id)),
+            {
+                'symbol': symbol,
+                'from_time': from_time,
+                'to_time': to_time,
+            },
+        )
+
+        return cur.fetchall()
+
+    def indexed_candidates(self, cur, bands, buckets):
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT DISTINCT
+                    l.band, l.bucket, c.id, c.cluster_id, c.signature
+                FROM UNNEST(%s::SMALLINT[], %s::BIGINT[]) AS q(band, bucket)
+                JOIN {} l USING (band, bucket)
+                JOIN {} c USING (id);
+                """
+            ).format(
+                sql.Identifier(self.lsh_table_id),
+                sql.Identifier(self.table_id),
+            ),
+            (bands, buckets),
+        )
+
+        candidates = dict()
+        for band, bucket, article_id, cluster_id, signature in cur.fetchall():
+            candidates.setdefault((band, bucket), list()).append(
+                (
+                    article_id,
+                    cluster_id,
+                    np.frombuffer(bytes(signature), dtype=np.uint32),
+                )
+            )
+
+        return candidates
+
+    def dedup(self, cur, symbol=None, from_time=None, to_time=None):
+        # Loads of different symbols may carry the same story. Bucket
+        # assignment is serialized until the caller commits, so each run
+        # sees the clusters of the runs before it.
+        cur.execute(
+            'SELECT PG_ADVISORY_XACT_LOCK(HASHTEXT(%s));',
+            (self.lsh_table_id,),
+        )
+
+        articles = self.new_articles(cur, symbol, from_time, to_time)
+        if len(articles) == 0:
+            return 0
+
+        signatures = dict()
+        article_buckets = dict()
+        for article_id, text in articles:
+            signature = self.signature(text)
+            signatures[article_id] = signature
+            if signature is not None:
+                article_buckets[article_id] = list(
+                    enumerate(self.buckets(signature))
+                )
+
+        keys = [key for buckets in article_buckets.values() for key in buckets]
+        indexed = self.indexed_candidates(
+            cur,
+            [band for band, _ in keys],
+            [bucket for _, bucket in keys],
+        )
+
+        # Union-find over the new articles, seeded with the clusters of
+        # matching articles that are already indexed
+        parent = {article_id: article_id for article_id, _ in articles}
+        cluster_of = dict()
+
+        def find(article_id):
+            while parent[article_id] != article_id:
+                parent[article_id] = parent[parent[article_id]]
+                article_id = parent[article_id]
+            return article_id
+
+        def union(left, right):
+            left, right = find(left), find(right)
+            if left != right:
+                parent[max(left, right)] = min(left, right)
+
+        batch_buckets = dict()
+        for article_id, buckets in article_buckets.items():
+            signature = signatures[article_id]
+            for key in buckets:
+                for _, cluster_id, other in indexed.get(key, list()):
+                    if self.similarity(signature, other) >= self.threshold:
+                        cluster_of[article_id] = min(
+                            cluster_of.get(article_id, cluster_id), cluster_id
+                        )
+                for other_id in batch_buckets.get(key, list()):
+                    if self.similarity(
+                        signature, signatures[other_id]
+                    ) >= self.threshold:
+                        union(article_id, other_id)
+                batch_buckets.setdefault(key, list()).append(article_id)
+
+        # An existing cluster wins over a new one, otherwise the smallest id
+        # of the group names the cluster
+        group_cluster = dict()
+        for article_id, cluster_id in cluster_of.items():
+            root = find(article_id)
+            group_cluster[root] = min(
+                group_cluster.get(root, cluster_id), cluster_id
+            )
+
+        cluster_rows = list()
+        for article_id, _ in articles:
+            root = find(article_id)
+            signature = signatures[article_id]
+            cluster_rows.append(
+                (
+                    article_id,
+                    group_cluster.get(root, root),
+                    None if signature is None else signature.tobytes(),
+                )
+            )
+
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                'INSERT INTO {} (id, cluster_id, signature) '
+                'VALUES %s ON CONFLICT DO NOTHING;'
+            ).format(sql.Identifier(self.table_id)),
+            cluster_rows,
+            page_size=1000,
+        )
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                'INSERT INTO {} (band, bucket, id) '
+                'VALUES %s ON CONFLICT DO NOTHING;'
+            ).format(sql.Identifier(self.lsh_table_id)),
+            [
+                (band, bucket, article_id)
+                for article_id, buckets in article_buckets.items()
+                for band, bucket in buckets
+            ],
+            page_size=1000,
+        )
+
+        return len({cluster for _, cluster, _ in cluster_rows})
@@ -0,0 +1,394 @@
+"""
+embeddings: doc2vec vectors of article text in a memory-mapped cosine index
+"""
+
+import argparse
+import contextlib
+import fcntl
+import io
+import json
+import os
+
+import numpy as np
+import polars as pl
+import psycopg2
+from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+from gensim.utils import simple_preprocess
+
+
+class ArticleEmbeddingIndex:
+
+    def __init__(self, index_dir=None, vector_size=64, epochs=20,
+                 batch_size=1024, n_probe=4, workers=4):
+        self.index_dir = index_dir or os.environ.get(
+            'ARTICLE_INDEX_DIR', 'exported_data/embeddings'
+        )
+        self.vector_size = vector_size
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.n_probe = n_probe
+        self.workers = workers
+
+        self.model_path = os.path.join(self.index_dir, 'doc2vec.model')
+        self.vectors_path = os.path.join(self.index_dir, 'vectors.f32')
+        self.ids_path = os.path.join(self.index_dir, 'ids.txt')
+        self.centroids_path = os.path.join(self.index_dir, 'centroids.npy')
+        self.assignments_path = os.path.join(self.index_dir, 'assignments.i4')
+        # Inverted lists, rows sorted by cluster and where each cluster
+        # starts. Rows appended since they were sorted follow them.
+        self.postings_path = os.path.join(self.index_dir, 'postings.i4')
+        self.offsets_path = os.path.join(self.index_dir, 'offsets.npy')
+        self.lock_path = os.path.join(self.index_dir, 'index.lock')
+        self.swap_lock_path = os.path.join(self.index_dir, 'swap.lock')
+
+    @contextlib.contextmanager
+    def lock(self, path=None, shared=False):
+        # Appends from concurrent ingest runs are serialized per index.
+        # Readers share the swap lock, files are replaced under it.
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(path or self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def replace(self, files):
+        # Written next to the index, then swapped in together
+        for path, data in files:
+            with open(path + '.tmp', 'wb') as tmp:
+                tmp.write(data)
+        with self.lock(self.swap_lock_path):
+            for path, _ in files:
+                os.replace(path + '.tmp', path)
+
+    def read_contents(self, conn, symbol=None, from_time=None, to_time=None):
+        cur = conn.cursor(name='article_embeddings')
+        cur.itersize = self.batch_size
+        cur.execute(
+            """
+            SELECT c.content_hash, c.headline || ' ' || c.summary
+            FROM article_contents c
+            WHERE %(symbol)s IS NULL OR EXISTS (
+                SELECT 1 FROM stock_articles a
+                WHERE a.content_hash = c.content_hash
+                    AND a.symbol = %(symbol)s
+                    AND (a.date >= %(from_time)s::DATE
+                        OR %(from_time)s IS NULL)
+                    AND (a.date <= %(to_time)s::DATE
+                        OR %(to_time)s IS NULL)
+            )
+            ORDER BY c.content_hash;
+            """,
+            {
+                'symbol': symbol,
+                'from_time': from_time,
+                'to_time': to_time,
+            },
+        )
+
+        while True:
+            rows = cur.fetchmany(self.batch_size)
+            if len(rows) == 0:
+                break
+            yield rows
+
+        cur.close()
+
+    def read_ids(self):
+        if not os.path.exists(self.ids_path):
+            return list()
+
+        with open(self.ids_path, 'r') as ids:
+            return ids.read().split()
+
+    def build(self, conn):
+        with self.lock():
+            return self.write_index(conn)
+
+    def write_index(self, conn):
+        hashes = list()
+        documents = list()
+        for rows in self.read_contents(conn):
+            for content_hash, text in rows:
+                documents.append(
+                    TaggedDocument(simple_preprocess(text), [len(hashes)])
+                )
+                hashes.append(content_hash)
+        if len(hashes) == 0:
+            return 0
+
+        model = Doc2Vec(
+            documents,
+            vector_size=self.vector_size,
+            min_count=2,
+            epochs=self.epochs,
+            workers=self.workers,
+        )
+        model.save(self.model_path)
+
+        vectors = normalize(model.dv.vectors[:len(hashes)])
+        centroids = kmeans(vectors, max(1, int(np.sqrt(len(hashes)))))
+        assignments = nearest(vectors, centroids).astype(np.int32)
+        postings, offsets = inverted_lists(assignments, len(centroids))
+
+        # Swapped in whole, readers never see a partial index or the
+        # centroids of another build
+        self.replace(
+            [
+                (self.vectors_path, vectors.astype(np.float32).tobytes()),
+                (self.assignments_path, assignments.tobytes()),
+                (self.postings_path, postings.tobytes()),
+                (self.offsets_path, npy_bytes(offsets)),
+                (self.centroids_path, npy_bytes(centroids)),
+                (self.ids_path, ''.join(h + '\n' for h in hashes).encode()),
+            ]
+        )
+
+        return len(hashes)
+
+    def append(self, conn, symbol=None, from_time=None, to_time=None):
+        with self.lock():
+            if not os.path.exists(self.model_path):
+                return self.write_index(conn)
+
+            model = Doc2Vec.load(self.model_path)
+            centroids = np.load(self.centroids_path)
+
+            # Ids are written last, drop rows of an interrupted append
+            ids = self.read_ids()
+            row_size = self.vector_size * 4
+            os.truncate(self.vectors_path, len(ids) * row_size)
+            os.truncate(self.assignments_path, len(ids) * 4)
+            indexed = set(ids)
+            # Lists sorted with the dropped rows no longer match the index
+            stale = len(self.read_postings(len(centroids))[0]) > len(ids)
+
+            appended = 0
+            for rows in self.read_contents(conn, symbol, from_time, to_time):
+                rows = [row for row in rows if row[0] not in indexed]
+                if len(rows) == 0:
+                    continue
+
+                vectors = normalize(
+                    np.array(
+                        [
+                            model.infer_vector(simple_preprocess(text))
+                            for _, text in rows
+                        ],
+                        dtype=np.float32,
+                    )
+                )
+                with open(self.vectors_path, 'ab') as f:
+                    f.write(vectors.tobytes())
+                assignments = nearest(vectors, centroids).astype(np.int32)
+                with open(self.assignments_path, 'ab') as f:
+                    f.write(assignments.tobytes())
+                with open(self.ids_path, 'a') as f:
+                    f.write(''.join(h + '\n' for h, _ in rows))
+
+                indexed.update(h for h, _ in rows)
+                appended += len(rows)
+
+            # Appended rows are scanned by every search until they are
+            # sorted into the inverted lists
+            sorted_rows = len(self.read_postings(len(centroids))[0])
+            unsorted = len(indexed) - sorted_rows
+            if stale or unsorted > max(1024, sorted_rows // 8):
+                assignments = np.fromfile(self.assignments_path, np.int32)
+                postings, offsets = inverted_lists(
+                    assignments[:len(indexed)], len(centroids)
+                )
+                self.replace(
+                    [
+                        (self.postings_path, postings.tobytes()),
+                        (self.offsets_path, npy_bytes(offsets)),
+                    ]
+                )
+
+            return appended
+
+    def load(self):
+        # Mapped files stay valid when a build replaces them
+        with self.lock(self.swap_lock_path, shared=True):
+            ids = self.read_ids()
+            vectors = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode='r',
+                shape=(len(ids), self.vector_size),
+            )
+            assignments = np.memmap(
+                self.assignments_path,
+                dtype=np.int32,
+                mode='r',
+                shape=(len(ids),),
+            )
+            centroids = np.load(self.centroids_path)
+            postings, offsets = self.read_postings(len(centroids))
+
+        return ids, vectors, assignments, (postings, offsets), centroids
+
+    def read_postings(self, k):
+        # An index built before the inverted lists has only appended rows
+        if not os.path.exists(self.postings_path):
+            return np.zeros(0, dtype=np.int32), np.zeros(k + 1, dtype=int)
+
+        return (
+            np.memmap(self.postings_path, dtype=np.int32, mode='r'),
+            np.load(self.offsets_path),
+        )
+
+    def search(self, vector, k=10, exclude=None):
+        ids, vectors, assignments, (postings, offsets), centroids = (
+            self.load()
+        )
+        query = normalize(np.asarray(vector, dtype=np.float32)[None, :])[0]
+
+        # Only rows of the clusters closest to the query are read, from
+        # their inverted lists and from the rows appended since
+        probes = np.argsort(centroids @ query)[::-1][:self.n_probe]
+        appended = np.arange(len(postings), len(ids))
+        candidates = np.concatenate(
+            [postings[offsets[p]:offsets[p + 1]] for p in probes]
+            + [appended[np.isin(assignments[len(postings):], probes)]]
+        )
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if len(candidates) == 0:
+            return list()
+
+        scores = vectors[candidates] @ query
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(ids[candidates[i]], float(scores[i])) for i in top]
+
+    def similar(self, conn, article_id, k=10):
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT content_hash FROM stock_articles WHERE id = %s;',
+            (article_id,),
+        )
+        row = cur.fetchone()
+        ids = self.read_ids()
+        if row is None or row[0] not in ids:
+            raise ValueError(f'{article_id} is not in the embedding index')
+
+        position = ids.index(row[0])
+        _, vectors, _, _, _ = self.load()
+        matches = self.search(vectors[position], k, exclude=position)
+        if len(matches) == 0:
+            return pl.DataFrame()
+
+        cur.execute(
+            """
+            SELECT DISTINCT ON (c.content_hash)
+                c.content_hash, a.id, a.symbol, a.date, c.headline
+            FROM article_contents c
+            JOIN stock_articles a USING (content_hash)
+            WHERE c.content_hash = ANY(%s)
+            ORDER BY c.content_hash, a.date, a.id;
+            """,
+            ([h for h, _ in matches],),
+        )
+        articles = pl.DataFrame(
+            cur.fetchall(),
+            schema=[
+                ('content_hash', pl.Utf8),
+                ('id', pl.Utf8),
+                ('symbol', pl.Utf8),
+                ('date', pl.Date),
+                ('headline', pl.Utf8),
+            ],
+            orient='row',
+        )
+        cur.close()
+
+        return pl.DataFrame(
+            matches,
+            schema=[('content_hash', pl.Utf8), ('similarity', pl.Float64)],
+            orient='row',
+        ).join(articles, on='content_hash', how='left')
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def inverted_lists(assignments, k):
+    postings = np.argsort(assignments, kind='stable').astype(np.int32)
+    offsets = np.searchsorted(assignments[postings], np.arange(k + 1))
+
+    return postings, offsets
+
+
+def npy_bytes(array):
+    data = io.BytesIO()
+    np.save(data, array)
+
+    return data.getvalue()
+
+
+def nearest(vectors, centroids, batch_size=65536):
+    return np.concatenate(
+        [
+            np.argmax(vectors[i:i + batch_size] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), batch_size)
+        ]
+    )
+
+
+def kmeans(vectors, k, iterations=10, sample_size=50000, seed=0):
+    # Spherical k-means on a sample, enough for a coarse index
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)]
+
+    for _ in range(iterations):
+        labels = nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        # Empty clusters keep their previous centroid
+        empty = np.bincount(labels, minlength=k) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+
+    return centroids.astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or query the article embedding index',
+    )
+    parser.add_argument(
+        '--build',
+        action='store_true',
+        help='retrain the model and rebuild the index from all articles',
+    )
+    parser.add_argument('--similar', metavar='ARTICLE_ID')
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    # Get config for the database
+    with open('postgresql.json', 'r') as psql:
+        config = json.load(psql)
+
+    conn = psycopg2.connect(
+        host=config['host'],
+        database=config['database'],
+        user=config['user'],
+        password=config['password'],
+        port=config['port'],
+    )
+
+    index = ArticleEmbeddingIndex()
+    if args.build:
+        print(f'Indexed {index.build(conn)} articles')
+    if args.similar:
+        print(index.similar(conn, args.similar, args.k))
+
+    conn.close()
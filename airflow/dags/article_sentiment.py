@@ -0,0 +1,147 @@
+"""
+nlp: textblob sentiment of article headlines and summaries, cached by content
+"""
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+from psycopg2 import extras, sql
+from textblob import TextBlob
+
+
+class ArticleSentimentScorer:
+
+    table_id = 'stock_article_sentiment'
+
+    score_columns = [
+        'headline_polarity',
+        'headline_subjectivity',
+        'summary_polarity',
+        'summary_subjectivity',
+    ]
+
+    def __init__(self, workers=4, batch_size=256):
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def unscored_articles(self, cur, symbol=None, from_time=None,
+                          to_time=None):
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT a.id, a.content_hash, c.headline, c.summary
+                FROM stock_articles a
+                JOIN article_contents c USING (content_hash)
+                LEFT JOIN {} s ON s.id = a.id
+                WHERE s.id IS NULL
+                    AND (a.symbol = %(symbol)s OR %(symbol)s IS NULL)
+                    AND (
+                        a.date >= %(from_time)s::DATE
+                        OR %(from_time)s IS NULL
+                    )
+                    AND (
+                        a.date <= %(to_time)s::DATE
+                        OR %(to_time)s IS NULL
+                    );
+                """
+            ).format(sql.Identifier(self.table_id)),
+            {
+                'symbol': symbol,
+                'from_time': from_time,
+                'to_time': to_time,
+            },
+        )
+
+        return cur.fetchall()
+
+    def cached_scores(self, cur, hashes):
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT DISTINCT ON (content_hash) content_hash, {}
+                FROM {}
+                WHERE content_hash = ANY(%s);
+                """
+            ).format(
+                sql.SQL(', ').join(map(sql.Identifier, self.score_columns)),
+                sql.Identifier(self.table_id),
+            ),
+            (list(hashes),),
+        )
+
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+    def score_texts(self, texts):
+        batches = [
+            texts[i:i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        if self.workers <= 1 or len(batches) <= 1:
+            return [
+                scores for batch in batches for scores in score_batch(batch)
+            ]
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context('spawn'),
+        ) as executor:
+            return [
+                scores
+                for batch_scores in executor.map(score_batch, batches)
+                for scores in batch_scores
+            ]
+
+    def score(self, cur, symbol=None, from_time=None, to_time=None):
+        articles = self.unscored_articles(cur, symbol, from_time, to_time)
+        if len(articles) == 0:
+            return 0
+
+        # Keyed by the article_contents hash, re-ingested and cross-listed
+        # copies of an article reuse its scores
+        scores = self.cached_scores(cur, {h for _, h, _, _ in articles})
+        texts = dict()
+        for _, h, headline, summary in articles:
+            if h not in scores:
+                texts[h] = (headline, summary)
+
+        new_hashes = list(texts)
+        scores.update(
+            zip(new_hashes, self.score_texts([texts[h] for h in new_hashes]))
+        )
+
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING;'
+            ).format(
+                sql.Identifier(self.table_id),
+                sql.SQL(', ').join(
+                    sql.Identifier(c)
+                    for c in ['id', 'content_hash'] + self.score_columns
+                ),
+            ),
+            [
+                (article_id, h) + tuple(scores[h])
+                for article_id, h, _, _ in articles
+            ],
+            page_size=1000,
+        )
+
+        return len(new_hashes)
+
+
+def score_batch(batch):
+    scores = list()
+    for headline, summary in batch:
+        headline_sentiment = TextBlob(headline).sentiment
+        summary_sentiment = TextBlob(summary).sentiment
+        scores.append(
+            (
+                headline_sentiment.polarity,
+                headline_sentiment.subjectivity,
+                summary_sentiment.polarity,
+                summary_sentiment.subjectivity,
+            )
+        )
+
+    return scores
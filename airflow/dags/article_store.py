@@ -0,0 +1,191 @@
+"""
+storage: article bodies stored once by content hash, referenced per symbol
+"""
+
+import hashlib
+import threading
+
+import polars as pl
+from psycopg2 import extras, sql
+
+import ingest_metrics
+import staging_loader
+
+# Hashes known to be stored, shared by the loads of this process
+_known_hashes = set()
+_lock = threading.Lock()
+
+
+class ArticleStore:
+
+    table_id = 'stock_articles'
+    contents_table_id = 'article_contents'
+
+    reference_columns = [
+        'id',
+        'symbol',
+        'date',
+        'time',
+        'content_hash',
+    ]
+
+    body_columns = [
+        'category',
+        'headline',
+        'image_url',
+        'source',
+        'summary',
+        'article_url',
+    ]
+
+    # Upper bound of the cached hash set before it is reset
+    max_cached = 1000000
+
+    def __init__(self):
+        self.new_hashes = set()
+
+    def with_hashes(self, df):
+        return df.with_columns(
+            pl.concat_str(
+                [pl.col(column) for column in self.body_columns],
+                separator='\x1f',
+            ).apply(
+                lambda x: hashlib.sha256(x.encode('utf-8')).hexdigest(),
+                return_dtype=pl.Utf8,
+            ).alias('content_hash')
+        )
+
+    def unknown_hashes(self, cur, hashes):
+        with _lock:
+            missing = [h for h in hashes if h not in _known_hashes]
+        if len(missing) == 0:
+            return set()
+
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT content_hash
+                FROM {}
+                WHERE content_hash = ANY(%s);
+                """
+            ).format(sql.Identifier(self.contents_table_id)),
+            (missing,),
+        )
+        stored = {row[0] for row in cur.fetchall()}
+        remember(stored)
+
+        return set(missing) - stored
+
+    def store(self, cur, df):
+        df = self.with_hashes(df)
+
+        # Only bodies not stored yet by any symbol are sent
+        self.new_hashes = self.unknown_hashes(
+            cur, df['content_hash'].unique().to_list()
+        )
+        contents = df.filter(
+            pl.col('content_hash').is_in(list(self.new_hashes))
+        ).unique(
+            subset='content_hash', keep='first', maintain_order=True
+        ).select(['content_hash'] + self.body_columns)
+
+        if contents.height:
+            extras.execute_values(
+                cur,
+                sql.SQL(
+                    'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING;'
+                ).format(
+                    sql.Identifier(self.contents_table_id),
+                    sql.SQL(', ').join(
+                        sql.Identifier(c)
+                        for c in ['content_hash'] + self.body_columns
+                    ),
+                ),
+                contents.rows(),
+                page_size=1000,
+            )
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                sql.SQL(
+                    'INSERT INTO {} ({}) VALUES %s '
+                    'ON CONFLICT DO NOTHING RETURNING 1;'
+                ).format(
+                    sql.Identifier(self.table_id),
+                    sql.SQL(', ').join(
+                        map(sql.Identifier, self.reference_columns)
+                    ),
+                ),
+                df.select(self.reference_columns).rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                df.select(self.reference_columns),
+            )
+
+        return contents.height
+
+    def committed(self):
+        # Cached only once the bodies are visible to other loads
+        remember(self.new_hashes)
+        self.new_hashes = set()
+
+    def migrate(self, cur):
+        # Move the bodies out of a stock_articles table created before
+        # content-addressed storage
+        cur.execute(
+            """
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name = %s;
+            """,
+            (self.table_id,),
+        )
+        if 'headline' not in {row[0] for row in cur.fetchall()}:
+            return False
+
+        body_columns = sql.SQL(', ').join(
+            map(sql.Identifier, self.body_columns)
+        )
+        cur.execute(
+            sql.SQL(
+                """
+                ALTER TABLE {table}
+                    ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+                UPDATE {table} SET content_hash = ENCODE(
+                    SHA256(CONVERT_TO({separated}, 'UTF8')), 'hex'
+                );
+                INSERT INTO {contents} (content_hash, {body_columns})
+                SELECT DISTINCT ON (content_hash) content_hash, {body_columns}
+                FROM {table}
+                ON CONFLICT DO NOTHING;
+                ALTER TABLE {table}
+                    ALTER COLUMN content_hash SET NOT NULL,
+                    {drop_columns};
+                """
+            ).format(
+                table=sql.Identifier(self.table_id),
+                contents=sql.Identifier(self.contents_table_id),
+                separated=sql.SQL(' || CHR(31) || ').join(
+                    map(sql.Identifier, self.body_columns)
+                ),
+                body_columns=body_columns,
+                drop_columns=sql.SQL(', ').join(
+                    sql.SQL('DROP COLUMN {}').format(sql.Identifier(c))
+                    for c in self.body_columns
+                ),
+            )
+        )
+
+        return True
+
+
+def remember(hashes):
+    with _lock:
+        if len(_known_hashes) + len(hashes) > ArticleStore.max_cached:
+            _known_hashes.clear()
+        _known_hashes.update(hashes)
@@ -2,7 +2,6 @@ import datetime as dt
 import os
 
 import polars as pl
-import psycopg2
 from psycopg2 import sql, extras
 import pandas as pd
 
@@ -10,6 +9,17 @@ from stock_articles_collect import ArticleCollector
 from social_sentiment_collect import SocialSentimentCollector
 from stock_price_collect import StockPriceCollector
 from stock_info_collect import StockInfoCollector
+from article_dedup import ArticleDeduplicator
+from article_embeddings import ArticleEmbeddingIndex
+from article_sentiment import ArticleSentimentScorer
+from article_store import ArticleStore
+import ingest_metrics
+from ingest_metrics import instrument
+from loaded_ids import LoadedIds
+from price_analytics import PriceAnalytics
+from sentiment_rollup import SentimentRollup
+from stock_info_history import StockInfoHistory
+import staging_loader
 
 PG_HOST = os.getenv('PG_HOST')
 PG_USER = os.getenv('PG_USER')
@@ -18,6 +28,7 @@ PG_PORT = os.getenv('PG_PORT')
 PG_DATABASE = os.getenv('PG_DATABASE')
 
 
+@instrument
 class StockInfoIngestion:
 
     def __init__(self):
@@ -39,6 +50,7 @@ class StockInfoIngestion:
         # Loop through the stock symbols to extract data of them
         for symbol in self.stock_symbols:
             collector = StockInfoCollector(symbol)
+            ingest_metrics.count_session(collector.client._session)
             stock = collector.get_stock_info()
             all_stocks_data.append(stock)
 
@@ -86,26 +98,8 @@ class StockInfoIngestion:
         return df
 
     def load_data(self, transformed_data):
-        # Create sql identifiers for the column names
-        columns = sql.SQL(',').join(
-            sql.Identifier(name) for name in transformed_data.columns
-        )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
-
-        # Prepare the insert query
-        insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
-        ).format(
-            sql.Identifier(self.table_id), columns, values
-        )
-
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=PG_HOST,
             database=PG_DATABASE,
             user=PG_USER,
@@ -114,12 +108,11 @@ class StockInfoIngestion:
         )
         cur = conn.cursor()
 
-        # Load data to the database
-        extras.execute_batch(
-            cur,
-            insert_query,
-            transformed_data.rows(),
-        )
+        # Write only the rows that changed since the last load, and
+        # version them in the history table
+        history = StockInfoHistory()
+        changed = history.load(cur, transformed_data)
+        ingest_metrics.count('rows_out', changed.height)
 
         cur.close()
         conn.commit()
@@ -130,6 +123,7 @@ class StockInfoIngestion:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockPriceIngest:
     def __init__(self, stock_symbol, from_time, to_time):
         self.stock_symbol = stock_symbol
@@ -145,27 +139,46 @@ class StockPriceIngest:
             self.to_time,
         )
 
-        price = collector.get_price()
-        volume = collector.get_volume()
+        raw_data = collector.get_ohlcv()
+        ingest_metrics.count('api_calls', collector.downloads)
 
-        return {
-            'price': price,
-            'volume': volume,
-        }
+        return raw_data
 
     def transform_data(self, raw_data):
         # Extract value of each columns from raw data
+        datetime_col = list(raw_data['price'].keys())
         price_col = list(raw_data['price'].values())
         volume_col = list(raw_data['volume'].values())
-        datetime_col = list(raw_data['price'].keys())
+        open_col = list(raw_data['open'].values())
+        high_col = list(raw_data['high'].values())
+        low_col = list(raw_data['low'].values())
+        close_col = list(raw_data['close'].values())
 
         if len(price_col) == 0:
             return dict()
 
-        df = pl.DataFrame([datetime_col, price_col, volume_col])
+        df = pl.DataFrame(
+            [
+                datetime_col,
+                open_col,
+                high_col,
+                low_col,
+                close_col,
+                price_col,
+                volume_col,
+            ]
+        )
 
         # Rename columns
-        df.columns = ['date', 'price', 'volume']
+        df.columns = [
+            'date',
+            'open',
+            'high',
+            'low',
+            'close',
+            'price',
+            'volume',
+        ]
 
         # Create new columns
         df = df.with_columns(
@@ -183,6 +196,10 @@ class StockPriceIngest:
                 'id',
                 'symbol',
                 'date',
+                'open',
+                'high',
+                'low',
+                'close',
                 'price',
                 'volume',
             ]
@@ -204,22 +221,17 @@ class StockPriceIngest:
         columns = sql.SQL(',').join(
             sql.Identifier(name) for name in transformed_data.columns
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
 
-        # Prepare the insert query
+        # Prepare the insert query, the inserted rows are returned to be
+        # counted
         insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
+            'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING 1;'
         ).format(
-            sql.Identifier(self.table_id), columns, values
+            sql.Identifier(self.table_id), columns
         )
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=PG_HOST,
             database=PG_DATABASE,
             user=PG_USER,
@@ -228,15 +240,34 @@ class StockPriceIngest:
         )
         cur = conn.cursor()
 
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
         # Load data to the database
-        extras.execute_batch(
-            cur,
-            insert_query,
-            transformed_data.rows(),
-        )
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                insert_query,
+                transformed_data.rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
+        # Extend the rolling analytics over the newly loaded days
+        PriceAnalytics().update(cur, [self.stock_symbol])
 
         cur.close()
         conn.commit()
+        loaded_ids.committed()
 
     def main(self):
         raw_data = self.extract_data()
@@ -244,6 +275,7 @@ class StockPriceIngest:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockRedditIngest:
 
     def __init__(self, stock_symbol, from_time, to_time):
@@ -259,6 +291,8 @@ class StockRedditIngest:
             self.from_time,
             self.to_time,
         )
+        # The api client keeps one requests session
+        ingest_metrics.count_session(collector.client._session)
 
         reddit_sentiment = collector.get_reddit_sentiment()
 
@@ -338,22 +372,17 @@ class StockRedditIngest:
         columns = sql.SQL(',').join(
             sql.Identifier(name) for name in transformed_data.columns
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
 
-        # Prepare the insert query
+        # Prepare the insert query, the inserted rows are returned to be
+        # counted
         insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
+            'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING 1;'
         ).format(
-            sql.Identifier(self.table_id), columns, values
+            sql.Identifier(self.table_id), columns
         )
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=PG_HOST,
             database=PG_DATABASE,
             user=PG_USER,
@@ -362,15 +391,38 @@ class StockRedditIngest:
         )
         cur = conn.cursor()
 
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
         # Load data to the database
-        extras.execute_batch(
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                insert_query,
+                transformed_data.rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
+        # Refresh the daily and weekly rollups of the dates just loaded
+        SentimentRollup('reddit').update(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.stock_symbol,
+            transformed_data['date'].unique().to_list(),
         )
 
         cur.close()
         conn.commit()
+        loaded_ids.committed()
 
     def main(self):
         raw_data = self.extract_data()
@@ -378,6 +430,7 @@ class StockRedditIngest:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockTwitterIngest:
 
     def __init__(self, stock_symbol, from_time, to_time):
@@ -393,6 +446,8 @@ class StockTwitterIngest:
             self.from_time,
             self.to_time,
         )
+        # The api client keeps one requests session
+        ingest_metrics.count_session(collector.client._session)
 
         twitter_sentiment = collector.get_twitter_sentiment()
 
@@ -472,22 +527,17 @@ class StockTwitterIngest:
         columns = sql.SQL(',').join(
             sql.Identifier(name) for name in transformed_data.columns
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
 
-        # Prepare the insert query
+        # Prepare the insert query, the inserted rows are returned to be
+        # counted
         insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
+            'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING 1;'
         ).format(
-            sql.Identifier(self.table_id), columns, values
+            sql.Identifier(self.table_id), columns
         )
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=PG_HOST,
             database=PG_DATABASE,
             user=PG_USER,
@@ -496,15 +546,38 @@ class StockTwitterIngest:
         )
         cur = conn.cursor()
 
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
         # Load data to the database
-        extras.execute_batch(
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                insert_query,
+                transformed_data.rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
+        # Refresh the daily and weekly rollups of the dates just loaded
+        SentimentRollup('twitter').update(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.stock_symbol,
+            transformed_data['date'].unique().to_list(),
         )
 
         cur.close()
         conn.commit()
+        loaded_ids.committed()
 
     def main(self):
         raw_data = self.extract_data()
@@ -512,6 +585,7 @@ class StockTwitterIngest:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockArticleIngest:
 
     def __init__(self, stock_symbol, from_time, to_time):
@@ -527,6 +601,8 @@ class StockArticleIngest:
             self.from_time,
             self.to_time,
         )
+        # The api client keeps one requests session
+        ingest_metrics.count_session(collector.client._session)
 
         articles = collector.get_articles()
 
@@ -597,26 +673,57 @@ class StockArticleIngest:
             )
         )
 
-        # Create sql identifiers for the column names
-        columns = sql.SQL(',').join(
-            sql.Identifier(name) for name in transformed_data.columns
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=PG_HOST,
+            database=PG_DATABASE,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            port=PG_PORT,
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
+        cur = conn.cursor()
+
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
+        # Load the references, and the bodies not stored yet
+        store = ArticleStore()
+        store.store(cur, transformed_data)
+
+        cur.close()
+        conn.commit()
+        loaded_ids.committed()
+        store.committed()
+
+    def dedup_data(self):
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=PG_HOST,
+            database=PG_DATABASE,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            port=PG_PORT,
         )
+        cur = conn.cursor()
 
-        # Prepare the insert query
-        insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
-        ).format(
-            sql.Identifier(self.table_id), columns, values
+        # Assign the articles loaded for this symbol and window to clusters
+        # of near-duplicate stories
+        ArticleDeduplicator().dedup(
+            cur,
+            self.stock_symbol,
+            self.from_time,
+            self.to_time,
         )
 
+        cur.close()
+        conn.commit()
+
+    def score_data(self):
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=PG_HOST,
             database=PG_DATABASE,
             user=PG_USER,
@@ -625,20 +732,44 @@ class StockArticleIngest:
         )
         cur = conn.cursor()
 
-        # Load data to the database
-        extras.execute_batch(
+        # Score the text of the articles loaded for this symbol and window
+        ArticleSentimentScorer().score(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.stock_symbol,
+            self.from_time,
+            self.to_time,
         )
 
         cur.close()
         conn.commit()
 
+    def embed_data(self):
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=PG_HOST,
+            database=PG_DATABASE,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            port=PG_PORT,
+        )
+
+        # Append the new article bodies to the embedding index
+        ArticleEmbeddingIndex().append(
+            conn,
+            self.stock_symbol,
+            self.from_time,
+            self.to_time,
+        )
+
+        conn.close()
+
     def main(self):
         raw_data = self.extract_data()
         transformed_data = self.transform_data(raw_data)
         self.load_data(transformed_data)
+        self.dedup_data()
+        self.score_data()
+        self.embed_data()
 
 
 if __name__ == '__main__':
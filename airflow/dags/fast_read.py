@@ -0,0 +1,219 @@
+"""
+analytics reads: postgres -> polars through connectorx, in parallel partitions
+"""
+
+import datetime as dt
+import os
+from urllib.parse import quote
+
+import connectorx as cx
+import polars as pl
+import psycopg2
+
+from article_store import ArticleStore
+
+PG_HOST = os.getenv('PG_HOST')
+PG_USER = os.getenv('PG_USER')
+PG_PASSWORD = os.getenv('PG_PASSWORD')
+PG_PORT = os.getenv('PG_PORT')
+PG_DATABASE = os.getenv('PG_DATABASE')
+
+
+class FastReader:
+
+    # Every other table is read by date
+    undated_tables = (
+        'stock_info',
+    )
+
+    def __init__(self, partition_num=4):
+        self.partition_num = partition_num
+
+        config = {
+            'host': PG_HOST,
+            'user': PG_USER,
+            'password': PG_PASSWORD,
+            'port': PG_PORT,
+            'database': PG_DATABASE,
+        }
+        self.config = config
+        self.uri = 'postgresql://{}:{}@{}:{}/{}'.format(
+            quote(config['user'], safe=''),
+            quote(config['password'], safe=''),
+            config['host'],
+            config['port'],
+            config['database'],
+        )
+
+    def query(self, query):
+        return cx.read_sql(self.uri, query, return_type='polars')
+
+    def read_table(self, table_id, columns=None, symbols=None,
+                   from_date=None, to_date=None, partition_on='date',
+                   where=None, joins=None):
+        if partition_on not in ('date', 'symbol'):
+            raise ValueError('partition_on must be date or symbol')
+        if table_id in self.undated_tables:
+            if from_date is not None or to_date is not None:
+                raise ValueError(f'{table_id} has no date column')
+            partition_on = 'symbol'
+
+        # Joined tables share the predicates on the columns of table_id
+        relation = identifier(table_id)
+        if joins is not None:
+            relation += ' ' + joins
+        select = 'SELECT {} FROM {}'.format(
+            '*' if columns is None else ', '.join(map(identifier, columns)),
+            relation,
+        )
+        predicates = list() if where is None else [f'({where})']
+        if from_date is not None:
+            predicates.append(f'date >= {date_literal(from_date)}')
+        if to_date is not None:
+            predicates.append(f'date <= {date_literal(to_date)}')
+        if symbols is not None and len(symbols) == 0:
+            return self.query(select + ' WHERE FALSE')
+
+        if partition_on == 'symbol':
+            if symbols is None:
+                symbols = self.query(
+                    f'SELECT DISTINCT symbol FROM {relation}'
+                )['symbol'].to_list()
+            partitions = [
+                f'symbol IN ({", ".join(map(literal, group))})'
+                for group in split_list(sorted(symbols), self.partition_num)
+            ]
+        else:
+            if symbols is not None:
+                predicates.append(
+                    f'symbol IN ({", ".join(map(literal, symbols))})'
+                )
+            partitions = self.date_partitions(
+                relation, predicates, from_date, to_date
+            )
+
+        # connectorx runs the list of queries in parallel and concatenates
+        queries = [
+            select + where_clause(predicates + [partition])
+            for partition in partitions
+        ] or [select + where_clause(predicates)]
+
+        return cx.read_sql(self.uri, queries, return_type='polars')
+
+    def date_partitions(self, relation, predicates, from_date, to_date):
+        if from_date is None or to_date is None:
+            bounds = self.query(
+                f'SELECT MIN(date) AS min_date, MAX(date) AS max_date '
+                f'FROM {relation}' + where_clause(predicates)
+            ).row(0)
+            if bounds[0] is None:
+                return list()
+            from_date = from_date or bounds[0]
+            to_date = to_date or bounds[1]
+
+        start = to_date_value(from_date)
+        end = to_date_value(to_date) + dt.timedelta(days=1)
+        step = max(1, -(-(end - start).days // self.partition_num))
+
+        partitions = list()
+        while start < end:
+            stop = min(start + dt.timedelta(days=step), end)
+            partitions.append(
+                f'date >= {date_literal(start)} '
+                f'AND date < {date_literal(stop)}'
+            )
+            start = stop
+
+        return partitions
+
+    def read_price(self, **kwargs):
+        return self.read_table('stock_price', **kwargs)
+
+    def read_sentiment(self, platform, **kwargs):
+        return self.read_table(f'stock_{platform}_sentiment', **kwargs)
+
+    def read_articles(self, with_contents=True, **kwargs):
+        columns = kwargs.get('columns') or ArticleStore.reference_columns
+        if not with_contents or 'content_hash' not in columns:
+            return self.read_table('stock_articles', **kwargs)
+
+        # The bodies are joined by the database, in every partition query.
+        # Columns are named, article_contents also holds a search vector.
+        kwargs['columns'] = list(columns) + [
+            c for c in ArticleStore.body_columns if c not in columns
+        ]
+        return self.read_table(
+            'stock_articles',
+            joins='LEFT JOIN {} USING (content_hash)'.format(
+                identifier(ArticleStore.contents_table_id)
+            ),
+            **kwargs,
+        )
+
+    def join_contents(self, articles):
+        # Bodies of articles read elsewhere, e.g. from the lake
+        if 'content_hash' not in articles.columns or articles.height == 0:
+            return articles
+
+        # Each body is read once, however many symbols reference it, the
+        # hashes are sent as one array parameter
+        columns = ['content_hash'] + ArticleStore.body_columns
+        conn = psycopg2.connect(
+            host=self.config['host'],
+            database=self.config['database'],
+            user=self.config['user'],
+            password=self.config['password'],
+            port=self.config['port'],
+        )
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                'SELECT {} FROM {} WHERE content_hash = ANY(%s);'.format(
+                    ', '.join(map(identifier, columns)),
+                    identifier(ArticleStore.contents_table_id),
+                ),
+                (articles['content_hash'].unique().to_list(),),
+            )
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+
+        contents = pl.DataFrame(
+            rows,
+            schema=[(column, pl.Utf8) for column in columns],
+            orient='row',
+        )
+
+        return articles.join(contents, on='content_hash', how='left')
+
+
+def identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def to_date_value(value):
+    if isinstance(value, dt.datetime):
+        return value.date()
+    if isinstance(value, dt.date):
+        return value
+
+    return dt.date.fromisoformat(str(value))
+
+
+def date_literal(value):
+    return f"DATE '{to_date_value(value).isoformat()}'"
+
+
+def where_clause(predicates):
+    if len(predicates) == 0:
+        return ''
+
+    return ' WHERE ' + ' AND '.join(predicates)
+
+
+def split_list(values, n):
+    return [values[i::n] for i in range(n) if values[i::n]]
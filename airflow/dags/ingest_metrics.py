@@ -0,0 +1,324 @@
+"""
+metrics: wall time, rows, bytes, api calls and db round-trips per ingest stage
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import polars as pl
+import psycopg2
+from psycopg2 import extensions
+
+import stage_profiler
+
+logger = logging.getLogger('ingest_metrics')
+
+STAGES = (
+    'extract_data',
+    'transform_data',
+    'load_data',
+    'dedup_data',
+    'score_data',
+    'embed_data',
+)
+
+_local = threading.local()
+_lock = threading.Lock()
+_samples = dict()
+
+
+class StageMetrics:
+
+    def __init__(self, table_id, symbol, ingest, stage):
+        self.table_id = table_id
+        self.symbol = symbol or ''
+        self.ingest = ingest
+        self.stage = stage
+
+        self.status = 'success'
+        self.started_at = None
+        self.wall_time = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.api_calls = 0
+        self.db_round_trips = 0
+        self.extra = dict()
+
+    @contextlib.contextmanager
+    def measure(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = list()
+        stack.append(self)
+
+        self.started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield self
+        except Exception:
+            self.status = 'failed'
+            raise
+        finally:
+            self.wall_time = time.perf_counter() - start
+            stack.pop()
+
+    def to_dict(self):
+        record = {
+            'table_id': self.table_id,
+            'symbol': self.symbol,
+            'ingest': self.ingest,
+            'stage': self.stage,
+            'status': self.status,
+            'started_at': self.started_at,
+            'wall_time_seconds': round(self.wall_time, 6),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'api_calls': self.api_calls,
+            'db_round_trips': self.db_round_trips,
+        }
+        record.update(self.extra)
+
+        return record
+
+    def publish(self):
+        with _lock:
+            _samples[(self.table_id, self.symbol, self.stage)] = self
+
+        logger.info(json.dumps(self.to_dict()))
+
+        # Metrics never fail the ingest they measure
+        metrics_dir = os.getenv('INGEST_METRICS_DIR')
+        if metrics_dir:
+            try:
+                write_textfile(metrics_dir, self.table_id, self.symbol)
+            except OSError as e:
+                logger.warning(f'Metrics not written to {metrics_dir}: {e}')
+
+
+class CountingCursor(extensions.cursor):
+
+    def execute(self, query, vars=None):
+        count('db_round_trips')
+        try:
+            return super().execute(query, vars)
+        finally:
+            count('bytes_out', len(self.query or b''))
+
+    def executemany(self, query, vars_list):
+        # One statement is sent per parameter set
+        vars_list = list(vars_list)
+        count('db_round_trips', len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count('db_round_trips')
+        start = file.tell()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            count('bytes_out', file.tell() - start)
+
+
+class CountingConnection(extensions.connection):
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        count('db_round_trips')
+        return super().commit()
+
+
+def current_stage():
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return None
+
+    return stack[-1]
+
+
+def count(name, value=1):
+    stage = current_stage()
+    if stage is not None:
+        setattr(stage, name, getattr(stage, name) + value)
+
+
+def add(name, value):
+    # Record a stage specific counter, e.g. rows skipped on conflict
+    stage = current_stage()
+    if stage is not None:
+        stage.extra[name] = stage.extra.get(name, 0) + value
+
+
+def collected():
+    with _lock:
+        return [sample.to_dict() for sample in _samples.values()]
+
+
+def count_rows(data):
+    if data is None or data is False:
+        return 0
+    if isinstance(data, pl.DataFrame):
+        return data.height
+    if isinstance(data, dict):
+        # Column oriented payloads, e.g. price/volume, intraday bars or
+        # XCom frames
+        columns = [
+            v for v in data.values() if isinstance(v, (dict, list, tuple))
+        ]
+        if len(columns) != 0:
+            return max(len(column) for column in columns)
+        return 1
+    if isinstance(data, (list, tuple)):
+        return len(data)
+
+    return 0
+
+
+def count_bytes(data):
+    # Raw payloads are measured on the wire, by the api sessions and the
+    # database cursors, never serialized again to be sized
+    if isinstance(data, pl.DataFrame):
+        return data.estimated_size()
+
+    return 0
+
+
+def connect(**kwargs):
+    # Only connections of the pipeline count round trips, other users of
+    # psycopg2 in the process are left alone
+    return psycopg2.connect(connection_factory=CountingConnection, **kwargs)
+
+
+def response_bytes(response, stream=False):
+    length = response.headers.get('Content-Length')
+    if length is not None:
+        return int(length)
+    if stream:
+        return 0
+
+    return len(response.content)
+
+
+def count_session(session):
+    # Counts the calls and bytes received of one requests session, e.g.
+    # the session of an api client
+    send = session.send
+
+    @functools.wraps(send)
+    def counting_send(request, **kwargs):
+        count('api_calls')
+        response = send(request, **kwargs)
+        count('bytes_in', response_bytes(response, kwargs.get('stream')))
+        return response
+
+    session.send = counting_send
+
+    return session
+
+
+def instrument(cls):
+    for stage in STAGES:
+        if hasattr(cls, stage):
+            setattr(cls, stage, instrument_stage(getattr(cls, stage), stage))
+
+    return cls
+
+
+def instrument_stage(method, stage):
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = StageMetrics(
+            self.table_id,
+            getattr(self, 'stock_symbol', None),
+            type(self).__name__,
+            stage,
+        )
+        if len(args) != 0:
+            metrics.rows_in = count_rows(args[0])
+            metrics.bytes_in += count_bytes(args[0])
+
+        try:
+            with metrics.measure(), stage_profiler.profile_stage(
+                metrics.ingest,
+                stage,
+                metrics.symbol,
+            ):
+                result = method(self, *args, **kwargs)
+        finally:
+            # Loads count the rows they wrote and the bytes they sent
+            # themselves
+            if stage != 'load_data' and metrics.status == 'success':
+                metrics.rows_out = count_rows(result)
+                if stage == 'extract_data':
+                    metrics.bytes_out = metrics.bytes_in
+                else:
+                    metrics.bytes_out += count_bytes(result)
+            metrics.publish()
+
+        return result
+
+    return wrapper
+
+
+def write_textfile(metrics_dir, table_id, symbol):
+    # Threads publishing the same table and symbol write one at a time,
+    # the file always holds the latest samples
+    with _lock:
+        samples = [
+            sample for (table, sym, _), sample in _samples.items()
+            if table == table_id and sym == symbol
+        ]
+
+        lines = list()
+        for sample in samples:
+            labels = 'table="{}",symbol="{}",stage="{}"'.format(
+                sample.table_id,
+                sample.symbol,
+                sample.stage,
+            )
+            values = {
+                'duration_seconds': sample.wall_time,
+                'rows_in': sample.rows_in,
+                'rows_out': sample.rows_out,
+                'bytes_in': sample.bytes_in,
+                'bytes_out': sample.bytes_out,
+                'api_calls': sample.api_calls,
+                'db_round_trips': sample.db_round_trips,
+                'success': int(sample.status == 'success'),
+                'last_run_timestamp_seconds': sample.started_at,
+            }
+            values.update(sample.extra)
+
+            for name, value in values.items():
+                lines.append(f'ingest_stage_{name}{{{labels}}} {value}')
+
+        # Write to a temporary file first so the collector never reads a
+        # partially written file, named per write as worker processes
+        # publish concurrently too
+        os.makedirs(metrics_dir, exist_ok=True)
+        file_name = f'ingest_{table_id}_{symbol or "all"}.prom'
+        path = os.path.join(metrics_dir, file_name)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=metrics_dir, prefix=f'.{file_name}.', suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'w') as textfile:
+                textfile.write('\n'.join(sorted(lines)) + '\n')
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,290 @@
+"""
+loaded ids: per-partition filters of stored ids, rows known to be loaded are
+never sent again
+"""
+
+import contextlib
+import datetime as dt
+import fcntl
+import hashlib
+import os
+import time
+
+import numpy as np
+import polars as pl
+from psycopg2 import sql
+
+import ingest_metrics
+
+
+class IdFilter:
+
+    def __init__(self, ids=None, bits=None, num_hashes=0, built_at=None):
+        # An exact set for small partitions, a Bloom filter otherwise
+        self.ids = ids
+        self.bits = bits
+        self.num_hashes = num_hashes
+        self.built_at = built_at or time.time()
+
+    @classmethod
+    def build(cls, ids, exact_limit, error_rate):
+        if len(ids) <= exact_limit:
+            return cls(ids=set(ids))
+
+        # Sized for twice the ids, room for the loads until the next rebuild
+        capacity = 2 * len(ids)
+        size = int(-capacity * np.log(error_rate) / np.log(2) ** 2)
+        bloom = cls(
+            bits=np.zeros((size + 7) // 8, dtype=np.uint8),
+            num_hashes=max(1, round(size / capacity * np.log(2))),
+        )
+        bloom.add(ids)
+
+        return bloom
+
+    @classmethod
+    def read(cls, path):
+        with np.load(path) as data:
+            if 'ids' in data:
+                return cls(
+                    ids=set(data['ids'].tolist()),
+                    built_at=float(data['built_at']),
+                )
+
+            return cls(
+                bits=data['bits'],
+                num_hashes=int(data['num_hashes']),
+                built_at=float(data['built_at']),
+            )
+
+    def write(self, path):
+        # Swapped in whole, concurrent loads never read a partial filter
+        with open(path + '.tmp', 'wb') as tmp:
+            if self.ids is not None:
+                np.savez(
+                    tmp,
+                    ids=np.array(sorted(self.ids), dtype=str),
+                    built_at=self.built_at,
+                )
+            else:
+                np.savez(
+                    tmp,
+                    bits=self.bits,
+                    num_hashes=self.num_hashes,
+                    built_at=self.built_at,
+                )
+        os.replace(path + '.tmp', path)
+
+    def positions(self, ids):
+        # Double hashing of one blake2b digest per id
+        digests = np.frombuffer(
+            b''.join(
+                hashlib.blake2b(i.encode('utf-8'), digest_size=16).digest()
+                for i in ids
+            ),
+            dtype=np.uint64,
+        ).reshape(-1, 2)
+        rounds = np.arange(self.num_hashes, dtype=np.uint64)
+
+        return (
+            digests[:, :1] + rounds * digests[:, 1:]
+        ) % np.uint64(len(self.bits) * 8)
+
+    def add(self, ids):
+        if self.ids is not None:
+            self.ids.update(ids)
+            return
+        if len(ids) == 0:
+            return
+
+        positions = self.positions(ids).ravel()
+        np.bitwise_or.at(
+            self.bits,
+            (positions >> np.uint64(3)).astype(np.int64),
+            (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)),
+        )
+
+    def contains(self, ids):
+        # False for ids certainly not loaded, True for loaded or, with a
+        # Bloom filter, possibly loaded ones
+        if self.ids is not None:
+            return np.array([i in self.ids for i in ids], dtype=bool)
+        if len(ids) == 0:
+            return np.zeros(0, dtype=bool)
+
+        positions = self.positions(ids)
+        found = (
+            self.bits[(positions >> np.uint64(3)).astype(np.int64)]
+            >> (positions & np.uint64(7)).astype(np.uint8)
+        ) & 1
+
+        return found.all(axis=1)
+
+
+class LoadedIds:
+
+    def __init__(self, table_id, directory=None, exact_limit=50000,
+                 error_rate=0.01, rebuild_seconds=7 * 24 * 3600):
+        self.table_id = table_id
+        self.directory = directory or os.environ.get(
+            'LOADED_IDS_DIR', 'exported_data/loaded_ids'
+        )
+        self.exact_limit = exact_limit
+        self.error_rate = error_rate
+        self.rebuild_seconds = rebuild_seconds
+
+        self.lock_path = os.path.join(self.directory, f'{table_id}.lock')
+        self.new_ids = dict()
+
+    @contextlib.contextmanager
+    def lock(self):
+        # Loads of the same table merge their ids into the files one at a time
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def path(self, partition):
+        return os.path.join(
+            self.directory,
+            f'{self.table_id}_{partition.replace("-", "_")}.npz',
+        )
+
+    @staticmethod
+    def date_range(partition):
+        # First day of the month and of the next one
+        start = dt.date.fromisoformat(partition + '-01')
+
+        return start, (start + dt.timedelta(days=32)).replace(day=1)
+
+    @staticmethod
+    def with_partitions(df):
+        # One filter per month of the date column, like the table partitions
+        return df.with_columns(
+            pl.col('date').cast(pl.Utf8).str.slice(0, 7).alias('partition')
+        )
+
+    def read_filters(self, partitions):
+        filters = dict()
+        for partition in partitions:
+            path = self.path(partition)
+            if os.path.exists(path):
+                id_filter = IdFilter.read(path)
+                if time.time() - id_filter.built_at < self.rebuild_seconds:
+                    filters[partition] = id_filter
+
+        return filters
+
+    def rebuild(self, cur, partitions):
+        # Missing and expired filters are rebuilt from a range scan of each
+        # month, which the date index and the table partitions can serve
+        ids = dict()
+        for partition in partitions:
+            cur.execute(
+                sql.SQL(
+                    'SELECT id FROM {} WHERE date >= %s AND date < %s;'
+                ).format(sql.Identifier(self.table_id)),
+                self.date_range(partition),
+            )
+            ids[partition] = [row[0] for row in cur.fetchall()]
+
+        with self.lock():
+            for partition, partition_ids in ids.items():
+                IdFilter.build(
+                    partition_ids, self.exact_limit, self.error_rate
+                ).write(self.path(partition))
+
+        # The ids just read are exact, the running load checks against them
+        # rather than against the written filters
+        return {
+            partition: IdFilter(ids=set(partition_ids))
+            for partition, partition_ids in ids.items()
+        }
+
+    def stored_ids(self, cur, ids, partitions):
+        # Bounded by the months of the ids, a partitioned table only
+        # searches those
+        ranges = [self.date_range(partition) for partition in partitions]
+        cur.execute(
+            sql.SQL(
+                'SELECT id FROM {} '
+                'WHERE id = ANY(%s) AND date >= %s AND date < %s;'
+            ).format(sql.Identifier(self.table_id)),
+            (
+                list(ids),
+                min(start for start, _ in ranges),
+                max(end for _, end in ranges),
+            ),
+        )
+
+        return {row[0] for row in cur.fetchall()}
+
+    def new_rows(self, cur, df):
+        df = self.with_partitions(df)
+        partitions = df['partition'].unique().to_list()
+
+        filters = self.read_filters(partitions)
+        stale = [p for p in partitions if p not in filters]
+        if len(stale):
+            filters.update(self.rebuild(cur, stale))
+
+        # Misses are surely new and hits of an exact set surely loaded,
+        # paths deleting rows forget their partitions. Only the hits of a
+        # Bloom filter are checked against the table.
+        loaded = set()
+        maybe = list()
+        hit_partitions = list()
+        for (partition,), group in df.groupby(['partition']):
+            ids = group['id'].to_list()
+            id_filter = filters[partition]
+            found = [
+                i for i, hit in zip(ids, id_filter.contains(ids)) if hit
+            ]
+            if id_filter.ids is not None:
+                loaded.update(found)
+            elif len(found):
+                maybe.extend(found)
+                hit_partitions.append(partition)
+        if len(maybe):
+            loaded.update(self.stored_ids(cur, maybe, hit_partitions))
+
+        df = df.filter(~pl.col('id').is_in(list(loaded)))
+        ingest_metrics.add('rows_filtered', len(loaded))
+        for (partition,), group in df.groupby(['partition']):
+            self.new_ids[partition] = group['id'].to_list()
+
+        return df.drop('partition')
+
+    def committed(self):
+        # Only ids of a committed load are added
+        if len(self.new_ids) == 0:
+            return
+
+        with self.lock():
+            for partition, ids in self.new_ids.items():
+                path = self.path(partition)
+                if not os.path.exists(path):
+                    continue
+                id_filter = IdFilter.read(path)
+                if (
+                    id_filter.ids is not None
+                    and len(id_filter.ids) + len(ids) > self.exact_limit
+                ):
+                    # Grown past an exact set, the next load rebuilds it
+                    os.remove(path)
+                    continue
+                id_filter.add(ids)
+                id_filter.write(path)
+        self.new_ids = dict()
+
+    def forget(self, partitions):
+        # Partitions with rows deleted from the table must not filter new
+        # loads, the next load rebuilds them
+        with self.lock():
+            for partition in partitions:
+                path = self.path(partition)
+                if os.path.exists(path):
+                    os.remove(path)
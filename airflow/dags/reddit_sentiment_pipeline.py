@@ -3,6 +3,7 @@ import datetime as dt
 from airflow.decorators import dag, task
 
 from data_ingest import StockRedditIngest
+import stage_profiler
 
 
 @dag(
@@ -42,6 +43,7 @@ def reddit_sentiment_ingest():
         )
         def extract(symbol, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             raw_data = StockRedditIngest(
                 symbol,
@@ -58,6 +60,7 @@ def reddit_sentiment_ingest():
         )
         def transform(symbol, raw_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             transformed_data = StockRedditIngest(
                 symbol,
@@ -73,6 +76,7 @@ def reddit_sentiment_ingest():
         )
         def load(symbol, transformed_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             StockRedditIngest(
                 symbol,
@@ -0,0 +1,225 @@
+"""
+opt-in profiling of a single ingest stage, e.g.
+    INGEST_PROFILE=StockArticleIngest.transform_data INGEST_PROFILER=sampling
+"""
+
+import collections
+import contextlib
+import cProfile
+import fnmatch
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger('stage_profiler')
+
+PROFILERS = ('cprofile', 'sampling')
+
+# Only one stage can be profiled at a time, cProfile can not be nested
+_active = threading.Lock()
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f'{os.path.basename(code.co_filename)}:{code.co_name}'
+                )
+                frame = frame.f_back
+
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        # Collapsed stacks, the input format of flamegraph tools
+        with open(path, 'w') as folded:
+            for stack, count in self.stacks.most_common():
+                folded.write(f'{stack} {count}\n')
+
+
+def targets():
+    return [
+        target.strip()
+        for target in os.getenv('INGEST_PROFILE', '').split(',')
+        if target.strip()
+    ]
+
+
+def is_target(ingest, stage):
+    for target in targets():
+        if '.' not in target:
+            target += '.*'
+        if fnmatch.fnmatch(f'{ingest}.{stage}', target):
+            return True
+
+    return False
+
+
+def output_dir():
+    if os.getenv('INGEST_PROFILE_DIR'):
+        return os.getenv('INGEST_PROFILE_DIR')
+
+    # Inside an Airflow task, write next to the log of the task
+    dag_id = os.getenv('AIRFLOW_CTX_DAG_ID')
+    if dag_id:
+        base_log_folder = os.getenv(
+            'AIRFLOW__LOGGING__BASE_LOG_FOLDER',
+            os.path.join(os.getenv('AIRFLOW_HOME', '.'), 'logs'),
+        )
+        return os.path.join(
+            base_log_folder,
+            f'dag_id={dag_id}',
+            f'run_id={os.getenv("AIRFLOW_CTX_DAG_RUN_ID")}',
+            f'task_id={os.getenv("AIRFLOW_CTX_TASK_ID")}',
+            'profiles',
+        )
+
+    return os.path.join('logs', 'profiles')
+
+
+def configure(profile=None, profiler=None, profile_dir=None):
+    settings = {
+        'INGEST_PROFILE': profile,
+        'INGEST_PROFILER': profiler,
+        'INGEST_PROFILE_DIR': profile_dir,
+    }
+    for name, value in settings.items():
+        if value:
+            os.environ[name] = value
+
+
+def configure_from_context(**kwargs):
+    # Lets a triggered DAG run turn profiling on through its conf, e.g.
+    # {"profile": "StockArticleIngest.transform_data"}
+    dag_run = kwargs.get('dag_run')
+    conf = (dag_run.conf if dag_run is not None else None) or dict()
+
+    configure(
+        conf.get('profile'),
+        conf.get('profiler'),
+        conf.get('profile_dir'),
+    )
+
+
+@contextlib.contextmanager
+def profile_stage(ingest, stage, symbol=None):
+    if not is_target(ingest, stage) or not _active.acquire(blocking=False):
+        yield
+        return
+
+    profiler_name = os.getenv('INGEST_PROFILER', 'cprofile')
+    if profiler_name not in PROFILERS:
+        _active.release()
+        raise ValueError(
+            f'INGEST_PROFILER must be one of {PROFILERS}, got {profiler_name}'
+        )
+
+    if profiler_name == 'sampling':
+        profiler = SamplingProfiler(
+            float(os.getenv('INGEST_PROFILE_INTERVAL', 0.005))
+        )
+        start, stop = profiler.start, profiler.stop
+    else:
+        profiler = cProfile.Profile()
+        start, stop = profiler.enable, profiler.disable
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    wall_start = time.perf_counter()
+    start()
+    try:
+        yield
+    finally:
+        stop()
+        wall_time = time.perf_counter() - wall_start
+        current, peak = tracemalloc.get_traced_memory()
+        top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        if not tracing:
+            tracemalloc.stop()
+        _active.release()
+
+        write_profile(
+            ingest,
+            stage,
+            symbol,
+            profiler_name,
+            profiler,
+            {
+                'ingest': ingest,
+                'stage': stage,
+                'symbol': symbol,
+                'profiler': profiler_name,
+                'wall_time_seconds': wall_time,
+                'tracemalloc_peak_bytes': peak,
+                'tracemalloc_current_bytes': current,
+                'top_allocations': [str(stat) for stat in top_allocations],
+            },
+        )
+
+
+def write_profile(ingest, stage, symbol, profiler_name, profiler, summary):
+    directory = output_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    prefix = os.path.join(
+        directory,
+        '.'.join(
+            [
+                ingest,
+                stage,
+                symbol or 'all',
+                str(os.getpid()),
+                time.strftime('%Y%m%dT%H%M%S'),
+            ]
+        ),
+    )
+
+    if profiler_name == 'sampling':
+        profiler.dump(prefix + '.folded')
+    else:
+        profiler.dump_stats(prefix + '.prof')
+
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats(
+            'cumulative'
+        ).print_stats(50)
+        with open(prefix + '.txt', 'w') as text:
+            text.write(report.getvalue())
+
+    with open(prefix + '.json', 'w') as summary_file:
+        json.dump(summary, summary_file, indent=4)
+
+    logger.info(
+        f'Wrote {profiler_name} profile of {ingest}.{stage} to {prefix}'
+    )
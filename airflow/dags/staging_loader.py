@@ -0,0 +1,205 @@
+"""
+staging: COPY into an unlogged staging table, merge with per-symbol
+inserted/updated/skipped counts
+"""
+
+import io
+import os
+import uuid
+
+import polars as pl
+from psycopg2 import sql
+
+import ingest_metrics
+
+# insert: row inserts with ON CONFLICT DO NOTHING
+# staging: staged merge, stored rows are kept
+# upsert: staged merge, stored rows that differ are updated
+LOADERS = (
+    'insert',
+    'staging',
+    'upsert',
+)
+
+
+def mode():
+    return os.getenv('INGEST_LOADER', 'insert')
+
+
+def configure(loader=None):
+    # Set in the environment so spawned workers load the same way
+    if loader:
+        os.environ['INGEST_LOADER'] = loader
+
+
+class StagingLoader:
+
+    def __init__(self, table_id, key_columns=None, update=None):
+        self.table_id = table_id
+        self.key_columns = key_columns
+        self.update = mode() == 'upsert' if update is None else update
+
+    def primary_key(self, cur):
+        # Partitioned tables have the partition column in their key
+        cur.execute(
+            """
+            SELECT a.attname
+            FROM pg_index i
+            JOIN pg_attribute a
+                ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = TO_REGCLASS(%s) AND i.indisprimary
+            ORDER BY ARRAY_POSITION(i.indkey::INT2[], a.attnum);
+            """,
+            (self.table_id,),
+        )
+
+        return [row[0] for row in cur.fetchall()]
+
+    def merge_query(self, staging_id, columns):
+        keys = sql.SQL(', ').join(map(sql.Identifier, self.key_columns))
+        returned = ['symbol'] + [c for c in self.key_columns if c != 'symbol']
+        if self.update:
+            values = [c for c in columns if c not in self.key_columns]
+            action = sql.SQL(
+                'DO UPDATE SET ({}) = ROW({}) WHERE ({}) IS DISTINCT FROM ({})'
+            ).format(
+                sql.SQL(', ').join(map(sql.Identifier, values)),
+                sql.SQL(', ').join(
+                    sql.SQL('EXCLUDED.{}').format(sql.Identifier(c))
+                    for c in values
+                ),
+                sql.SQL(', ').join(
+                    sql.SQL('t.{}').format(sql.Identifier(c)) for c in values
+                ),
+                sql.SQL(', ').join(
+                    sql.SQL('EXCLUDED.{}').format(sql.Identifier(c))
+                    for c in values
+                ),
+            )
+        else:
+            action = sql.SQL('DO NOTHING')
+
+        # Inserted rows are told apart from updated ones by the stored
+        # keys, read in the same snapshot as the merge. Rows left as they
+        # were are not returned, they count as skipped.
+        return sql.SQL(
+            """
+            WITH staged AS (
+                SELECT DISTINCT ON ({keys}) {columns} FROM {staging}
+            ),
+            stored AS (
+                SELECT {keys} FROM {table} JOIN staged USING ({keys})
+            ),
+            merged AS (
+                INSERT INTO {table} AS t ({columns})
+                SELECT {columns} FROM staged
+                ON CONFLICT ({keys}) {action}
+                RETURNING {returned}
+            )
+            SELECT
+                merged.symbol,
+                COUNT(*) FILTER (WHERE stored IS NULL),
+                COUNT(*) FILTER (WHERE stored IS NOT NULL)
+            FROM merged
+            LEFT JOIN stored USING ({keys})
+            GROUP BY merged.symbol;
+            """
+        ).format(
+            table=sql.Identifier(self.table_id),
+            columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+            keys=keys,
+            staging=sql.Identifier(staging_id),
+            action=action,
+            returned=sql.SQL(', ').join(
+                sql.SQL('t.{}').format(sql.Identifier(c)) for c in returned
+            ),
+        )
+
+    def load(self, cur, df):
+        if df.height == 0:
+            return self.report(df, list())
+
+        if self.key_columns is None:
+            self.key_columns = self.primary_key(cur)
+
+        # Named per load, concurrent loads of a table never share one
+        staging_id = f'{self.table_id}_staging_{uuid.uuid4().hex[:12]}'
+        cur.execute(
+            sql.SQL(
+                'CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS);'
+            ).format(
+                sql.Identifier(staging_id),
+                sql.Identifier(self.table_id),
+            )
+        )
+        # Numbers are staged as sent and cast on the merge, like the
+        # row inserts do, e.g. a float volume into an integer column
+        numeric = [
+            sql.SQL('ALTER COLUMN {} TYPE {}').format(
+                sql.Identifier(column),
+                sql.SQL('FLOAT8' if dtype in pl.FLOAT_DTYPES else 'BIGINT'),
+            )
+            for column, dtype in df.schema.items()
+            if dtype in pl.FLOAT_DTYPES or dtype in pl.INTEGER_DTYPES
+        ]
+        if len(numeric):
+            cur.execute(
+                sql.SQL('ALTER TABLE {} {};').format(
+                    sql.Identifier(staging_id),
+                    sql.SQL(', ').join(numeric),
+                )
+            )
+
+        data = io.BytesIO()
+        df.write_csv(data, has_header=False)
+        data.seek(0)
+        cur.copy_expert(
+            sql.SQL('COPY {} ({}) FROM STDIN WITH (FORMAT csv);').format(
+                sql.Identifier(staging_id),
+                sql.SQL(', ').join(map(sql.Identifier, df.columns)),
+            ),
+            data,
+        )
+
+        cur.execute(self.merge_query(staging_id, df.columns))
+        merged = cur.fetchall()
+
+        # A failed load rolls the staging table back with everything else
+        cur.execute(
+            sql.SQL('DROP TABLE {};').format(sql.Identifier(staging_id))
+        )
+
+        return self.report(df, merged)
+
+    def report(self, df, merged):
+        counts = df.groupby('symbol').agg(
+            pl.count().alias('staged')
+        ).join(
+            pl.DataFrame(
+                merged,
+                schema=[
+                    ('symbol', pl.Utf8),
+                    ('inserted', pl.Int64),
+                    ('updated', pl.Int64),
+                ],
+                orient='row',
+            ),
+            on='symbol',
+            how='left',
+        ).with_columns(
+            pl.col(['inserted', 'updated']).fill_null(0)
+        ).with_columns(
+            (
+                pl.col('staged') - pl.col('inserted') - pl.col('updated')
+            ).alias('skipped')
+        ).sort('symbol')
+
+        # Counters of the running load stage, one stage per table and symbol
+        for name in ('inserted', 'updated', 'skipped'):
+            ingest_metrics.add(f'rows_{name}', counts[name].sum() or 0)
+        ingest_metrics.count(
+            'rows_out',
+            (counts['inserted'].sum() or 0) + (counts['updated'].sum() or 0),
+        )
+
+        return counts
@@ -3,6 +3,7 @@ import datetime as dt
 from airflow.decorators import dag, task
 
 from data_ingest import StockArticleIngest
+import stage_profiler
 
 
 @dag(
@@ -42,6 +43,7 @@ def stock_article_ingest():
         )
         def extract(symbol, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             raw_data = StockArticleIngest(
                 symbol,
@@ -58,6 +60,7 @@ def stock_article_ingest():
         )
         def transform(symbol, raw_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             transformed_data = StockArticleIngest(
                 symbol,
@@ -73,6 +76,7 @@ def stock_article_ingest():
         )
         def load(symbol, transformed_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             StockArticleIngest(
                 symbol,
@@ -80,9 +84,54 @@ def stock_article_ingest():
                 from_time,
             ).load_data(transformed_data)
 
+        @task(
+            task_id=f'dedup_data_{symbol}',
+            retries=3,
+        )
+        def dedup(symbol, **kwargs):
+            from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
+
+            StockArticleIngest(
+                symbol,
+                from_time,
+                from_time,
+            ).dedup_data()
+
+        @task(
+            task_id=f'score_data_{symbol}',
+            retries=3,
+        )
+        def score(symbol, **kwargs):
+            from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
+
+            StockArticleIngest(
+                symbol,
+                from_time,
+                from_time,
+            ).score_data()
+
+        @task(
+            task_id=f'embed_data_{symbol}',
+            retries=3,
+        )
+        def embed(symbol, **kwargs):
+            from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
+
+            StockArticleIngest(
+                symbol,
+                from_time,
+                from_time,
+            ).embed_data()
+
         raw_data = extract(symbol)
         transformed_data = transform(symbol, raw_data)
-        load(symbol, transformed_data)
+        load(symbol, transformed_data) >> dedup(symbol) >> [
+            score(symbol),
+            embed(symbol),
+        ]
 
 
 stock_article_ingest()
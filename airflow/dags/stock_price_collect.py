@@ -2,6 +2,7 @@
 daily: to_time = from_time + 1 day
 """
 
+import pandas as pd
 from pandas_datareader import data as pdr
 import yfinance as yf
 
@@ -12,31 +13,44 @@ class StockPriceCollector:
         self.from_time = from_time
         self.to_time = to_time
         self.stock_symbol = stock_symbol
+        self.daily = None
+        # Requests sent to the provider, for the ingest metrics
+        self.downloads = 0
 
         yf.pdr_override()
 
+    def get_daily(self):
+        # One download serves every column, later calls reuse it
+        if self.daily is None:
+            self.downloads += 1
+            daily = pdr.get_data_yahoo(
+                self.stock_symbol,
+                self.from_time,
+                self.to_time,
+            )
+            if isinstance(daily.columns, pd.MultiIndex):
+                daily.columns = daily.columns.get_level_values(0)
+            daily.index = [
+                date.strftime('%Y-%m-%d') for date in daily.index
+            ]
+            self.daily = daily.fillna(value=999999)
+
+        return self.daily
+
+    def get_ohlcv(self):
+        daily = self.get_daily()
+
+        return {
+            'open': daily['Open'].to_dict(),
+            'high': daily['High'].to_dict(),
+            'low': daily['Low'].to_dict(),
+            'close': daily['Close'].to_dict(),
+            'price': daily['Adj Close'].to_dict(),
+            'volume': daily['Volume'].to_dict(),
+        }
+
     def get_price(self):
-        price = pdr.get_data_yahoo(
-            self.stock_symbol,
-            self.from_time,
-            self.to_time,
-        )['Adj Close']
-        price.index = [
-            date.strftime('%Y-%m-%d') for date in price.index
-        ]
-        price = price.fillna(value=999999)
-        
-        return price.to_dict()
+        return self.get_daily()['Adj Close'].to_dict()
 
     def get_volume(self):
-        volume = pdr.get_data_yahoo(
-            self.stock_symbol,
-            self.from_time,
-            self.to_time
-        )['Volume']
-        volume.index = [
-            date.strftime('%Y-%m-%d') for date in volume.index
-        ]
-        volume = volume.fillna(value=999999)
-
-        return volume.to_dict()
+        return self.get_daily()['Volume'].to_dict()
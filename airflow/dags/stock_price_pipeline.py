@@ -3,6 +3,8 @@ import datetime as dt
 from airflow.decorators import dag, task
 
 from data_ingest import StockPriceIngest
+from feature_table import FeatureTableBuilder
+import stage_profiler
 
 
 @dag(
@@ -27,7 +29,7 @@ def stock_price_ingest():
 
         return from_time, to_time
 
-    for symbol in [
+    symbols = [
         'META',
         'AMZN',
         'AAPL',
@@ -35,7 +37,22 @@ def stock_price_ingest():
         'GOOGL',
         'TSLA',
         'MSFT',
-    ]:
+    ]
+
+    # Features are built from the price analytics the loads extended, once
+    # every symbol is loaded
+    @task(
+        task_id='update_features',
+        retries=3,
+    )
+    def update_features(**kwargs):
+        stage_profiler.configure_from_context(**kwargs)
+
+        FeatureTableBuilder().update(symbols)
+
+    features = update_features()
+
+    for symbol in symbols:
         @task(
             task_id=f'extract_data_{symbol}',
             multiple_outputs=True,
@@ -43,6 +60,7 @@ def stock_price_ingest():
         )
         def extract(symbol, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             raw_data = StockPriceIngest(
                 symbol,
@@ -59,6 +77,7 @@ def stock_price_ingest():
         )
         def transform(symbol, raw_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             transformed_data = StockPriceIngest(
                 symbol,
@@ -74,6 +93,7 @@ def stock_price_ingest():
         )
         def load(symbol, transformed_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             StockPriceIngest(
                 symbol,
@@ -83,7 +103,7 @@ def stock_price_ingest():
 
         raw_data = extract(symbol)
         transformed_data = transform(symbol, raw_data)
-        load(symbol, transformed_data)
+        load(symbol, transformed_data) >> features
 
 
 stock_price_ingest()
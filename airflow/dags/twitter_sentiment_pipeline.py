@@ -3,6 +3,7 @@ import datetime as dt
 from airflow.decorators import dag, task
 
 from data_ingest import StockTwitterIngest
+import stage_profiler
 
 
 @dag(
@@ -42,6 +43,7 @@ def twitter_sentiment_ingest():
         )
         def extract(symbol, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             raw_data = StockTwitterIngest(
                 symbol,
@@ -58,6 +60,7 @@ def twitter_sentiment_ingest():
         )
         def transform(symbol, raw_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             transformed_data = StockTwitterIngest(
                 symbol,
@@ -73,6 +76,7 @@ def twitter_sentiment_ingest():
         )
         def load(symbol, transformed_data, **kwargs):
             from_time, to_time = retrieve_time(**kwargs)
+            stage_profiler.configure_from_context(**kwargs)
 
             StockTwitterIngest(
                 symbol,
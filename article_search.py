@@ -0,0 +1,110 @@
+"""
+search: ranked full-text search over article headlines and summaries
+"""
+
+import argparse
+import threading
+import time
+from collections import OrderedDict
+
+from fast_read import FastReader, date_literal, literal, where_clause
+
+
+class ArticleSearch:
+
+    text_config = 'english'
+
+    def __init__(self, reader=None, cache_size=128, cache_ttl=300):
+        self.reader = reader or FastReader()
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def build_query(self, text, symbols, from_date, to_date, limit):
+        tsquery = 'WEBSEARCH_TO_TSQUERY({}, {})'.format(
+            literal(self.text_config), literal(text)
+        )
+
+        predicates = ['c.search_vector @@ q']
+        if symbols is not None:
+            predicates.append(
+                f'a.symbol IN ({", ".join(map(literal, symbols))})'
+                if len(symbols) else 'FALSE'
+            )
+        if from_date is not None:
+            predicates.append(f'a.date >= {date_literal(from_date)}')
+        if to_date is not None:
+            predicates.append(f'a.date <= {date_literal(to_date)}')
+
+        return (
+            'SELECT a.id, a.symbol, a.date, a.time, c.headline, c.summary, '
+            'c.source, c.article_url, '
+            'TS_RANK(c.search_vector, q)::FLOAT8 AS rank '
+            'FROM article_contents c '
+            'JOIN stock_articles a USING (content_hash) '
+            f'CROSS JOIN {tsquery} AS q'
+            + where_clause(predicates)
+            + ' ORDER BY rank DESC, a.date DESC, a.id'
+            + f' LIMIT {int(limit)}'
+        )
+
+    def search(self, text, symbols=None, from_date=None, to_date=None,
+               limit=100):
+        if symbols is not None:
+            symbols = tuple(sorted(set(symbols)))
+        key = (
+            text,
+            symbols,
+            None if from_date is None else str(from_date),
+            None if to_date is None else str(to_date),
+            limit,
+        )
+
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                cached_at, df = cached
+                if time.monotonic() - cached_at < self.cache_ttl:
+                    self.cache.move_to_end(key)
+                    return df
+
+        df = self.reader.query(
+            self.build_query(text, symbols, from_date, to_date, limit)
+        )
+
+        with self.lock:
+            self.cache[key] = (time.monotonic(), df)
+            self.cache.move_to_end(key)
+            # Evict the least recently used queries
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return df
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Search article headlines and summaries',
+    )
+    parser.add_argument('text', help='web search syntax, e.g. "rate cut" -fed')
+    parser.add_argument('--symbols', nargs='+')
+    parser.add_argument('--from-date')
+    parser.add_argument('--to-date')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    print(
+        ArticleSearch().search(
+            args.text,
+            args.symbols,
+            args.from_date,
+            args.to_date,
+            args.limit,
+        )
+    )
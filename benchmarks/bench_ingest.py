@@ -0,0 +1,312 @@
+"""
+run from the repository root:
+    python -m benchmarks.bench_ingest --symbols 20 --days 30 \
+        --save-baseline default
+    python -m benchmarks.bench_ingest --symbols 20 --days 30 --compare default
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from benchmarks.synthetic_data import SyntheticDataGenerator
+from data_ingest import (
+    StockArticleIngest,
+    StockInfoIngestion,
+    StockPriceIngest,
+    StockRedditIngest,
+    StockTwitterIngest,
+)
+import ingest_metrics
+from loaded_ids import LoadedIds
+from psql_table_create import TableCreation
+from stock_info_history import StockInfoHistory
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+class IngestBenchmark:
+
+    def __init__(self, generator, load=True):
+        self.generator = generator
+        self.load = load
+
+        self.from_time = generator.start_date.strftime('%Y-%m-%d')
+        self.to_time = generator.days()[-1].strftime('%Y-%m-%d')
+
+    def payloads(self):
+        gen = self.generator
+        symbols = gen.stock_symbols
+
+        sentiment = {
+            symbol: gen.stock_social_sentiment(symbol) for symbol in symbols
+        }
+        ohlcv = {symbol: gen.yahoo_ohlcv(symbol) for symbol in symbols}
+
+        # Shape the payloads the way each extract_data returns them
+        return {
+            'StockInfoIngestion': [
+                (None, [gen.company_profile2(s) for s in symbols]),
+            ],
+            'StockPriceIngest': [
+                (
+                    s,
+                    {
+                        'open': ohlcv[s]['Open'],
+                        'high': ohlcv[s]['High'],
+                        'low': ohlcv[s]['Low'],
+                        'close': ohlcv[s]['Close'],
+                        'price': ohlcv[s]['Adj Close'],
+                        'volume': ohlcv[s]['Volume'],
+                    },
+                )
+                for s in symbols
+            ],
+            'StockRedditIngest': [
+                (s, sentiment[s]['reddit']) for s in symbols
+            ],
+            'StockTwitterIngest': [
+                (s, sentiment[s]['twitter']) for s in symbols
+            ],
+            'StockArticleIngest': [
+                (s, gen.company_news(s)) for s in symbols
+            ],
+        }
+
+    def ingest(self, class_name, symbol):
+        if class_name == 'StockInfoIngestion':
+            return StockInfoIngestion()
+
+        ingest_class = {
+            'StockPriceIngest': StockPriceIngest,
+            'StockRedditIngest': StockRedditIngest,
+            'StockTwitterIngest': StockTwitterIngest,
+            'StockArticleIngest': StockArticleIngest,
+        }[class_name]
+
+        return ingest_class(symbol, self.from_time, self.to_time)
+
+    def run(self):
+        results = dict()
+
+        for class_name, payloads in self.payloads().items():
+            ingests = [
+                (self.ingest(class_name, symbol), raw_data)
+                for symbol, raw_data in payloads
+            ]
+
+            reset_peak_rss()
+            start = time.perf_counter()
+            transformed = [
+                (ingest, ingest.transform_data(raw_data))
+                for ingest, raw_data in ingests
+            ]
+            transform_seconds = time.perf_counter() - start
+            transform_peak = peak_rss()
+
+            rows = sum(
+                0 if df is False else df.height for _, df in transformed
+            )
+            result = {
+                'rows': rows,
+                'transform_seconds': transform_seconds,
+                'transform_rows_per_second': rows / transform_seconds,
+                'transform_peak_rss_mib': transform_peak,
+            }
+
+            if self.load:
+                reset_peak_rss()
+                start = time.perf_counter()
+                for ingest, df in transformed:
+                    ingest.load_data(df)
+                load_seconds = time.perf_counter() - start
+
+                result.update(
+                    {
+                        'load_seconds': load_seconds,
+                        'load_rows_per_second': rows / load_seconds,
+                        'load_peak_rss_mib': peak_rss(),
+                        'load_db_round_trips': sum(
+                            sample['db_round_trips']
+                            for sample in ingest_metrics.collected()
+                            if sample['ingest'] == class_name
+                            and sample['stage'] == 'load_data'
+                        ),
+                    }
+                )
+
+            results[class_name] = result
+            print_result(class_name, result)
+
+        return results
+
+
+def reset_peak_rss():
+    # Linux resets the VmHWM high-water mark when 5 is written here
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # Fall back to the process wide high-water mark (KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def print_result(class_name, result):
+    line = (
+        f'{class_name:<20} rows={result["rows"]:>9} '
+        f'transform={result["transform_rows_per_second"]:>12,.0f} rows/s '
+        f'peak={result["transform_peak_rss_mib"]:>8.1f} MiB'
+    )
+    if 'load_seconds' in result:
+        line += (
+            f' | load={result["load_rows_per_second"]:>10,.0f} rows/s '
+            f'peak={result["load_peak_rss_mib"]:>8.1f} MiB '
+            f'round-trips={result["load_db_round_trips"]}'
+        )
+    print(line)
+
+
+def prepare_database(generator, allow_remote):
+    with open('postgresql.json', 'r') as psql:
+        config = json.load(psql)
+
+    if config['host'] not in ('localhost', '127.0.0.1') and not allow_remote:
+        sys.exit(
+            f'Refusing to load synthetic data into {config["host"]}, '
+            'use a local Postgres or pass --allow-remote'
+        )
+
+    TableCreation().create_table()
+
+    conn = psycopg2.connect(
+        host=config['host'],
+        database=config['database'],
+        user=config['user'],
+        password=config['password'],
+        port=config['port'],
+    )
+    cur = conn.cursor()
+
+    # Remove rows of a previous run so every load inserts fresh rows
+    for table_id in TableCreation.ingest_tables:
+        cur.execute(
+            sql.SQL('DELETE FROM {} WHERE symbol = ANY(%s);').format(
+                sql.Identifier(table_id)
+            ),
+            (generator.stock_symbols,),
+        )
+    cur.execute(
+        sql.SQL('DELETE FROM {} WHERE symbol = ANY(%s);').format(
+            sql.Identifier(StockInfoHistory.history_table_id)
+        ),
+        (generator.stock_symbols,),
+    )
+    cur.execute(
+        'DELETE FROM article_contents c WHERE NOT EXISTS '
+        '(SELECT 1 FROM stock_articles a '
+        'WHERE a.content_hash = c.content_hash);'
+    )
+
+    cur.close()
+    conn.commit()
+
+    # Filters of loaded ids still hold the deleted rows
+    months = sorted({day.strftime('%Y-%m') for day in generator.days()})
+    for table_id in TableCreation.ingest_tables:
+        LoadedIds(table_id).forget(months)
+
+
+def compare(results, baseline, threshold):
+    regressions = list()
+
+    for class_name, result in results.items():
+        base = baseline.get(class_name)
+        if base is None:
+            continue
+
+        for metric in ('transform_rows_per_second', 'load_rows_per_second'):
+            if metric not in result or metric not in base:
+                continue
+            change = result[metric] / base[metric] - 1
+            flag = ''
+            if change < -threshold:
+                flag = '  <-- regression'
+                regressions.append((class_name, metric))
+            print(f'{class_name:<20} {metric:<26} {change:+8.1%}{flag}')
+
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark transform and load of every ingest class',
+    )
+    parser.add_argument('--symbols', type=int, default=7)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--hourly-rows', type=int, default=24)
+    parser.add_argument('--articles-per-day', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-load', action='store_true')
+    parser.add_argument('--allow-remote', action='store_true')
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--threshold', type=float, default=0.1)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    generator = SyntheticDataGenerator(
+        args.symbols,
+        args.days,
+        hourly_rows=args.hourly_rows,
+        articles_per_day=args.articles_per_day,
+        seed=args.seed,
+    )
+    if not args.skip_load:
+        prepare_database(generator, args.allow_remote)
+
+    results = IngestBenchmark(generator, load=not args.skip_load).run()
+
+    scale = {
+        'symbols': args.symbols,
+        'days': args.days,
+        'hourly_rows': args.hourly_rows,
+        'articles_per_day': args.articles_per_day,
+    }
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'{args.save_baseline}.json')
+        with open(path, 'w') as baseline:
+            json.dump({'scale': scale, 'results': results}, baseline, indent=4)
+        print(f'Saved baseline to {path}')
+
+    if args.compare:
+        path = os.path.join(BASELINE_DIR, f'{args.compare}.json')
+        with open(path, 'r') as baseline:
+            baseline = json.load(baseline)
+        if baseline['scale'] != scale:
+            print(f'Warning: baseline was recorded at {baseline["scale"]}')
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
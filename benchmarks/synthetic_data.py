@@ -0,0 +1,153 @@
+"""
+synthetic finnhub and yahoo payloads shaped like the real api responses
+"""
+
+import datetime as dt
+import random
+
+
+class SyntheticDataGenerator:
+
+    def __init__(self, n_symbols, n_days, hourly_rows=24,
+                 articles_per_day=10, start_date='2022-04-01', seed=0):
+        self.n_symbols = n_symbols
+        self.n_days = n_days
+        self.hourly_rows = hourly_rows
+        self.articles_per_day = articles_per_day
+        self.start_date = dt.datetime.strptime(start_date, '%Y-%m-%d')
+        self.seed = seed
+
+        # Synthetic tickers never collide with real ones
+        self.stock_symbols = [
+            f'SYN{i:04d}' for i in range(n_symbols)
+        ]
+
+    def rng(self, *key):
+        return random.Random(f'{self.seed}_' + '_'.join(map(str, key)))
+
+    def days(self):
+        return [
+            self.start_date + dt.timedelta(days=i)
+            for i in range(self.n_days)
+        ]
+
+    def company_profile2(self, symbol):
+        rng = self.rng('profile', symbol)
+
+        return {
+            'country': 'US',
+            'currency': 'USD',
+            'estimateCurrency': 'USD',
+            'exchange': 'NASDAQ NMS - GLOBAL MARKET',
+            'finnhubIndustry': rng.choice(
+                ['Technology', 'Media', 'Retail', 'Automobiles']
+            ),
+            'ipo': (
+                dt.date(1980, 1, 1)
+                + dt.timedelta(days=rng.randint(0, 15000))
+            ).strftime('%Y-%m-%d'),
+            'logo': f'https://static.finnhub.io/logo/{symbol}.png',
+            'marketCapitalization': rng.uniform(1e4, 3e6),
+            'name': f'{symbol} Synthetic Inc',
+            'phone': str(float(rng.randint(10 ** 9, 10 ** 10))),
+            'shareOutstanding': rng.uniform(1e2, 2e4),
+            'ticker': symbol,
+            'weburl': f'https://www.{symbol.lower()}.example.com/',
+        }
+
+    def stock_social_sentiment(self, symbol):
+        rng = self.rng('sentiment', symbol)
+
+        def platform_rows():
+            rows = list()
+            for day in self.days():
+                for hour in range(self.hourly_rows):
+                    positive = rng.randint(0, 50)
+                    negative = rng.randint(0, 50)
+                    positive_score = rng.uniform(0, 1)
+                    negative_score = -rng.uniform(0, 1)
+                    rows.append(
+                        {
+                            'atTime': (
+                                day + dt.timedelta(hours=hour)
+                            ).strftime('%Y-%m-%d %H:%M:%S'),
+                            'mention': positive + negative,
+                            'positiveScore': positive_score,
+                            'negativeScore': negative_score,
+                            'positiveMention': positive,
+                            'negativeMention': negative,
+                            'score': positive_score + negative_score,
+                        }
+                    )
+
+            return rows
+
+        return {
+            'reddit': platform_rows(),
+            'symbol': symbol,
+            'twitter': platform_rows(),
+        }
+
+    def company_news(self, symbol):
+        rng = self.rng('news', symbol)
+        words = [
+            'shares', 'rally', 'earnings', 'beat', 'guidance', 'cut',
+            'analysts', 'upgrade', 'downgrade', 'record', 'quarter',
+            'revenue', 'growth', 'slows', 'market', 'investors',
+        ]
+
+        articles = list()
+        for day in self.days():
+            for _ in range(self.articles_per_day):
+                news_id = rng.randint(10 ** 8, 10 ** 9)
+                published = day + dt.timedelta(
+                    seconds=rng.randint(0, 86399)
+                )
+                articles.append(
+                    {
+                        'category': 'company',
+                        'datetime': int(
+                            published.replace(
+                                tzinfo=dt.timezone.utc
+                            ).timestamp()
+                        ),
+                        'headline': ' '.join(rng.choices(words, k=10)),
+                        'id': news_id,
+                        'image': f'https://images.example.com/{news_id}.jpg',
+                        'related': symbol,
+                        'source': rng.choice(['Yahoo', 'Reuters', 'CNBC']),
+                        'summary': ' '.join(rng.choices(words, k=80)),
+                        'url': f'https://news.example.com/{news_id}',
+                    }
+                )
+
+        return articles
+
+    def yahoo_ohlcv(self, symbol):
+        rng = self.rng('ohlcv', symbol)
+
+        close = rng.uniform(20, 500)
+        ohlcv = {
+            'Open': dict(),
+            'High': dict(),
+            'Low': dict(),
+            'Close': dict(),
+            'Adj Close': dict(),
+            'Volume': dict(),
+        }
+        for day in self.days():
+            date = day.strftime('%Y-%m-%d')
+            open_ = close * (1 + rng.gauss(0, 0.005))
+            close = open_ * (1 + rng.gauss(0, 0.02))
+            ohlcv['Open'][date] = open_
+            ohlcv['High'][date] = (
+                max(open_, close) * (1 + rng.uniform(0, 0.01))
+            )
+            ohlcv['Low'][date] = (
+                min(open_, close) * (1 - rng.uniform(0, 0.01))
+            )
+            ohlcv['Close'][date] = close
+            ohlcv['Adj Close'][date] = close * 0.99
+            ohlcv['Volume'][date] = rng.randint(10 ** 6, 10 ** 8)
+
+        return ohlcv
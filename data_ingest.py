@@ -1,16 +1,41 @@
+import argparse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 import datetime as dt
+import io
 import json
+import multiprocessing as mp
+import time
 
-import polars as pl
-import psycopg2
 from psycopg2 import sql, extras
 
 from stock_articles_collect import ArticleCollector
 from social_sentiment_collect import SocialSentimentCollector
 from stock_price_collect import StockPriceCollector
 from stock_info_collect import StockInfoCollector
-
-
+from article_dedup import ArticleDeduplicator
+from article_embeddings import ArticleEmbeddingIndex
+from article_sentiment import ArticleSentimentScorer
+from article_store import ArticleStore
+from feature_table import FeatureTableBuilder
+import ingest_metrics
+from ingest_metrics import instrument
+import ingest_transforms
+from loaded_ids import LoadedIds
+from price_analytics import PriceAnalytics
+from psql_table_create import TableCreation
+from sentiment_rollup import SentimentRollup
+from stock_info_history import StockInfoHistory
+import stage_profiler
+import staging_loader
+import transform_executor
+
+
+@instrument
 class StockInfoIngestion:
 
     def __init__(self):
@@ -32,71 +57,16 @@ class StockInfoIngestion:
         # Loop through the stock symbols to extract data of them
         for symbol in self.stock_symbols:
             collector = StockInfoCollector(symbol)
+            ingest_metrics.count_session(collector.client._session)
             stock = collector.get_stock_info()
             all_stocks_data.append(stock)
 
         return all_stocks_data
 
     def transform_data(self, raw_data):
-        df = pl.DataFrame(raw_data)
-
-        # Rename and reorder columns of dataframe
-        df = df.rename(
-            {
-                'ticker': 'symbol',
-                'estimateCurrency': 'estimate_currency',
-                'finnhubIndustry': 'industry',
-                'ipo': 'ipo_date',
-                'marketCapitalization': 'market_capitalization',
-                'shareOutstanding': 'share_outstanding',
-                'weburl': 'web_url',
-            }
-        ).select(
-            [
-                'symbol',
-                'country',
-                'currency',
-                'estimate_currency',
-                'exchange',
-                'industry',
-                'ipo_date',
-                'logo',
-                'market_capitalization',
-                'name',
-                'phone',
-                'share_outstanding',
-                'web_url',
-            ]
-        )
-
-        # Convert data type of column to datetime format
-        df = df.with_columns(
-            df['ipo_date'].apply(
-                lambda x: dt.datetime.strptime(x, '%Y-%m-%d')
-            )
-        )
-
-        return df
+        return ingest_transforms.transform_info(raw_data)
 
     def load_data(self, transformed_data):
-        # Create sql identifiers for the column names
-        columns = sql.SQL(',').join(
-            sql.Identifier(name) for name in transformed_data.columns
-        )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
-
-        # Prepare the insert query
-        insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
-        ).format(
-            sql.Identifier(self.table_id), columns, values
-        )
-
         # Get config for the database
         with open('postgresql.json', 'r') as psql:
             config = json.load(psql)
@@ -107,7 +77,7 @@ class StockInfoIngestion:
         port = config['port']
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=host,
             database=db,
             user=user,
@@ -116,12 +86,11 @@ class StockInfoIngestion:
         )
         cur = conn.cursor()
 
-        # Load data to the database
-        extras.execute_batch(
-            cur,
-            insert_query,
-            transformed_data.rows(),
-        )
+        # Write only the rows that changed since the last load, and
+        # version them in the history table
+        history = StockInfoHistory()
+        changed = history.load(cur, transformed_data)
+        ingest_metrics.count('rows_out', changed.height)
 
         cur.close()
         conn.commit()
@@ -132,13 +101,28 @@ class StockInfoIngestion:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockPriceIngest:
-    def __init__(self, stock_symbol, from_time, to_time):
+    intervals = (
+        '1d',
+        '1h',
+        '5m',
+        '1m',
+    )
+
+    def __init__(self, stock_symbol, from_time, to_time, interval='1d'):
+        if interval not in self.intervals:
+            raise ValueError(f'interval must be one of {self.intervals}')
+
         self.stock_symbol = stock_symbol
         self.from_time = from_time
         self.to_time = to_time
+        self.interval = interval
 
         self.table_id = 'stock_price'
+        if interval != '1d':
+            # Intraday bars go to their own partitioned table
+            self.table_id = 'stock_price_bars'
 
     def extract_data(self):
         collector = StockPriceCollector(
@@ -147,71 +131,38 @@ class StockPriceIngest:
             self.to_time,
         )
 
-        price = collector.get_price()
-        volume = collector.get_volume()
+        if self.interval != '1d':
+            raw_data = collector.get_bars(self.interval)
+        else:
+            raw_data = collector.get_ohlcv()
+        ingest_metrics.count('api_calls', collector.downloads)
 
-        return {
-            'price': price,
-            'volume': volume,
-        }
+        return raw_data
 
     def transform_data(self, raw_data):
-        # Extract value of each columns from raw data
-        price_col = list(raw_data['price'].values())
-        volume_col = list(raw_data['volume'].values())
-        datetime_col = list(raw_data['price'].keys())
-
-        if len(price_col) == 0:
-            return False
-
-        df = pl.DataFrame([datetime_col, price_col, volume_col])
-
-        # Rename columns
-        df.columns = ['date', 'price', 'volume']
-
-        # Create new columns
-        df = df.with_columns(
-            pl.lit(self.stock_symbol).alias('symbol')
-        )
-        df = df.with_columns(
-            (
-                df['symbol'] + '_' + df['date']
-            ).alias('id')
+        return ingest_transforms.transform_price(
+            raw_data,
+            self.stock_symbol,
+            self.interval,
         )
 
-        # Reorder columns and sort by id
-        df = df.select(
-            [
-                'id',
-                'symbol',
-                'date',
-                'price',
-                'volume',
-            ]
-        ).sort('id')
-
-        return df
-
     def load_data(self, transformed_data):
         if transformed_data is False:
             return
+        if self.interval != '1d':
+            return self.load_bars(transformed_data)
 
         # Create sql identifiers for the column names
         columns = sql.SQL(',').join(
             sql.Identifier(name) for name in transformed_data.columns
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
 
-        # Prepare the insert query
+        # Prepare the insert query, the inserted rows are returned to be
+        # counted
         insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
+            'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING 1;'
         ).format(
-            sql.Identifier(self.table_id), columns, values
+            sql.Identifier(self.table_id), columns
         )
 
         # Get config for the database
@@ -224,7 +175,7 @@ class StockPriceIngest:
         port = config['port']
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=host,
             database=db,
             user=user,
@@ -233,13 +184,90 @@ class StockPriceIngest:
         )
         cur = conn.cursor()
 
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
         # Load data to the database
-        extras.execute_batch(
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                insert_query,
+                transformed_data.rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
+        # Extend the rolling analytics over the newly loaded days
+        PriceAnalytics().update(cur, [self.stock_symbol])
+
+        cur.close()
+        conn.commit()
+        loaded_ids.committed()
+
+    def load_bars(self, transformed_data):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+        cur = conn.cursor()
+
+        TableCreation().create_partitions(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.table_id,
+            transformed_data['ts'].dt.date().unique().to_list(),
         )
 
+        if staging_loader.mode() == 'insert':
+            # COPY into a staging table, then skip bars already stored
+            cur.execute(
+                sql.SQL(
+                    'CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP;'
+                ).format(
+                    sql.Identifier(f'{self.table_id}_staging'),
+                    sql.Identifier(self.table_id),
+                )
+            )
+            data = io.BytesIO()
+            transformed_data.write_csv(data, has_header=False)
+            data.seek(0)
+            cur.copy_expert(
+                sql.SQL('COPY {} FROM STDIN WITH (FORMAT csv);').format(
+                    sql.Identifier(f'{self.table_id}_staging'),
+                ),
+                data,
+            )
+            cur.execute(
+                sql.SQL(
+                    'INSERT INTO {} SELECT * FROM {} ON CONFLICT DO NOTHING;'
+                ).format(
+                    sql.Identifier(self.table_id),
+                    sql.Identifier(f'{self.table_id}_staging'),
+                )
+            )
+            ingest_metrics.count('rows_out', cur.rowcount)
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
         cur.close()
         conn.commit()
 
@@ -249,6 +277,7 @@ class StockPriceIngest:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockRedditIngest:
 
     def __init__(self, stock_symbol, from_time, to_time):
@@ -264,74 +293,19 @@ class StockRedditIngest:
             self.from_time,
             self.to_time,
         )
+        # The api client keeps one requests session
+        ingest_metrics.count_session(collector.client._session)
 
         reddit_sentiment = collector.get_reddit_sentiment()
 
         return reddit_sentiment
 
     def transform_data(self, raw_data):
-        if len(raw_data) == 0:
-            return False
-
-        df = pl.DataFrame(raw_data)
-
-        # Rename columns
-        df = df.rename(
-            {
-                'positiveScore': 'positive_score',
-                'negativeScore': 'negative_score',
-                'positiveMention': 'positive_mention',
-                'negativeMention': 'negative_mention',
-                'score': 'sentiment_score',
-                'atTime': 'date',
-
-            }
-        )
-
-        # Create new columns
-        df = df.with_columns(
-            pl.lit(self.stock_symbol).alias('symbol')
-        )
-        df = df.with_columns(
-            df['date'].apply(
-                lambda x: x.split(' ')[1]
-            ).alias('time')
-        )
-        df = df.with_columns(
-            (
-                'reddit' + '_'
-                + df['symbol'] + '_'
-                + df['date'].apply(lambda x: x.split(' ')[0])
-                + '_' + df['time']
-            ).alias('id')
-        )
-        df = df.with_columns(
-            df['date'].apply(
-                lambda x: dt.datetime.strptime(
-                    x.split(' ')[0],
-                    '%Y-%m-%d',
-                )
-            )
+        return ingest_transforms.transform_reddit(
+            raw_data,
+            self.stock_symbol,
         )
 
-        # Reorder columns and sort by id
-        df = df.select(
-            [
-                'id',
-                'symbol',
-                'date',
-                'time',
-                'mention',
-                'positive_score',
-                'negative_score',
-                'positive_mention',
-                'negative_mention',
-                'sentiment_score',
-            ]
-        ).sort('id')
-
-        return df
-
     def load_data(self, transformed_data):
         if transformed_data is False:
             return
@@ -340,18 +314,13 @@ class StockRedditIngest:
         columns = sql.SQL(',').join(
             sql.Identifier(name) for name in transformed_data.columns
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
 
-        # Prepare the insert query
+        # Prepare the insert query, the inserted rows are returned to be
+        # counted
         insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
+            'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING 1;'
         ).format(
-            sql.Identifier(self.table_id), columns, values
+            sql.Identifier(self.table_id), columns
         )
 
         # Get config for the database
@@ -364,7 +333,7 @@ class StockRedditIngest:
         port = config['port']
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=host,
             database=db,
             user=user,
@@ -373,15 +342,45 @@ class StockRedditIngest:
         )
         cur = conn.cursor()
 
+        # Months without a partition would be loaded into the default one
+        TableCreation().create_partitions(
+            cur,
+            self.table_id,
+            transformed_data['date'].unique().to_list(),
+        )
+
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
         # Load data to the database
-        extras.execute_batch(
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                insert_query,
+                transformed_data.rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
+        # Refresh the daily and weekly rollups of the dates just loaded
+        SentimentRollup('reddit').update(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.stock_symbol,
+            transformed_data['date'].unique().to_list(),
         )
 
         cur.close()
         conn.commit()
+        loaded_ids.committed()
 
     def main(self):
         raw_data = self.extract_data()
@@ -389,6 +388,7 @@ class StockRedditIngest:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockTwitterIngest:
 
     def __init__(self, stock_symbol, from_time, to_time):
@@ -404,74 +404,19 @@ class StockTwitterIngest:
             self.from_time,
             self.to_time,
         )
+        # The api client keeps one requests session
+        ingest_metrics.count_session(collector.client._session)
 
         twitter_sentiment = collector.get_twitter_sentiment()
 
         return twitter_sentiment
 
     def transform_data(self, raw_data):
-        if len(raw_data) == 0:
-            return False
-
-        df = pl.DataFrame(raw_data)
-
-        # Rename columns
-        df = df.rename(
-            {
-                'positiveScore': 'positive_score',
-                'negativeScore': 'negative_score',
-                'positiveMention': 'positive_mention',
-                'negativeMention': 'negative_mention',
-                'score': 'sentiment_score',
-                'atTime': 'date',
-
-            }
-        )
-
-        # Create new columns
-        df = df.with_columns(
-            pl.lit(self.stock_symbol).alias('symbol')
-        )
-        df = df.with_columns(
-            df['date'].apply(
-                lambda x: x.split(' ')[1]
-            ).alias('time')
-        )
-        df = df.with_columns(
-            (
-                'twitter' + '_'
-                + df['symbol'] + '_'
-                + df['date'].apply(lambda x: x.split(' ')[0])
-                + '_' + df['time']
-            ).alias('id')
-        )
-        df = df.with_columns(
-            df['date'].apply(
-                lambda x: dt.datetime.strptime(
-                    x.split(' ')[0],
-                    '%Y-%m-%d',
-                )
-            )
+        return ingest_transforms.transform_twitter(
+            raw_data,
+            self.stock_symbol,
         )
 
-        # Reorder columns and sort by id
-        df = df.select(
-            [
-                'id',
-                'symbol',
-                'date',
-                'time',
-                'mention',
-                'positive_score',
-                'negative_score',
-                'positive_mention',
-                'negative_mention',
-                'sentiment_score'
-            ]
-        ).sort('id')
-
-        return df
-
     def load_data(self, transformed_data):
         if transformed_data is False:
             return
@@ -480,18 +425,13 @@ class StockTwitterIngest:
         columns = sql.SQL(',').join(
             sql.Identifier(name) for name in transformed_data.columns
         )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
 
-        # Prepare the insert query
+        # Prepare the insert query, the inserted rows are returned to be
+        # counted
         insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
+            'INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING RETURNING 1;'
         ).format(
-            sql.Identifier(self.table_id), columns, values
+            sql.Identifier(self.table_id), columns
         )
 
         # Get config for the database
@@ -504,7 +444,7 @@ class StockTwitterIngest:
         port = config['port']
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=host,
             database=db,
             user=user,
@@ -513,15 +453,45 @@ class StockTwitterIngest:
         )
         cur = conn.cursor()
 
+        # Months without a partition would be loaded into the default one
+        TableCreation().create_partitions(
+            cur,
+            self.table_id,
+            transformed_data['date'].unique().to_list(),
+        )
+
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
         # Load data to the database
-        extras.execute_batch(
+        if staging_loader.mode() == 'insert':
+            inserted = extras.execute_values(
+                cur,
+                insert_query,
+                transformed_data.rows(),
+                page_size=1000,
+                fetch=True,
+            )
+            ingest_metrics.count('rows_out', len(inserted))
+        else:
+            staging_loader.StagingLoader(self.table_id).load(
+                cur,
+                transformed_data,
+            )
+
+        # Refresh the daily and weekly rollups of the dates just loaded
+        SentimentRollup('twitter').update(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.stock_symbol,
+            transformed_data['date'].unique().to_list(),
         )
 
         cur.close()
         conn.commit()
+        loaded_ids.committed()
 
     def main(self):
         raw_data = self.extract_data()
@@ -529,6 +499,7 @@ class StockTwitterIngest:
         self.load_data(transformed_data)
 
 
+@instrument
 class StockArticleIngest:
 
     def __init__(self, stock_symbol, from_time, to_time):
@@ -544,88 +515,23 @@ class StockArticleIngest:
             self.from_time,
             self.to_time,
         )
+        # The api client keeps one requests session
+        ingest_metrics.count_session(collector.client._session)
 
         articles = collector.get_articles()
 
         return articles
 
     def transform_data(self, raw_data):
-        if len(raw_data) == 0:
-            return False
-
-        df = pl.DataFrame(raw_data)
-
-        # Rename columns
-        df = df.rename(
-            {
-                'related': 'symbol',
-                'image': 'image_url',
-                'url': 'article_url',
-                'datetime': 'date'
-            }
-        )
-
-        # Create new columns
-        df = df.with_columns(
-            df['date'].apply(
-                lambda x: dt.datetime.utcfromtimestamp(
-                    int(x)
-                ).strftime('%H:%M:%S')
-            ).alias('time')
-        )
-        df = df.with_columns(
-            df['date'].apply(
-                lambda x: dt.datetime.utcfromtimestamp(
-                    int(x)
-                ).replace(hour=0, minute=0, second=0)
-            )
-        )
-        df = df.with_columns(
-            df['id'].apply(
-                lambda x: self.stock_symbol + '_' + str(x)
-            )
+        return ingest_transforms.transform_articles(
+            raw_data,
+            self.stock_symbol,
         )
 
-        # Reorder columns and sort by id
-        df = df.select(
-            [
-                'id',
-                'symbol',
-                'date',
-                'time',
-                'category',
-                'headline',
-                'image_url',
-                'source',
-                'summary',
-                'article_url'
-            ]
-        ).sort('id')
-
-        return df
-
     def load_data(self, transformed_data):
         if transformed_data is False:
             return
 
-        # Create sql identifiers for the column names
-        columns = sql.SQL(',').join(
-            sql.Identifier(name) for name in transformed_data.columns
-        )
-        # Create placeholders for the values
-        values = sql.SQL(',').join(
-            [
-                sql.Placeholder() for _ in transformed_data.columns
-            ]
-        )
-
-        # Prepare the insert query
-        insert_query = sql.SQL(
-            'INSERT INTO {} ({}) VALUES({}) ON CONFLICT DO NOTHING;'
-        ).format(
-            sql.Identifier(self.table_id), columns, values
-        )
-
         # Get config for the database
         with open('postgresql.json', 'r') as psql:
             config = json.load(psql)
@@ -636,7 +542,7 @@ class StockArticleIngest:
         port = config['port']
 
         # Make a connection
-        conn = psycopg2.connect(
+        conn = ingest_metrics.connect(
             host=host,
             database=db,
             user=user,
@@ -645,57 +551,543 @@ class StockArticleIngest:
         )
         cur = conn.cursor()
 
-        # Load data to the database
-        extras.execute_batch(
+        # Months without a partition would be loaded into the default one
+        TableCreation().create_partitions(
             cur,
-            insert_query,
-            transformed_data.rows(),
+            self.table_id,
+            transformed_data['date'].unique().to_list(),
         )
 
+        # Drop the rows already loaded before sending them, unless stored
+        # rows are to be updated
+        loaded_ids = LoadedIds(self.table_id)
+        if staging_loader.mode() != 'upsert':
+            transformed_data = loaded_ids.new_rows(cur, transformed_data)
+
+        # Load the references, and the bodies not stored yet
+        store = ArticleStore()
+        store.store(cur, transformed_data)
+
         cur.close()
         conn.commit()
+        loaded_ids.committed()
+        store.committed()
+
+    def dedup_data(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+        cur = conn.cursor()
+
+        # Assign the articles loaded for this symbol and window to clusters
+        # of near-duplicate stories
+        ArticleDeduplicator().dedup(
+            cur,
+            self.stock_symbol,
+            self.from_time,
+            self.to_time,
+        )
+
+        cur.close()
+        conn.commit()
+
+    def score_data(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+        cur = conn.cursor()
+
+        # Score the text of the articles loaded for this symbol and window
+        ArticleSentimentScorer().score(
+            cur,
+            self.stock_symbol,
+            self.from_time,
+            self.to_time,
+        )
+
+        cur.close()
+        conn.commit()
+
+    def embed_data(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        # Make a connection
+        conn = ingest_metrics.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+        # Append the new article bodies to the embedding index
+        ArticleEmbeddingIndex().append(
+            conn,
+            self.stock_symbol,
+            self.from_time,
+            self.to_time,
+        )
+
+        conn.close()
 
     def main(self):
         raw_data = self.extract_data()
         transformed_data = self.transform_data(raw_data)
         self.load_data(transformed_data)
+        self.dedup_data()
+        self.score_data()
+        self.embed_data()
+
+
+# Run in this order after a load, by the datasets that have them
+POST_LOAD_STAGES = (
+    'dedup_data',
+    'score_data',
+    'embed_data',
+)
+
+DATASETS = {
+    'info': StockInfoIngestion,
+    'price': StockPriceIngest,
+    'reddit': StockRedditIngest,
+    'twitter': StockTwitterIngest,
+    'articles': StockArticleIngest,
+}
+
+
+def symbols_from_file(path):
+    with open(path, 'r') as symbols:
+        return [
+            line.split('#')[0].strip()
+            for line in symbols
+            if line.split('#')[0].strip()
+        ]
+
+
+def symbols_from_db():
+    # Get config for the database
+    with open('postgresql.json', 'r') as psql:
+        config = json.load(psql)
+
+    conn = ingest_metrics.connect(
+        host=config['host'],
+        database=config['database'],
+        user=config['user'],
+        password=config['password'],
+        port=config['port'],
+    )
+    cur = conn.cursor()
+    cur.execute('SELECT symbol FROM stock_info ORDER BY symbol;')
+    symbols = [row[0] for row in cur.fetchall()]
+
+    cur.close()
+    conn.close()
+
+    return symbols
+
+
+def windows(from_date, to_date, window_days):
+    start = dt.datetime.strptime(from_date, '%Y-%m-%d')
+    end = dt.datetime.strptime(to_date, '%Y-%m-%d')
+
+    while start < end:
+        window_end = min(start + dt.timedelta(days=window_days), end)
+        yield start, window_end
+        start = window_end
+
+
+def plan_jobs(datasets, symbols, from_date, to_date, window_days):
+    jobs = list()
+
+    for dataset in datasets:
+        if dataset == 'info':
+            jobs.append((dataset, None, None, None))
+            continue
+
+        for symbol in symbols:
+            for start, end in windows(from_date, to_date, window_days):
+                from_time = start.strftime('%Y-%m-%d')
+                to_time = end.strftime('%Y-%m-%d')
+                # Articles are daily with to_time = from_time, so their
+                # window ends on its last day instead of the next one
+                if dataset == 'articles':
+                    to_time = (
+                        end - dt.timedelta(days=1)
+                    ).strftime('%Y-%m-%d')
+                jobs.append((dataset, symbol, from_time, to_time))
+
+    return jobs
+
+
+def make_ingest(job, symbols, interval='1d'):
+    dataset, symbol, from_time, to_time = job
+
+    if dataset == 'info':
+        ingest = StockInfoIngestion()
+        ingest.stock_symbols = symbols
+    elif dataset == 'price':
+        ingest = StockPriceIngest(symbol, from_time, to_time, interval)
+    else:
+        ingest = DATASETS[dataset](symbol, from_time, to_time)
+
+    return ingest
+
+
+def load_job(ingest, transformed_data):
+    ingest.load_data(transformed_data)
+    for stage in POST_LOAD_STAGES:
+        if hasattr(ingest, stage):
+            getattr(ingest, stage)()
+
+
+def run_job(job, symbols, dry_run, interval='1d'):
+    start = time.perf_counter()
+    ingest = make_ingest(job, symbols, interval)
+
+    try:
+        raw_data = ingest.extract_data()
+        transformed_data = ingest.transform_data(raw_data)
+        if not dry_run:
+            load_job(ingest, transformed_data)
+    except Exception as error:
+        return {
+            'job': job,
+            'rows': 0,
+            'seconds': time.perf_counter() - start,
+            'error': repr(error),
+        }
+
+    return {
+        'job': job,
+        'rows': 0 if transformed_data is False else transformed_data.height,
+        'seconds': time.perf_counter() - start,
+        'error': None,
+    }
+
+
+def extract_job(job, symbols, interval='1d'):
+    start = time.perf_counter()
+    try:
+        raw_data = make_ingest(job, symbols, interval).extract_data()
+    except Exception as error:
+        return None, time.perf_counter() - start, repr(error)
+
+    return raw_data, time.perf_counter() - start, None
+
+
+def transform_load_job(job, symbols, dry_run, interval, raw_data):
+    start = time.perf_counter()
+    ingest = make_ingest(job, symbols, interval)
+    try:
+        transformed_data = ingest.transform_data(raw_data)
+        if not dry_run:
+            load_job(ingest, transformed_data)
+    except Exception as error:
+        return 0, time.perf_counter() - start, repr(error)
+
+    rows = 0 if transformed_data is False else transformed_data.height
+
+    return rows, time.perf_counter() - start, None
+
+
+def pooled_load_job(job, symbols, dry_run, interval, transformed_data):
+    start = time.perf_counter()
+    try:
+        if not dry_run:
+            load_job(make_ingest(job, symbols, interval), transformed_data)
+    except Exception as error:
+        return 0, time.perf_counter() - start, repr(error)
+
+    rows = 0 if transformed_data is False else transformed_data.height
+
+    return rows, time.perf_counter() - start, None
+
+
+def run_backfill(executor, jobs, symbols, dry_run, interval='1d',
+                 transform_workers=None):
+    # Each job moves on as soon as its previous stage is done: extracts and
+    # loads run on the executor, the transforms of every windowed dataset on
+    # one spawned process pool sized for the cores. Only jobs in flight hold
+    # their rows.
+    results = [
+        {'job': job, 'rows': 0, 'seconds': 0.0, 'error': None}
+        for job in jobs
+    ]
+
+    with transform_executor.TransformExecutor(transform_workers) as pool:
+        stages = {
+            executor.submit(extract_job, job, symbols, interval):
+                ('extract', i)
+            for i, job in enumerate(jobs)
+        }
+
+        while len(stages) != 0:
+            done, _ = wait(stages, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, i = stages.pop(future)
+                job = jobs[i]
+
+                if stage == 'extract':
+                    raw_data, seconds, error = future.result()
+                    results[i]['seconds'] += seconds
+                    if error is not None:
+                        results[i]['error'] = error
+                        continue
+
+                    ingest_class = DATASETS[job[0]]
+                    if ingest_class.__name__ in pool.windowed_ingests:
+                        next_future = pool.submit(
+                            ingest_class,
+                            job[1],
+                            raw_data,
+                            interval,
+                        )
+                        stages[next_future] = ('transform', i)
+                    else:
+                        next_future = executor.submit(
+                            transform_load_job,
+                            job,
+                            symbols,
+                            dry_run,
+                            interval,
+                            raw_data,
+                        )
+                        stages[next_future] = ('load', i)
+                elif stage == 'transform':
+                    try:
+                        frame, seconds = pool.result(future)
+                    except Exception as error:
+                        results[i]['error'] = repr(error)
+                        continue
+
+                    results[i]['seconds'] += seconds
+                    next_future = executor.submit(
+                        pooled_load_job,
+                        job,
+                        symbols,
+                        dry_run,
+                        interval,
+                        frame,
+                    )
+                    stages[next_future] = ('load', i)
+                else:
+                    rows, seconds, error = future.result()
+                    results[i]['rows'] = rows
+                    results[i]['seconds'] += seconds
+                    results[i]['error'] = error
+
+    return results
+
+
+def update_features(results):
+    # Feature rows of the symbols whose daily prices were just loaded
+    symbols = sorted(
+        {
+            result['job'][1]
+            for result in results
+            if result['job'][0] == 'price' and result['error'] is None
+        }
+    )
+    if len(symbols) == 0:
+        return 0
+
+    return FeatureTableBuilder().update(symbols)
+
+
+def print_summary(results, wall_time, dry_run):
+    print()
+    print(f'{"dataset":<10}{"jobs":>7}{"failed":>8}{"rows":>11}'
+          f'{"job time (s)":>14}{"rows/s":>11}')
+
+    for dataset in DATASETS:
+        dataset_results = [r for r in results if r['job'][0] == dataset]
+        if len(dataset_results) == 0:
+            continue
+
+        rows = sum(r['rows'] for r in dataset_results)
+        seconds = sum(r['seconds'] for r in dataset_results)
+        failed = sum(r['error'] is not None for r in dataset_results)
+        print(f'{dataset:<10}{len(dataset_results):>7}{failed:>8}{rows:>11}'
+              f'{seconds:>14.1f}{rows / max(seconds, 1e-9):>11,.0f}')
+
+    rows = sum(r['rows'] for r in results)
+    print(f'\n{"dry run, nothing loaded. " if dry_run else ""}'
+          f'{rows} rows in {wall_time:.1f}s '
+          f'({rows / max(wall_time, 1e-9):,.0f} rows/s wall clock)')
+
+    for result in results:
+        if result['error'] is not None:
+            print(f'Failed {result["job"]}: {result["error"]}')
+
+
+def parse_args():
+    today = dt.date.today()
+
+    parser = argparse.ArgumentParser(
+        description='Ingest stock data for a symbol universe and date range',
+    )
+    universe = parser.add_mutually_exclusive_group()
+    universe.add_argument('--symbols', nargs='+')
+    universe.add_argument(
+        '--symbols-file',
+        help='file with one symbol per line',
+    )
+    universe.add_argument(
+        '--symbols-from-db',
+        action='store_true',
+        help='use every symbol of the stock_info table',
+    )
+    parser.add_argument(
+        '--from-date',
+        default=(today - dt.timedelta(days=1)).strftime('%Y-%m-%d'),
+    )
+    parser.add_argument(
+        '--to-date',
+        default=today.strftime('%Y-%m-%d'),
+        help='exclusive end of the date range',
+    )
+    parser.add_argument(
+        '--window-days',
+        type=int,
+        default=1,
+        help='days requested from the apis per job',
+    )
+    parser.add_argument(
+        '--datasets',
+        nargs='+',
+        choices=list(DATASETS),
+        default=list(DATASETS),
+    )
+    parser.add_argument(
+        '--interval',
+        choices=StockPriceIngest.intervals,
+        default='1d',
+        help='bar size of the price dataset, intraday bars load to '
+             'stock_price_bars',
+    )
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument(
+        '--transform-workers',
+        type=int,
+        default=0,
+        help='transform price, sentiment and article jobs on a process '
+             'pool of this size between extract and load, for backfills',
+    )
+    parser.add_argument(
+        '--executor',
+        choices=['thread', 'process'],
+        default='thread',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='extract and transform without loading',
+    )
+    parser.add_argument(
+        '--profile',
+        help='ingest class and stage to profile, '
+             'e.g. StockArticleIngest.transform_data',
+    )
+    parser.add_argument(
+        '--profiler',
+        choices=stage_profiler.PROFILERS,
+    )
+    parser.add_argument('--profile-dir')
+    parser.add_argument(
+        '--loader',
+        choices=staging_loader.LOADERS,
+        help='insert rows directly (default), or merge through an unlogged '
+        'staging table and report inserted/updated/skipped rows',
+    )
+
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    StockInfoIngestion().main()
-
-    from_time = '2022-03-31'
-    to_time = '2022-04-01'
-
-    for symbol in [
-        'META',
-        'AMZN',
-        'AAPL',
-        'NFLX',
-        'GOOGL',
-        'TSLA',
-        'MSFT',
-    ]:
-        StockArticleIngest(
-            symbol,
-            from_time,
-            from_time,
-        ).main()
-        to_time = '2022-04-01'
-        StockPriceIngest(
-            symbol,
-            from_time,
-            to_time,
-        ).main()
-        StockRedditIngest(
-            symbol,
-            from_time,
-            to_time,
-        ).main()
-        StockTwitterIngest(
-            symbol,
-            from_time,
-            to_time,
-        ).main()
-
-        print(f'Done ingest data for {symbol}')
+    args = parse_args()
+
+    stage_profiler.configure(args.profile, args.profiler, args.profile_dir)
+    staging_loader.configure(args.loader)
+
+    if args.symbols:
+        symbols = args.symbols
+    elif args.symbols_file:
+        symbols = symbols_from_file(args.symbols_file)
+    elif args.symbols_from_db:
+        symbols = symbols_from_db()
+    else:
+        symbols = StockInfoIngestion().stock_symbols
+
+    jobs = plan_jobs(
+        args.datasets,
+        symbols,
+        args.from_date,
+        args.to_date,
+        args.window_days,
+    )
+    print(f'Ingesting {len(jobs)} jobs for {len(symbols)} symbols '
+          f'with {args.workers} {args.executor} workers')
+
+    if args.executor == 'process':
+        # Spawn rather than fork a parent that already runs polars threads
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=mp.get_context('spawn'),
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    start = time.perf_counter()
+    results = list()
+    with executor:
+        if args.transform_workers:
+            results = run_backfill(
+                executor,
+                jobs,
+                symbols,
+                args.dry_run,
+                args.interval,
+                args.transform_workers,
+            )
+        else:
+            futures = [
+                executor.submit(
+                    run_job, job, symbols, args.dry_run, args.interval
+                )
+                for job in jobs
+            ]
+            results = [future.result() for future in futures]
+    for result in results:
+        if result['error'] is None:
+            print(f'Done {result["job"][0]} {result["job"][1] or ""} '
+                  f'{result["job"][2] or ""}: {result["rows"]} rows')
+
+    # Features are built from the price analytics the loads extended
+    if not args.dry_run and args.interval == '1d':
+        rows = update_features(results)
+        print(f'Wrote {rows} rows to {FeatureTableBuilder.table_id}')
+
+    print_summary(results, time.perf_counter() - start, args.dry_run)
+
+    if any(result['error'] is not None for result in results):
+        raise SystemExit(1)
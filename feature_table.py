@@ -0,0 +1,264 @@
+"""
+features: price analytics joined as-of with sentiment rollups and article
+counts
+"""
+
+import argparse
+import datetime as dt
+import json
+
+import polars as pl
+import psycopg2
+from psycopg2 import extras, sql
+
+from fast_read import FastReader, date_literal, literal, where_clause
+
+
+class FeatureTableBuilder:
+
+    table_id = 'stock_features'
+
+    lags = (1, 2, 3)
+    lagged_columns = (
+        'log_return',
+        'reddit_weighted_score',
+        'twitter_weighted_score',
+        'article_count',
+    )
+
+    # Sentiment older than this is not carried forward to a trading day
+    sentiment_tolerance = '7d'
+
+    def __init__(self, reader=None):
+        self.reader = reader or FastReader()
+
+        self.columns = [
+            'id',
+            'symbol',
+            'date',
+            'price',
+            'daily_return',
+            'log_return',
+            'volatility_20',
+            'drawdown',
+            'reddit_mention',
+            'reddit_mean_score',
+            'reddit_weighted_score',
+            'twitter_mention',
+            'twitter_mean_score',
+            'twitter_weighted_score',
+            'article_count',
+            'article_count_5d',
+        ] + [
+            f'{column}_lag_{lag}'
+            for column in self.lagged_columns
+            for lag in self.lags
+        ] + [
+            'target_return_1d',
+        ]
+
+    def get_connection(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        return psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+    def last_dates(self, cur, symbols):
+        # Per symbol the last stored day, rebuilt as well since its next-day
+        # target was unknown until now. NULL for symbols without features.
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT a.symbol, MAX(f.date)
+                FROM (
+                    SELECT DISTINCT symbol FROM stock_price_analytics
+                    WHERE symbol = ANY(%s) OR %s
+                ) AS a
+                LEFT JOIN {} AS f USING (symbol)
+                GROUP BY a.symbol;
+                """
+            ).format(sql.Identifier(self.table_id)),
+            (symbols or list(), symbols is None),
+        )
+
+        return pl.DataFrame(
+            cur.fetchall(),
+            schema=[('symbol', pl.Utf8), ('last_date', pl.Date)],
+            orient='row',
+        )
+
+    def read_inputs(self, symbols, from_date):
+        price = self.reader.read_table(
+            'stock_price_analytics',
+            columns=[
+                'symbol',
+                'date',
+                'price',
+                'daily_return',
+                'log_return',
+                'volatility_20',
+                'drawdown',
+            ],
+            symbols=symbols,
+            from_date=from_date,
+        )
+
+        sentiment_from = None
+        if from_date is not None:
+            sentiment_from = from_date - dt.timedelta(days=7)
+        sentiment = self.reader.query(
+            'SELECT symbol, platform, date, total_mention, mean_score, '
+            'weighted_score FROM stock_sentiment_daily'
+            + self.where(symbols, sentiment_from)
+        )
+
+        articles = self.reader.query(
+            'SELECT symbol, date, COUNT(*)::BIGINT AS article_count '
+            'FROM stock_articles'
+            + self.where(symbols, from_date)
+            + ' GROUP BY symbol, date'
+        )
+
+        return price, sentiment, articles
+
+    @staticmethod
+    def where(symbols, from_date):
+        predicates = list()
+        if symbols is not None:
+            predicates.append(
+                f'symbol IN ({", ".join(map(literal, symbols))})'
+            )
+        if from_date is not None:
+            predicates.append(f'date >= {date_literal(from_date)}')
+
+        return where_clause(predicates)
+
+    def build(self, price, sentiment, articles):
+        df = price.with_columns(pl.col('date').cast(pl.Date)).sort('date')
+
+        for platform in ('reddit', 'twitter'):
+            platform_sentiment = sentiment.filter(
+                pl.col('platform') == platform
+            ).select(
+                [
+                    'symbol',
+                    pl.col('date').cast(pl.Date),
+                    pl.col('total_mention').alias(f'{platform}_mention'),
+                    pl.col('mean_score').alias(f'{platform}_mean_score'),
+                    pl.col('weighted_score').alias(
+                        f'{platform}_weighted_score'
+                    ),
+                ]
+            ).sort('date')
+
+            # Latest sentiment day at or before each trading day
+            df = df.join_asof(
+                platform_sentiment,
+                on='date',
+                by='symbol',
+                strategy='backward',
+                tolerance=self.sentiment_tolerance,
+            )
+
+        df = df.join(
+            articles.with_columns(pl.col('date').cast(pl.Date)),
+            on=['symbol', 'date'],
+            how='left',
+        ).with_columns(
+            pl.col('article_count').fill_null(0)
+        ).sort(['symbol', 'date'])
+
+        df = df.with_columns(
+            [
+                pl.col('article_count').rolling_sum(
+                    5, min_periods=1
+                ).over('symbol').alias('article_count_5d'),
+                pl.col('daily_return').shift(-1).over('symbol').alias(
+                    'target_return_1d'
+                ),
+                (
+                    pl.col('symbol') + '_' + pl.col('date').cast(pl.Utf8)
+                ).alias('id'),
+            ]
+            + [
+                pl.col(column).shift(lag).over('symbol').alias(
+                    f'{column}_lag_{lag}'
+                )
+                for column in self.lagged_columns
+                for lag in self.lags
+            ]
+        )
+
+        return df.select(self.columns)
+
+    def update(self, symbols=None, rebuild=False):
+        conn = self.get_connection()
+        cur = conn.cursor()
+
+        last_dates = self.last_dates(cur, symbols)
+        if rebuild:
+            last_dates = last_dates.with_columns(
+                pl.lit(None, pl.Date).alias('last_date')
+            )
+
+        # Enough history before the first rebuilt day for the lags and the
+        # 5 day article window
+        read_from = None
+        if last_dates['last_date'].null_count() == 0 and last_dates.height:
+            read_from = last_dates['last_date'].min() - dt.timedelta(
+                days=2 * max(self.lags) + 14
+            )
+
+        df = self.build(*self.read_inputs(symbols, read_from))
+        df = df.join(last_dates, on='symbol', how='left').filter(
+            pl.col('last_date').is_null()
+            | (pl.col('date') >= pl.col('last_date'))
+        ).select(self.columns)
+
+        updates = sql.SQL(', ').join(
+            sql.SQL('{} = EXCLUDED.{}').format(
+                sql.Identifier(column), sql.Identifier(column)
+            )
+            for column in self.columns[1:]
+        )
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                'INSERT INTO {} ({}) VALUES %s '
+                'ON CONFLICT (id) DO UPDATE SET {};'
+            ).format(
+                sql.Identifier(self.table_id),
+                sql.SQL(', ').join(map(sql.Identifier, self.columns)),
+                updates,
+            ),
+            df.rows(),
+            page_size=1000,
+        )
+
+        cur.close()
+        conn.commit()
+
+        return df.height
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update the price and sentiment feature table',
+    )
+    parser.add_argument('--symbols', nargs='+')
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='rebuild every date instead of only the new ones',
+    )
+    args = parser.parse_args()
+
+    rows = FeatureTableBuilder().update(args.symbols, args.rebuild)
+    print(f'Wrote {rows} rows to {FeatureTableBuilder.table_id}')
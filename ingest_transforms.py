@@ -0,0 +1,347 @@
+"""
+transforms: raw api payloads to table rows, one pure function per dataset
+"""
+
+import datetime as dt
+
+import polars as pl
+
+
+def transform_info(raw_data):
+    df = pl.DataFrame(raw_data)
+
+    # Rename and reorder columns of dataframe
+    df = df.rename(
+        {
+            'ticker': 'symbol',
+            'estimateCurrency': 'estimate_currency',
+            'finnhubIndustry': 'industry',
+            'ipo': 'ipo_date',
+            'marketCapitalization': 'market_capitalization',
+            'shareOutstanding': 'share_outstanding',
+            'weburl': 'web_url',
+        }
+    ).select(
+        [
+            'symbol',
+            'country',
+            'currency',
+            'estimate_currency',
+            'exchange',
+            'industry',
+            'ipo_date',
+            'logo',
+            'market_capitalization',
+            'name',
+            'phone',
+            'share_outstanding',
+            'web_url',
+        ]
+    )
+
+    # Convert data type of column to datetime format
+    df = df.with_columns(
+        df['ipo_date'].apply(
+            lambda x: dt.datetime.strptime(x, '%Y-%m-%d')
+        )
+    )
+
+    return df
+
+
+def transform_price(raw_data, symbol, interval='1d'):
+    if interval != '1d':
+        return transform_bars(raw_data, symbol, interval)
+
+    # Extract value of each columns from raw data
+    datetime_col = list(raw_data['price'].keys())
+    price_col = list(raw_data['price'].values())
+    volume_col = list(raw_data['volume'].values())
+    open_col = list(raw_data['open'].values())
+    high_col = list(raw_data['high'].values())
+    low_col = list(raw_data['low'].values())
+    close_col = list(raw_data['close'].values())
+
+    if len(price_col) == 0:
+        return False
+
+    df = pl.DataFrame(
+        [
+            datetime_col,
+            open_col,
+            high_col,
+            low_col,
+            close_col,
+            price_col,
+            volume_col,
+        ]
+    )
+
+    # Rename columns
+    df.columns = [
+        'date',
+        'open',
+        'high',
+        'low',
+        'close',
+        'price',
+        'volume',
+    ]
+
+    # Create new columns
+    df = df.with_columns(
+        pl.lit(symbol).alias('symbol')
+    )
+    df = df.with_columns(
+        (
+            df['symbol'] + '_' + df['date']
+        ).alias('id')
+    )
+
+    # Reorder columns and sort by id
+    df = df.select(
+        [
+            'id',
+            'symbol',
+            'date',
+            'open',
+            'high',
+            'low',
+            'close',
+            'price',
+            'volume',
+        ]
+    ).sort('id')
+
+    return df
+
+
+def transform_bars(raw_data, symbol, interval):
+    if len(raw_data['ts']) == 0:
+        return False
+
+    df = pl.DataFrame(raw_data)
+
+    # Create new columns
+    df = df.with_columns(
+        [
+            pl.lit(symbol).alias('symbol'),
+            pl.lit(interval).alias('interval'),
+            pl.col('ts').str.strptime(pl.Datetime, '%Y-%m-%d %H:%M:%S'),
+            pl.col('volume').cast(pl.Int64),
+        ]
+    )
+
+    # Reorder columns like the table and sort by ts
+    df = df.select(
+        [
+            'symbol',
+            'interval',
+            'ts',
+            'open',
+            'high',
+            'low',
+            'close',
+            'volume',
+        ]
+    ).sort('ts')
+
+    return df
+
+
+def transform_reddit(raw_data, symbol):
+    if len(raw_data) == 0:
+        return False
+
+    df = pl.DataFrame(raw_data)
+
+    # Rename columns
+    df = df.rename(
+        {
+            'positiveScore': 'positive_score',
+            'negativeScore': 'negative_score',
+            'positiveMention': 'positive_mention',
+            'negativeMention': 'negative_mention',
+            'score': 'sentiment_score',
+            'atTime': 'date',
+
+        }
+    )
+
+    # Create new columns
+    df = df.with_columns(
+        pl.lit(symbol).alias('symbol')
+    )
+    df = df.with_columns(
+        df['date'].apply(
+            lambda x: x.split(' ')[1]
+        ).alias('time')
+    )
+    df = df.with_columns(
+        (
+            'reddit' + '_'
+            + df['symbol'] + '_'
+            + df['date'].apply(lambda x: x.split(' ')[0])
+            + '_' + df['time']
+        ).alias('id')
+    )
+    df = df.with_columns(
+        df['date'].apply(
+            lambda x: dt.datetime.strptime(
+                x.split(' ')[0],
+                '%Y-%m-%d',
+            )
+        )
+    )
+
+    # Reorder columns and sort by id
+    df = df.select(
+        [
+            'id',
+            'symbol',
+            'date',
+            'time',
+            'mention',
+            'positive_score',
+            'negative_score',
+            'positive_mention',
+            'negative_mention',
+            'sentiment_score',
+        ]
+    ).sort('id')
+
+    return df
+
+
+def transform_twitter(raw_data, symbol):
+    if len(raw_data) == 0:
+        return False
+
+    df = pl.DataFrame(raw_data)
+
+    # Rename columns
+    df = df.rename(
+        {
+            'positiveScore': 'positive_score',
+            'negativeScore': 'negative_score',
+            'positiveMention': 'positive_mention',
+            'negativeMention': 'negative_mention',
+            'score': 'sentiment_score',
+            'atTime': 'date',
+
+        }
+    )
+
+    # Create new columns
+    df = df.with_columns(
+        pl.lit(symbol).alias('symbol')
+    )
+    df = df.with_columns(
+        df['date'].apply(
+            lambda x: x.split(' ')[1]
+        ).alias('time')
+    )
+    df = df.with_columns(
+        (
+            'twitter' + '_'
+            + df['symbol'] + '_'
+            + df['date'].apply(lambda x: x.split(' ')[0])
+            + '_' + df['time']
+        ).alias('id')
+    )
+    df = df.with_columns(
+        df['date'].apply(
+            lambda x: dt.datetime.strptime(
+                x.split(' ')[0],
+                '%Y-%m-%d',
+            )
+        )
+    )
+
+    # Reorder columns and sort by id
+    df = df.select(
+        [
+            'id',
+            'symbol',
+            'date',
+            'time',
+            'mention',
+            'positive_score',
+            'negative_score',
+            'positive_mention',
+            'negative_mention',
+            'sentiment_score'
+        ]
+    ).sort('id')
+
+    return df
+
+
+def transform_articles(raw_data, symbol):
+    if len(raw_data) == 0:
+        return False
+
+    df = pl.DataFrame(raw_data)
+
+    # Rename columns
+    df = df.rename(
+        {
+            'related': 'symbol',
+            'image': 'image_url',
+            'url': 'article_url',
+            'datetime': 'date'
+        }
+    )
+
+    # Create new columns
+    df = df.with_columns(
+        df['date'].apply(
+            lambda x: dt.datetime.utcfromtimestamp(
+                int(x)
+            ).strftime('%H:%M:%S')
+        ).alias('time')
+    )
+    df = df.with_columns(
+        df['date'].apply(
+            lambda x: dt.datetime.utcfromtimestamp(
+                int(x)
+            ).replace(hour=0, minute=0, second=0)
+        )
+    )
+    df = df.with_columns(
+        df['id'].apply(
+            lambda x: symbol + '_' + str(x)
+        )
+    )
+
+    # Reorder columns and sort by id
+    df = df.select(
+        [
+            'id',
+            'symbol',
+            'date',
+            'time',
+            'category',
+            'headline',
+            'image_url',
+            'source',
+            'summary',
+            'article_url'
+        ]
+    ).sort('id')
+
+    return df
+
+
+def transform(class_name, raw_data, symbol=None, interval='1d'):
+    # The transform of an ingest class by name, e.g. in a pool worker
+    if class_name == 'StockInfoIngestion':
+        return transform_info(raw_data)
+    if class_name == 'StockPriceIngest':
+        return transform_price(raw_data, symbol, interval)
+
+    return {
+        'StockRedditIngest': transform_reddit,
+        'StockTwitterIngest': transform_twitter,
+        'StockArticleIngest': transform_articles,
+    }[class_name](raw_data, symbol)
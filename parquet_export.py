@@ -0,0 +1,289 @@
+"""
+data lake: <lake_dir>/<table>/symbol=<symbol>/year=<year>/month=<month>/
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+
+import polars as pl
+import psycopg2
+from psycopg2 import sql
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+LAKE_DIR = os.path.join('exported_data', 'lake')
+
+
+class ParquetExporter:
+
+    # Date column of each table, stock_info is only partitioned by symbol
+    tables = {
+        'stock_info': None,
+        'stock_price': 'date',
+        'stock_reddit_sentiment': 'date',
+        'stock_twitter_sentiment': 'date',
+        'stock_articles': 'date',
+    }
+
+    def __init__(self, lake_dir=LAKE_DIR, row_group_size=128 * 1024,
+                 compression_level=None):
+        self.lake_dir = lake_dir
+        self.row_group_size = row_group_size
+        self.compression_level = compression_level
+
+    def get_connection(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        return psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+    def manifest_path(self, table_id):
+        return os.path.join(self.lake_dir, table_id, '_manifest.json')
+
+    def load_manifest(self, table_id):
+        if not os.path.exists(self.manifest_path(table_id)):
+            return dict()
+
+        with open(self.manifest_path(table_id), 'r') as manifest:
+            return json.load(manifest)
+
+    def save_manifest(self, table_id, manifest):
+        path = self.manifest_path(table_id)
+        with open(path + '.tmp', 'w') as tmp:
+            json.dump(manifest, tmp, indent=4, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def partition_fingerprints(self, cur, table_id, relation_id=None):
+        # Row count and an order independent sum of row hashes, rows
+        # updated in place change the partition too
+        date_column = self.tables[table_id]
+        fingerprint = sql.SQL(
+            'COUNT(*), SUM(HASHTEXTEXTENDED(t::TEXT, 0)::NUMERIC)::TEXT'
+        )
+
+        if date_column is None:
+            query = sql.SQL(
+                'SELECT symbol, NULL, NULL, {fingerprint} '
+                'FROM {table} t GROUP BY 1;'
+            ).format(
+                fingerprint=fingerprint,
+                table=sql.Identifier(relation_id or table_id),
+            )
+        else:
+            query = sql.SQL(
+                'SELECT symbol, '
+                'EXTRACT(YEAR FROM {date})::INT, '
+                'EXTRACT(MONTH FROM {date})::INT, '
+                '{fingerprint} FROM {table} t GROUP BY 1, 2, 3;'
+            ).format(
+                date=sql.Identifier(date_column),
+                fingerprint=fingerprint,
+                table=sql.Identifier(relation_id or table_id),
+            )
+        cur.execute(query)
+
+        return {
+            partition_key(symbol, year, month): {
+                'rows': count,
+                'fingerprint': fingerprint,
+            }
+            for symbol, year, month, count, fingerprint in cur.fetchall()
+        }
+
+    def partition_query(self, table_id, key):
+        date_column = self.tables[table_id]
+        parts = dict(part.split('=', 1) for part in key.split('/'))
+
+        if date_column is None:
+            return sql.SQL('SELECT * FROM {} WHERE symbol = %s;').format(
+                sql.Identifier(table_id)
+            ), (parts['symbol'],)
+
+        start = dt.date(int(parts['year']), int(parts['month']), 1)
+        end = (start + dt.timedelta(days=32)).replace(day=1)
+
+        return sql.SQL(
+            'SELECT * FROM {table} WHERE symbol = %s '
+            'AND {date} >= %s AND {date} < %s ORDER BY {date};'
+        ).format(
+            table=sql.Identifier(table_id),
+            date=sql.Identifier(date_column),
+        ), (parts['symbol'], start, end)
+
+    def write_partition(self, cur, table_id, key, part='part-0'):
+        query, params = self.partition_query(table_id, key)
+        cur.execute(query, params)
+
+        return self.write_rows(
+            table_id,
+            key,
+            [column.name for column in cur.description],
+            cur.fetchall(),
+            part,
+        )
+
+    def write_rows(self, table_id, key, columns, rows, part='part-0'):
+        if len(rows) == 0:
+            # Nothing to export, e.g. a partition emptied since it was
+            # fingerprinted
+            return 0
+
+        data = {
+            name: list(values) for name, values in zip(columns, zip(*rows))
+        }
+        # The symbol is stored in the partition path
+        data.pop('symbol')
+        table = pa.Table.from_pydict(data)
+
+        directory = os.path.join(self.lake_dir, table_id, key)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{part}.parquet')
+        # Dot-prefixed, readers of the lake skip it while it is written
+        tmp_path = os.path.join(directory, f'.{part}.parquet.tmp')
+
+        pq.write_table(
+            table,
+            tmp_path,
+            row_group_size=self.row_group_size,
+            compression='zstd',
+            compression_level=self.compression_level,
+            write_statistics=True,
+        )
+        os.replace(tmp_path, path)
+
+        return table.num_rows
+
+    def export_table(self, table_id, incremental=True):
+        os.makedirs(os.path.join(self.lake_dir, table_id), exist_ok=True)
+
+        conn = self.get_connection()
+        cur = conn.cursor()
+
+        fingerprints = self.partition_fingerprints(cur, table_id)
+        manifest = self.load_manifest(table_id) if incremental else dict()
+        archive = load_archive(self.lake_dir, table_id)
+
+        # Only partitions that are new or whose rows changed since the last
+        # export are written again
+        changed = sorted(
+            key for key, fingerprint in fingerprints.items()
+            if manifest.get(key) != fingerprint
+        )
+
+        exported_rows = 0
+        for key in changed:
+            # Rows loaded again into an archived month are all that
+            # postgres holds of it, the archived files are never replaced
+            part = 'part-0'
+            if partition_month(key) in archive:
+                part = 'part-reloaded'
+            exported_rows += self.write_partition(cur, table_id, key, part)
+            manifest[key] = fingerprints[key]
+            self.save_manifest(table_id, manifest)
+
+        cur.close()
+        conn.close()
+
+        print(f'Exported {len(changed)} of {len(fingerprints)} partitions '
+              f'({exported_rows} rows) of {table_id}')
+
+        return changed
+
+    def export(self, table_ids=None, incremental=True):
+        for table_id in table_ids or self.tables:
+            self.export_table(table_id, incremental)
+
+
+def partition_key(symbol, year=None, month=None):
+    if year is None:
+        return f'symbol={symbol}'
+
+    return f'symbol={symbol}/year={year}/month={month:02d}'
+
+
+def partition_month(key):
+    # 'YYYY-MM' of a partition key, None for symbol only keys
+    parts = dict(part.split('=', 1) for part in key.split('/'))
+    if 'year' not in parts:
+        return None
+
+    return f'{parts["year"]}-{parts["month"]}'
+
+
+def load_archive(lake_dir, table_id):
+    # Months archived by partition_retention.py
+    path = os.path.join(lake_dir, table_id, '_archived.json')
+    if not os.path.exists(path):
+        return dict()
+
+    with open(path, 'r') as archive:
+        return json.load(archive)
+
+
+def read_lake(table_id, symbols=None, from_date=None, to_date=None,
+              columns=None, lake_dir=LAKE_DIR):
+    # Archived months may have several part files holding the same rows,
+    # told apart by id
+    dated = ParquetExporter.tables.get(table_id) is not None
+    read_columns = columns
+    if dated and columns is not None and 'id' not in columns:
+        read_columns = ['id'] + list(columns)
+
+    filters = list()
+    if symbols is not None:
+        filters.append(('symbol', 'in', list(symbols)))
+    # Prune year partitions first, then rely on row-group statistics
+    if from_date is not None:
+        from_date = dt.date.fromisoformat(str(from_date))
+        filters += [('year', '>=', from_date.year), ('date', '>=', from_date)]
+    if to_date is not None:
+        to_date = dt.date.fromisoformat(str(to_date))
+        filters += [('year', '<=', to_date.year), ('date', '<=', to_date)]
+
+    table = pq.read_table(
+        os.path.join(lake_dir, table_id),
+        columns=read_columns,
+        filters=filters or None,
+        memory_map=True,
+        partitioning='hive',
+    )
+
+    df = pl.from_arrow(table)
+    if 'symbol' in df.columns:
+        df = df.with_columns(pl.col('symbol').cast(pl.Utf8))
+    if dated:
+        # Part files are read in name order, the latest export is kept
+        df = df.unique(subset='id', keep='last', maintain_order=True)
+
+    df = df.drop([c for c in ('year', 'month') if c in df.columns])
+
+    return df if columns is None else df.select(columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export tables to a partitioned Parquet data lake',
+    )
+    parser.add_argument(
+        '--tables',
+        nargs='+',
+        choices=list(ParquetExporter.tables),
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='rewrite every partition instead of only the changed ones',
+    )
+    parser.add_argument('--lake-dir', default=LAKE_DIR)
+    args = parser.parse_args()
+
+    ParquetExporter(args.lake_dir).export(args.tables, not args.full)
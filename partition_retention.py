@@ -0,0 +1,487 @@
+"""
+retention: months past the hot window archived to the parquet lake and
+removed from postgres, reads union the two tiers
+"""
+
+import argparse
+import datetime as dt
+import glob
+import json
+import os
+import re
+import uuid
+
+import polars as pl
+from psycopg2 import sql
+import pyarrow.parquet as pq
+
+from fast_read import FastReader, to_date_value
+from loaded_ids import LoadedIds
+from parquet_export import (
+    LAKE_DIR,
+    ParquetExporter,
+    load_archive,
+    partition_key,
+    read_lake,
+)
+from psql_table_create import TableCreation
+
+
+class PartitionRetention:
+
+    tables = TableCreation.partitioned_tables
+
+    def __init__(self, retention_days=90, lake_dir=LAKE_DIR, drop=False,
+                 batch_size=10000):
+        self.retention_days = retention_days
+        self.drop = drop
+        self.batch_size = batch_size
+        self.exporter = ParquetExporter(lake_dir)
+
+    def archive_path(self, table_id):
+        return os.path.join(
+            self.exporter.lake_dir, table_id, '_archived.json'
+        )
+
+    def load_archive(self, table_id):
+        return load_archive(self.exporter.lake_dir, table_id)
+
+    def save_archive(self, table_id, archive):
+        path = self.archive_path(table_id)
+        with open(path + '.tmp', 'w') as tmp:
+            json.dump(archive, tmp, indent=4, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def is_partitioned(self, cur, table_id):
+        cur.execute(
+            'SELECT relkind FROM pg_class WHERE oid = TO_REGCLASS(%s);',
+            (table_id,),
+        )
+        row = cur.fetchone()
+
+        return row is not None and row[0] == 'p'
+
+    def cutoff(self):
+        return dt.date.today() - dt.timedelta(days=self.retention_days)
+
+    def old_partitions(self, cur, table_id):
+        # Monthly partitions ending on or before the cutoff, old months of
+        # the default partition are archived by archive_default
+        cutoff = self.cutoff()
+        cur.execute(
+            """
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = TO_REGCLASS(%s)
+            ORDER BY c.relname;
+            """,
+            (table_id,),
+        )
+
+        partitions = list()
+        for (partition_id,) in cur.fetchall():
+            match = re.fullmatch(
+                re.escape(table_id) + r'_(\d{4})_(\d{2})', partition_id
+            )
+            if match is None:
+                continue
+            start = dt.date(int(match.group(1)), int(match.group(2)), 1)
+            end = (start + dt.timedelta(days=32)).replace(day=1)
+            if end <= cutoff:
+                partitions.append((partition_id, start))
+
+        return partitions
+
+    def old_default_months(self, cur, table_id):
+        # Months past the cutoff with rows in the default partition, e.g.
+        # rows loaded again after their month was archived
+        cutoff = self.cutoff()
+        cur.execute(
+            sql.SQL(
+                'SELECT DISTINCT DATE_TRUNC(\'month\', date)::DATE '
+                'FROM {} WHERE date < %s ORDER BY 1;'
+            ).format(sql.Identifier(f'{table_id}_default')),
+            (cutoff.replace(day=1),),
+        )
+
+        return [row[0] for row in cur.fetchall()]
+
+    def export_partition(self, conn, table_id, partition_id, month,
+                         part='part-0'):
+        # One ordered pass over the month, a lake file per symbol
+        cur = conn.cursor(name=f'partition_retention_{uuid.uuid4().hex}')
+        cur.itersize = self.batch_size
+        cur.execute(
+            sql.SQL(
+                'SELECT * FROM {} WHERE date >= %s AND date < %s '
+                'ORDER BY symbol, date;'
+            ).format(sql.Identifier(partition_id)),
+            LoadedIds.date_range(f'{month:%Y-%m}'),
+        )
+
+        columns = None
+        counts = dict()
+        symbol = None
+        rows = list()
+        while True:
+            batch = cur.fetchmany(self.batch_size)
+            if columns is None:
+                columns = [column.name for column in cur.description]
+                symbol_index = columns.index('symbol')
+            for row in batch:
+                if row[symbol_index] != symbol and len(rows):
+                    key = partition_key(symbol, month.year, month.month)
+                    counts[key] = self.exporter.write_rows(
+                        table_id, key, columns, rows, part
+                    )
+                    rows = list()
+                symbol = row[symbol_index]
+                rows.append(row)
+            if len(batch) == 0:
+                break
+        if len(rows):
+            key = partition_key(symbol, month.year, month.month)
+            counts[key] = self.exporter.write_rows(
+                table_id, key, columns, rows, part
+            )
+
+        cur.close()
+
+        return counts
+
+    def verify(self, cur, table_id, partition_id, month, counts,
+               part='part-0'):
+        cur.execute(
+            sql.SQL(
+                'SELECT symbol, COUNT(*) FROM {} '
+                'WHERE date >= %s AND date < %s GROUP BY symbol;'
+            ).format(sql.Identifier(partition_id)),
+            LoadedIds.date_range(f'{month:%Y-%m}'),
+        )
+        stored = {
+            partition_key(symbol, month.year, month.month): count
+            for symbol, count in cur.fetchall()
+        }
+
+        # Counts read back from the written files, not from the export
+        written = {
+            key: pq.read_metadata(
+                os.path.join(
+                    self.exporter.lake_dir, table_id, key, f'{part}.parquet'
+                )
+            ).num_rows
+            for key in counts
+        }
+        if stored != written:
+            raise ValueError(
+                f'{partition_id}: {sum(written.values())} rows written to '
+                f'the lake, {sum(stored.values())} stored'
+            )
+
+        return sum(stored.values())
+
+    def archive_partition(self, conn, table_id, partition_id, month):
+        cur = conn.cursor()
+
+        # No load writes to the month between the export and the detach
+        cur.execute(
+            sql.SQL('LOCK TABLE {} IN SHARE MODE;').format(
+                sql.Identifier(partition_id)
+            )
+        )
+        part = self.next_part(
+            table_id, month, self.symbols(cur, partition_id, month)
+        )
+        counts = self.export_partition(
+            conn, table_id, partition_id, month, part
+        )
+        rows = self.verify(cur, table_id, partition_id, month, counts, part)
+        fingerprints = self.exporter.partition_fingerprints(
+            cur, table_id, partition_id
+        )
+
+        cur.execute(
+            sql.SQL('ALTER TABLE {} DETACH PARTITION {};').format(
+                sql.Identifier(table_id),
+                sql.Identifier(partition_id),
+            )
+        )
+        if self.drop:
+            cur.execute(
+                sql.SQL('DROP TABLE {};').format(sql.Identifier(partition_id))
+            )
+        cur.close()
+        conn.commit()
+
+        # Exported partitions count as unchanged for incremental exports
+        manifest = self.exporter.load_manifest(table_id)
+        manifest.update(fingerprints)
+        self.exporter.save_manifest(table_id, manifest)
+        self.remove_reloaded(table_id, counts)
+
+        self.record_archive(
+            table_id, month, rows, 'dropped' if self.drop else 'detached'
+        )
+
+        return rows
+
+    def symbols(self, cur, relation_id, month):
+        cur.execute(
+            sql.SQL(
+                'SELECT DISTINCT symbol FROM {} '
+                'WHERE date >= %s AND date < %s;'
+            ).format(sql.Identifier(relation_id)),
+            LoadedIds.date_range(f'{month:%Y-%m}'),
+        )
+
+        return [row[0] for row in cur.fetchall()]
+
+    def next_part(self, table_id, month, symbols):
+        # Archived files are never replaced, rows of a month archived
+        # before go to a new part file
+        if f'{month:%Y-%m}' not in self.load_archive(table_id):
+            return 'part-0'
+
+        parts = 0
+        for symbol in symbols:
+            directory = os.path.join(
+                self.exporter.lake_dir,
+                table_id,
+                partition_key(symbol, month.year, month.month),
+            )
+            parts = max(
+                parts,
+                len(
+                    [
+                        path
+                        for path in glob.glob(
+                            os.path.join(directory, 'part-*.parquet')
+                        )
+                        if not path.endswith('part-reloaded.parquet')
+                    ]
+                ),
+            )
+
+        return f'part-{parts}'
+
+    def archive_default(self, conn, table_id, month):
+        default_id = f'{table_id}_default'
+        date_range = LoadedIds.date_range(f'{month:%Y-%m}')
+        cur = conn.cursor()
+
+        # No load writes to the default partition until the rows are deleted
+        cur.execute(
+            sql.SQL('LOCK TABLE {} IN SHARE MODE;').format(
+                sql.Identifier(default_id)
+            )
+        )
+        part = self.next_part(
+            table_id, month, self.symbols(cur, default_id, month)
+        )
+
+        counts = self.export_partition(
+            conn, table_id, default_id, month, part
+        )
+        rows = self.verify(cur, table_id, default_id, month, counts, part)
+        cur.execute(
+            sql.SQL('DELETE FROM {} WHERE date >= %s AND date < %s;').format(
+                sql.Identifier(default_id)
+            ),
+            date_range,
+        )
+        cur.close()
+        conn.commit()
+
+        # The rows are archived now, their exports from postgres are not
+        # needed anymore
+        manifest = self.exporter.load_manifest(table_id)
+        for key in counts:
+            manifest.pop(key, None)
+        self.exporter.save_manifest(table_id, manifest)
+        self.remove_reloaded(table_id, counts)
+
+        self.record_archive(table_id, month, rows, 'deleted')
+
+        return rows
+
+    def remove_reloaded(self, table_id, keys):
+        # Exports of rows loaded again into an archived month, archived now
+        for key in keys:
+            path = os.path.join(
+                self.exporter.lake_dir, table_id, key, 'part-reloaded.parquet'
+            )
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record_archive(self, table_id, month, rows, action):
+        # Rows archived later for a month add to its first archive
+        archive = self.load_archive(table_id)
+        previous = archive.get(f'{month:%Y-%m}', dict())
+        archive[f'{month:%Y-%m}'] = {
+            'rows': previous.get('rows', 0) + rows,
+            'archived_at': dt.datetime.now().isoformat(timespec='seconds'),
+            'action': previous.get('action', action),
+        }
+        self.save_archive(table_id, archive)
+
+        # Ids of the month are no longer in the table
+        LoadedIds(table_id).forget([f'{month:%Y-%m}'])
+
+    def run(self, table_ids=None, dry_run=False):
+        conn = self.exporter.get_connection()
+        cur = conn.cursor()
+
+        archived = dict()
+        for table_id in table_ids or self.tables:
+            if not self.is_partitioned(cur, table_id):
+                print(f'{table_id} is not partitioned, run '
+                      f'psql_table_create.py --partitioned first')
+                continue
+
+            # Partitions for the coming months are created ahead of loads,
+            # recent months loaded into the default partition get theirs
+            TableCreation().ensure_partitions(
+                cur, table_id, since=self.cutoff().replace(day=1)
+            )
+            conn.commit()
+
+            os.makedirs(
+                os.path.join(self.exporter.lake_dir, table_id), exist_ok=True
+            )
+            for partition_id, month in self.old_partitions(cur, table_id):
+                if dry_run:
+                    print(f'Would archive {partition_id}')
+                    continue
+
+                rows = self.archive_partition(
+                    conn, table_id, partition_id, month
+                )
+                archived[partition_id] = rows
+                print(f'Archived {partition_id} ({rows} rows)')
+
+            for month in self.old_default_months(cur, table_id):
+                name = f'{table_id}_default/{month:%Y-%m}'
+                if dry_run:
+                    print(f'Would archive {name}')
+                    continue
+
+                rows = self.archive_default(conn, table_id, month)
+                archived[name] = rows
+                print(f'Archived {name} ({rows} rows)')
+
+        cur.close()
+        conn.close()
+
+        return archived
+
+
+class TieredReader:
+
+    def __init__(self, reader=None, lake_dir=LAKE_DIR):
+        self.reader = reader or FastReader()
+        self.lake_dir = lake_dir
+
+    def archived_until(self, table_id):
+        # Last day of the latest archived month
+        archive = load_archive(self.lake_dir, table_id)
+        if len(archive) == 0:
+            return None
+
+        month = dt.date.fromisoformat(max(archive) + '-01')
+
+        return (month + dt.timedelta(days=32)).replace(day=1) - dt.timedelta(
+            days=1
+        )
+
+    def read_table(self, table_id, columns=None, symbols=None,
+                   from_date=None, to_date=None):
+        # Rows are told apart by id across the tiers
+        read_columns = columns
+        if columns is not None and 'id' not in columns:
+            read_columns = ['id'] + list(columns)
+
+        # Postgres holds every month not archived, and rows of archived
+        # months loaded again later, kept in the default partition
+        hot = self.reader.read_table(
+            table_id,
+            columns=read_columns,
+            symbols=symbols,
+            from_date=from_date,
+            to_date=to_date,
+        )
+
+        until = self.archived_until(table_id)
+        if until is None:
+            return hot.select(columns or hot.columns)
+        if from_date is not None and to_date_value(from_date) > until:
+            return hot.select(columns or hot.columns)
+        if to_date is not None:
+            until = min(until, to_date_value(to_date))
+
+        # The lake also holds exports of hot months, only archived ones
+        # are read from it
+        cold = read_lake(
+            table_id,
+            symbols=symbols,
+            from_date=from_date,
+            to_date=until,
+            columns=read_columns,
+            lake_dir=self.lake_dir,
+        )
+
+        return pl.concat(
+            [
+                cold.select(hot.columns).with_columns(
+                    [
+                        pl.col(column).cast(dtype)
+                        for column, dtype in hot.schema.items()
+                    ]
+                ),
+                hot,
+            ]
+        ).unique(
+            subset='id', keep='last', maintain_order=True
+        ).select(columns or hot.columns)
+
+    def read_sentiment(self, platform, **kwargs):
+        return self.read_table(f'stock_{platform}_sentiment', **kwargs)
+
+    def read_articles(self, with_contents=True, **kwargs):
+        articles = self.read_table('stock_articles', **kwargs)
+        if not with_contents:
+            return articles
+
+        # Bodies are shared across months and stay in postgres
+        return self.reader.join_contents(articles)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Archive partitions older than the retention window',
+    )
+    parser.add_argument(
+        '--tables',
+        nargs='+',
+        choices=list(PartitionRetention.tables),
+    )
+    parser.add_argument(
+        '--retention-days',
+        type=int,
+        default=90,
+        help='months ending more than this many days ago are archived',
+    )
+    parser.add_argument(
+        '--drop',
+        action='store_true',
+        help='drop archived partitions instead of only detaching them',
+    )
+    parser.add_argument('--lake-dir', default=LAKE_DIR)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    PartitionRetention(
+        args.retention_days,
+        args.lake_dir,
+        args.drop,
+    ).run(args.tables, args.dry_run)
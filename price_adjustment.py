@@ -0,0 +1,263 @@
+"""
+adjustments: rescale stored history when yahoo re-adjusts for splits/dividends
+"""
+
+import argparse
+import datetime as dt
+import json
+import logging
+
+import polars as pl
+import psycopg2
+from psycopg2 import sql
+
+from feature_table import FeatureTableBuilder
+from price_analytics import PriceAnalytics
+from stock_price_collect import StockPriceCollector
+
+logger = logging.getLogger('price_adjustment')
+
+
+class PriceAdjustment:
+
+    table_id = 'stock_price'
+    log_table_id = 'stock_price_adjustments'
+
+    # Stored and refetched column compared for each factor
+    factors = {
+        'price_factor': 'price',
+        'close_factor': 'close',
+        'volume_factor': 'volume',
+    }
+
+    # Placeholder the collector stores for missing values
+    missing = 999999
+
+    def __init__(self, overlap_days=10, tolerance=1e-3):
+        self.overlap_days = overlap_days
+        self.tolerance = tolerance
+
+    def get_connection(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        return psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+    def read_overlap(self, cur, symbol):
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT date::TEXT, price, close, volume
+                FROM {}
+                WHERE symbol = %s
+                ORDER BY date DESC
+                LIMIT %s;
+                """
+            ).format(sql.Identifier(self.table_id)),
+            (symbol, self.overlap_days),
+        )
+
+        return pl.DataFrame(
+            cur.fetchall(),
+            schema=[
+                ('date', pl.Utf8),
+                ('price', pl.Float64),
+                ('close', pl.Float64),
+                ('volume', pl.Float64),
+            ],
+            orient='row',
+        )
+
+    def fetch_overlap(self, symbol, stored):
+        first = dt.date.fromisoformat(stored['date'].min())
+        last = dt.date.fromisoformat(stored['date'].max())
+        ohlcv = StockPriceCollector(
+            symbol,
+            first.isoformat(),
+            (last + dt.timedelta(days=1)).isoformat(),
+        ).get_ohlcv()
+
+        return pl.DataFrame(
+            {
+                'date': list(ohlcv['price'].keys()),
+                'price': list(ohlcv['price'].values()),
+                'close': list(ohlcv['close'].values()),
+                'volume': list(ohlcv['volume'].values()),
+            }
+        ).with_columns(
+            pl.col(['price', 'close', 'volume']).cast(pl.Float64)
+        )
+
+    def detect(self, stored, fresh):
+        # Ratio of the refetched to the stored value, per day and column.
+        # Missing values, and close on rows stored before it was captured,
+        # leave a null ratio.
+        df = stored.join(fresh, on='date', suffix='_fresh').sort(
+            'date'
+        ).with_columns(
+            [
+                pl.when(
+                    (pl.col(column) != self.missing)
+                    & (pl.col(f'{column}_fresh') != self.missing)
+                ).then(
+                    pl.col(f'{column}_fresh') / pl.col(column)
+                ).alias(factor)
+                for factor, column in self.factors.items()
+            ]
+        ).filter(
+            pl.col('price_factor').is_not_null()
+        )
+        if df.height == 0:
+            return None
+
+        changed = df.filter(
+            pl.any(
+                [
+                    ((pl.col(factor) - 1).abs() > self.tolerance).fill_null(
+                        False
+                    )
+                    for factor in self.factors
+                ]
+            )
+        )
+        if changed.height == 0:
+            return None
+
+        # The event falls after the last re-adjusted day, every stored day
+        # up to that one was scaled by the same factors
+        boundary = changed['date'].max()
+        adjusted = df.filter(pl.col('date') <= boundary)
+
+        factors = dict()
+        for factor in self.factors:
+            ratios = adjusted[factor].drop_nulls()
+            if len(ratios) == 0:
+                factors[factor] = 1.0
+                continue
+
+            factors[factor] = ratios.median()
+            if (ratios / factors[factor] - 1).abs().max() > self.tolerance:
+                raise ValueError(
+                    f'Inconsistent {factor} in the overlap window, '
+                    f'refetch the history instead'
+                )
+
+        return boundary, factors
+
+    def apply(self, cur, symbol, boundary, factors):
+        # One set-based rescale of every stored day up to the boundary
+        cur.execute(
+            sql.SQL(
+                """
+                UPDATE {} SET
+                    price = price * %(price_factor)s,
+                    open = open * %(close_factor)s,
+                    high = high * %(close_factor)s,
+                    low = low * %(close_factor)s,
+                    close = close * %(close_factor)s,
+                    volume = ROUND(volume * %(volume_factor)s)
+                WHERE symbol = %(symbol)s
+                    AND date <= %(boundary)s::DATE
+                    AND price <> %(missing)s;
+                """
+            ).format(sql.Identifier(self.table_id)),
+            {
+                'symbol': symbol,
+                'boundary': boundary,
+                'missing': self.missing,
+                **factors,
+            },
+        )
+        rows = cur.rowcount
+
+        cur.execute(
+            sql.SQL(
+                """
+                INSERT INTO {} (
+                    symbol, detected_at, boundary_date, rows_adjusted,
+                    price_factor, close_factor, volume_factor
+                )
+                VALUES (
+                    %(symbol)s, NOW(), %(boundary)s, %(rows)s,
+                    %(price_factor)s, %(close_factor)s, %(volume_factor)s
+                );
+                """
+            ).format(sql.Identifier(self.log_table_id)),
+            {
+                'symbol': symbol,
+                'boundary': boundary,
+                'rows': rows,
+                **factors,
+            },
+        )
+
+        return rows
+
+    def adjust_symbol(self, cur, symbol, dry_run=False):
+        stored = self.read_overlap(cur, symbol)
+        if stored.height == 0:
+            return False
+
+        detected = self.detect(stored, self.fetch_overlap(symbol, stored))
+        if detected is None:
+            return False
+
+        boundary, factors = detected
+        print(f'{symbol}: rescaling up to {boundary} by {factors}')
+        if dry_run:
+            return False
+
+        self.apply(cur, symbol, boundary, factors)
+        PriceAnalytics().update(cur, [symbol], rebuild=True)
+
+        return True
+
+    def adjust(self, symbols, dry_run=False):
+        conn = self.get_connection()
+
+        adjusted = list()
+        try:
+            cur = conn.cursor()
+            for symbol in symbols:
+                # One symbol that can not be adjusted leaves the others
+                # to go on
+                try:
+                    if self.adjust_symbol(cur, symbol, dry_run):
+                        conn.commit()
+                        adjusted.append(symbol)
+                except (ValueError, psycopg2.Error):
+                    logger.exception(f'{symbol}: not adjusted')
+                    conn.rollback()
+            cur.close()
+        finally:
+            conn.close()
+
+        # Features read the committed analytics
+        if len(adjusted):
+            FeatureTableBuilder().update(adjusted, rebuild=True)
+
+        return adjusted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rescale stored prices after a split or dividend',
+    )
+    parser.add_argument('--symbols', nargs='+', required=True)
+    parser.add_argument(
+        '--overlap-days',
+        type=int,
+        default=10,
+        help='latest stored days refetched to detect a new adjustment',
+    )
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    PriceAdjustment(args.overlap_days).adjust(args.symbols, args.dry_run)
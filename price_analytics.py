@@ -0,0 +1,247 @@
+"""
+analytics: rolling price metrics per symbol, recomputed over a trailing window
+"""
+
+import argparse
+import json
+import math
+
+import polars as pl
+import psycopg2
+from psycopg2 import extras, sql
+
+
+class PriceAnalytics:
+
+    table_id = 'stock_price_analytics'
+
+    columns = [
+        'id',
+        'symbol',
+        'date',
+        'price',
+        'volume',
+        'daily_return',
+        'log_return',
+        'ma_5',
+        'ma_20',
+        'ma_50',
+        'volatility_20',
+        'vwap_20',
+        'volume_ma_20',
+        'running_max',
+        'drawdown',
+    ]
+
+    def __init__(self, windows=(5, 20, 50), volatility_window=20,
+                 vwap_window=20):
+        self.windows = windows
+        self.volatility_window = volatility_window
+        self.vwap_window = vwap_window
+
+        # Calendar days that surely contain the longest window of trading
+        # days before the first new row
+        longest = max(max(windows), volatility_window, vwap_window)
+        self.lookback_days = math.ceil(longest * 7 / 5) + 10
+
+    def get_connection(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        return psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+    def read_prices(self, cur, symbols, rebuild):
+        # Symbols with a price row older than their last analytics row were
+        # backfilled and get recomputed from the start
+        cur.execute(
+            """
+            WITH last AS (
+                SELECT symbol, MAX(date) AS last_date, COUNT(*) AS n
+                FROM stock_price_analytics
+                WHERE symbol = ANY(%(symbols)s) OR %(all)s
+                GROUP BY symbol
+            ), price AS (
+                SELECT symbol, COUNT(*) AS n
+                FROM stock_price p
+                JOIN last l USING (symbol)
+                WHERE p.date <= l.last_date
+                GROUP BY symbol
+            ), start AS (
+                SELECT
+                    l.symbol,
+                    CASE WHEN p.n > l.n OR %(rebuild)s
+                        THEN NULL
+                        ELSE l.last_date
+                    END AS last_date
+                FROM last l
+                LEFT JOIN price p USING (symbol)
+            )
+            SELECT
+                p.symbol,
+                p.date,
+                p.price,
+                p.volume,
+                s.last_date,
+                CASE WHEN s.last_date IS NOT NULL THEN a.running_max END
+            FROM stock_price p
+            LEFT JOIN start s USING (symbol)
+            LEFT JOIN stock_price_analytics a USING (id)
+            WHERE (p.symbol = ANY(%(symbols)s) OR %(all)s)
+                AND (
+                    s.last_date IS NULL
+                    OR p.date > s.last_date - %(lookback)s
+                )
+            ORDER BY p.symbol, p.date;
+            """,
+            {
+                'symbols': symbols or list(),
+                'all': symbols is None,
+                'rebuild': rebuild,
+                'lookback': self.lookback_days,
+            },
+        )
+
+        return pl.DataFrame(
+            cur.fetchall(),
+            schema=[
+                ('symbol', pl.Utf8),
+                ('date', pl.Date),
+                ('price', pl.Float64),
+                ('volume', pl.Int64),
+                ('last_date', pl.Date),
+                ('stored_running_max', pl.Float64),
+            ],
+            orient='row',
+        )
+
+    def compute(self, df):
+        by_symbol = 'symbol'
+
+        df = df.sort([by_symbol, 'date']).with_columns(
+            [
+                (
+                    pl.col('price') / pl.col('price').shift(1) - 1
+                ).over(by_symbol).alias('daily_return'),
+                (
+                    pl.col('price').log() - pl.col('price').shift(1).log()
+                ).over(by_symbol).alias('log_return'),
+                (
+                    pl.col('price') * pl.col('volume')
+                ).alias('dollar_volume'),
+                # Running max of the rows before the window, if any
+                pl.col('stored_running_max').first().over(by_symbol).alias(
+                    'seed_running_max'
+                ),
+            ]
+            + [
+                pl.col('price').rolling_mean(window).over(by_symbol).alias(
+                    f'ma_{window}'
+                )
+                for window in self.windows
+            ]
+        )
+
+        df = df.with_columns(
+            [
+                (
+                    pl.col('log_return').rolling_std(self.volatility_window)
+                    * math.sqrt(252)
+                ).over(by_symbol).alias(
+                    f'volatility_{self.volatility_window}'
+                ),
+                (
+                    pl.col('dollar_volume').rolling_sum(self.vwap_window)
+                    / pl.col('volume').rolling_sum(self.vwap_window)
+                ).over(by_symbol).alias(f'vwap_{self.vwap_window}'),
+                pl.col('volume').cast(pl.Float64).rolling_mean(
+                    self.vwap_window
+                ).over(by_symbol).alias(f'volume_ma_{self.vwap_window}'),
+                pl.max(
+                    [
+                        pl.col('price').cummax().over(by_symbol),
+                        pl.col('seed_running_max').fill_null(
+                            pl.col('price')
+                        ),
+                    ]
+                ).alias('running_max'),
+            ]
+        )
+
+        df = df.with_columns(
+            [
+                (
+                    pl.col('price') / pl.col('running_max') - 1
+                ).alias('drawdown'),
+                (
+                    pl.col('symbol') + '_' + pl.col('date').cast(pl.Utf8)
+                ).alias('id'),
+            ]
+        )
+
+        # The lookback rows only seed the windows, they are already stored
+        return df.filter(
+            pl.col('last_date').is_null()
+            | (pl.col('date') > pl.col('last_date'))
+        ).select(self.columns)
+
+    def update(self, cur, symbols=None, rebuild=False):
+        df = self.read_prices(cur, symbols, rebuild)
+        if df.height == 0:
+            return 0
+
+        df = self.compute(df)
+
+        updates = sql.SQL(', ').join(
+            sql.SQL('{} = EXCLUDED.{}').format(
+                sql.Identifier(column), sql.Identifier(column)
+            )
+            for column in self.columns[1:]
+        )
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                'INSERT INTO {} ({}) VALUES %s '
+                'ON CONFLICT (id) DO UPDATE SET {};'
+            ).format(
+                sql.Identifier(self.table_id),
+                sql.SQL(', ').join(map(sql.Identifier, self.columns)),
+                updates,
+            ),
+            df.rows(),
+            page_size=1000,
+        )
+
+        return df.height
+
+    def main(self, symbols=None, rebuild=False):
+        conn = self.get_connection()
+        cur = conn.cursor()
+
+        rows = self.update(cur, symbols, rebuild)
+
+        cur.close()
+        conn.commit()
+
+        print(f'Wrote {rows} rows to {self.table_id}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update rolling price analytics from stock_price',
+    )
+    parser.add_argument('--symbols', nargs='+')
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='recompute the full history of the symbols',
+    )
+    args = parser.parse_args()
+
+    PriceAnalytics().main(args.symbols, args.rebuild)
@@ -1,10 +1,33 @@
+import argparse
+import datetime as dt
 import json
 import psycopg2
+from psycopg2 import sql
+
+from article_store import ArticleStore
 
 
 class TableCreation:
 
-    def __init__(self):
+    ingest_tables = (
+        'stock_info',
+        'stock_price',
+        'stock_reddit_sentiment',
+        'stock_twitter_sentiment',
+        'stock_articles',
+    )
+
+    # Kept in monthly range partitions by date when partitioned, old months
+    # are archived and removed whole
+    partitioned_tables = (
+        'stock_reddit_sentiment',
+        'stock_twitter_sentiment',
+        'stock_articles',
+    )
+
+    def __init__(self, partitioned=False):
+        self.partitioned = partitioned
+
         self.stock_info = """
         CREATE TABLE IF NOT EXISTS stock_info (
             symbol VARCHAR PRIMARY KEY,
@@ -23,6 +46,32 @@ class TableCreation:
         );
         """
 
+        # One row per version of a stock_info row, valid_to is NULL on the
+        # current one
+        self.stock_info_history = """
+        CREATE TABLE IF NOT EXISTS stock_info_history (
+            symbol VARCHAR NOT NULL,
+            country VARCHAR NOT NULL,
+            currency VARCHAR NOT NULL,
+            estimate_currency VARCHAR NOT NULL,
+            exchange VARCHAR NOT NULL,
+            industry VARCHAR NOT NULL,
+            ipo_date DATE NOT NULL,
+            logo TEXT NOT NULL,
+            market_capitalization FLOAT NOT NULL,
+            name VARCHAR NOT NULL,
+            phone FLOAT NOT NULL,
+            share_outstanding FLOAT NOT NULL,
+            web_url TEXT NOT NULL,
+            row_hash CHAR(64) NOT NULL,
+            valid_from TIMESTAMP NOT NULL,
+            valid_to TIMESTAMP,
+            PRIMARY KEY (symbol, valid_from)
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS stock_info_history_current_idx
+            ON stock_info_history (symbol) WHERE valid_to IS NULL;
+        """
+
         self.stock_price = """
         CREATE TABLE IF NOT EXISTS stock_price (
             id VARCHAR PRIMARY KEY,
@@ -33,6 +82,15 @@ class TableCreation:
         );
         """
 
+        # Full daily bars, NULL on rows loaded before they were captured
+        self.stock_price_ohlc = """
+        ALTER TABLE stock_price
+            ADD COLUMN IF NOT EXISTS open FLOAT,
+            ADD COLUMN IF NOT EXISTS high FLOAT,
+            ADD COLUMN IF NOT EXISTS low FLOAT,
+            ADD COLUMN IF NOT EXISTS close FLOAT;
+        """
+
         self.stock_reddit_sentiment = """
         CREATE TABLE IF NOT EXISTS stock_reddit_sentiment (
             id VARCHAR PRIMARY KEY,
@@ -69,6 +127,13 @@ class TableCreation:
             symbol VARCHAR NOT NULL,
             date DATE NOT NULL,
             time TIME NOT NULL,
+            content_hash CHAR(64) NOT NULL
+        );
+        """
+
+        self.article_contents = """
+        CREATE TABLE IF NOT EXISTS article_contents (
+            content_hash CHAR(64) PRIMARY KEY,
             category VARCHAR NOT NULL,
             headline VARCHAR NOT NULL,
             image_url TEXT NOT NULL,
@@ -78,6 +143,244 @@ class TableCreation:
         );
         """
 
+        # Weighted headline and summary lexemes for full-text search
+        self.article_contents_search = """
+        ALTER TABLE article_contents
+            ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+            GENERATED ALWAYS AS (
+                SETWEIGHT(TO_TSVECTOR('english', headline), 'A')
+                || SETWEIGHT(TO_TSVECTOR('english', summary), 'B')
+            ) STORED;
+        CREATE INDEX IF NOT EXISTS article_contents_search_idx
+            ON article_contents USING GIN (search_vector);
+        """
+
+        if partitioned:
+            # The partition key has to be part of the primary key
+            self.stock_reddit_sentiment = """
+            CREATE TABLE IF NOT EXISTS stock_reddit_sentiment (
+                id VARCHAR NOT NULL,
+                symbol VARCHAR NOT NULL,
+                date DATE NOT NULL,
+                time TIME NOT NULL,
+                mention INTEGER NOT NULL,
+                positive_score FLOAT NOT NULL,
+                negative_score FLOAT NOT NULL,
+                positive_mention INTEGER NOT NULL,
+                negative_mention INTEGER NOT NULL,
+                sentiment_score FLOAT NOT NULL,
+                PRIMARY KEY (id, date)
+            ) PARTITION BY RANGE (date);
+            """
+
+            self.stock_twitter_sentiment = """
+            CREATE TABLE IF NOT EXISTS stock_twitter_sentiment (
+                id VARCHAR NOT NULL,
+                symbol VARCHAR NOT NULL,
+                date DATE NOT NULL,
+                time TIME NOT NULL,
+                mention INTEGER NOT NULL,
+                positive_score FLOAT NOT NULL,
+                negative_score FLOAT NOT NULL,
+                positive_mention INTEGER NOT NULL,
+                negative_mention INTEGER NOT NULL,
+                sentiment_score FLOAT NOT NULL,
+                PRIMARY KEY (id, date)
+            ) PARTITION BY RANGE (date);
+            """
+
+            self.stock_articles = """
+            CREATE TABLE IF NOT EXISTS stock_articles (
+                id VARCHAR NOT NULL,
+                symbol VARCHAR NOT NULL,
+                date DATE NOT NULL,
+                time TIME NOT NULL,
+                content_hash CHAR(64) NOT NULL,
+                PRIMARY KEY (id, date)
+            ) PARTITION BY RANGE (date);
+            """
+
+        # Created after old tables are migrated to have the column
+        self.stock_articles_hash_index = """
+        CREATE INDEX IF NOT EXISTS stock_articles_hash_idx
+            ON stock_articles (content_hash);
+        """
+
+        self.stock_sentiment_daily = """
+        CREATE TABLE IF NOT EXISTS stock_sentiment_daily (
+            symbol VARCHAR NOT NULL,
+            platform VARCHAR NOT NULL,
+            date DATE NOT NULL,
+            hours INTEGER NOT NULL,
+            total_mention INTEGER NOT NULL,
+            positive_mention INTEGER NOT NULL,
+            negative_mention INTEGER NOT NULL,
+            mean_score FLOAT NOT NULL,
+            weighted_score FLOAT,
+            PRIMARY KEY (symbol, platform, date)
+        );
+        """
+
+        self.stock_sentiment_weekly = """
+        CREATE TABLE IF NOT EXISTS stock_sentiment_weekly (
+            symbol VARCHAR NOT NULL,
+            platform VARCHAR NOT NULL,
+            week DATE NOT NULL,
+            hours INTEGER NOT NULL,
+            total_mention INTEGER NOT NULL,
+            positive_mention INTEGER NOT NULL,
+            negative_mention INTEGER NOT NULL,
+            mean_score FLOAT NOT NULL,
+            weighted_score FLOAT,
+            PRIMARY KEY (symbol, platform, week)
+        );
+        """
+
+        self.stock_price_analytics = """
+        CREATE TABLE IF NOT EXISTS stock_price_analytics (
+            id VARCHAR PRIMARY KEY,
+            symbol VARCHAR NOT NULL,
+            date DATE NOT NULL,
+            price FLOAT NOT NULL,
+            volume BIGINT NOT NULL,
+            daily_return FLOAT,
+            log_return FLOAT,
+            ma_5 FLOAT,
+            ma_20 FLOAT,
+            ma_50 FLOAT,
+            volatility_20 FLOAT,
+            vwap_20 FLOAT,
+            volume_ma_20 FLOAT,
+            running_max FLOAT NOT NULL,
+            drawdown FLOAT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS stock_price_analytics_symbol_date_idx
+            ON stock_price_analytics (symbol, date);
+        """
+
+        self.stock_features = """
+        CREATE TABLE IF NOT EXISTS stock_features (
+            id VARCHAR PRIMARY KEY,
+            symbol VARCHAR NOT NULL,
+            date DATE NOT NULL,
+            price FLOAT NOT NULL,
+            daily_return FLOAT,
+            log_return FLOAT,
+            volatility_20 FLOAT,
+            drawdown FLOAT NOT NULL,
+            reddit_mention INTEGER,
+            reddit_mean_score FLOAT,
+            reddit_weighted_score FLOAT,
+            twitter_mention INTEGER,
+            twitter_mean_score FLOAT,
+            twitter_weighted_score FLOAT,
+            article_count INTEGER NOT NULL,
+            article_count_5d INTEGER NOT NULL,
+            log_return_lag_1 FLOAT,
+            log_return_lag_2 FLOAT,
+            log_return_lag_3 FLOAT,
+            reddit_weighted_score_lag_1 FLOAT,
+            reddit_weighted_score_lag_2 FLOAT,
+            reddit_weighted_score_lag_3 FLOAT,
+            twitter_weighted_score_lag_1 FLOAT,
+            twitter_weighted_score_lag_2 FLOAT,
+            twitter_weighted_score_lag_3 FLOAT,
+            article_count_lag_1 INTEGER,
+            article_count_lag_2 INTEGER,
+            article_count_lag_3 INTEGER,
+            target_return_1d FLOAT
+        );
+        CREATE INDEX IF NOT EXISTS stock_features_symbol_date_idx
+            ON stock_features (symbol, date);
+        """
+
+        self.stock_article_sentiment = """
+        CREATE TABLE IF NOT EXISTS stock_article_sentiment (
+            id VARCHAR PRIMARY KEY,
+            content_hash CHAR(64) NOT NULL,
+            headline_polarity FLOAT NOT NULL,
+            headline_subjectivity FLOAT NOT NULL,
+            summary_polarity FLOAT NOT NULL,
+            summary_subjectivity FLOAT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS stock_article_sentiment_hash_idx
+            ON stock_article_sentiment (content_hash);
+        """
+
+        self.stock_article_clusters = """
+        CREATE TABLE IF NOT EXISTS stock_article_clusters (
+            id VARCHAR PRIMARY KEY,
+            cluster_id VARCHAR NOT NULL,
+            signature BYTEA
+        );
+        CREATE INDEX IF NOT EXISTS stock_article_clusters_cluster_idx
+            ON stock_article_clusters (cluster_id);
+        """
+
+        self.stock_price_adjustments = """
+        CREATE TABLE IF NOT EXISTS stock_price_adjustments (
+            symbol VARCHAR NOT NULL,
+            detected_at TIMESTAMPTZ NOT NULL,
+            boundary_date DATE NOT NULL,
+            rows_adjusted INTEGER NOT NULL,
+            price_factor FLOAT NOT NULL,
+            close_factor FLOAT NOT NULL,
+            volume_factor FLOAT NOT NULL,
+            PRIMARY KEY (symbol, detected_at)
+        );
+        """
+
+        # Intraday bars, one partition per month of ts
+        self.stock_price_bars = """
+        CREATE TABLE IF NOT EXISTS stock_price_bars (
+            symbol VARCHAR NOT NULL,
+            interval VARCHAR NOT NULL,
+            ts TIMESTAMP NOT NULL,
+            open FLOAT NOT NULL,
+            high FLOAT NOT NULL,
+            low FLOAT NOT NULL,
+            close FLOAT NOT NULL,
+            volume BIGINT NOT NULL,
+            PRIMARY KEY (symbol, interval, ts)
+        ) PARTITION BY RANGE (ts);
+        """
+
+        self.stock_trades = """
+        CREATE TABLE IF NOT EXISTS stock_trades (
+            symbol VARCHAR NOT NULL,
+            ts TIMESTAMP NOT NULL,
+            price FLOAT NOT NULL,
+            volume FLOAT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS stock_trades_symbol_ts_idx
+            ON stock_trades (symbol, ts);
+        """
+
+        self.stock_trade_bars = """
+        CREATE TABLE IF NOT EXISTS stock_trade_bars (
+            symbol VARCHAR NOT NULL,
+            minute TIMESTAMP NOT NULL,
+            open FLOAT NOT NULL,
+            high FLOAT NOT NULL,
+            low FLOAT NOT NULL,
+            close FLOAT NOT NULL,
+            volume FLOAT NOT NULL,
+            trades INTEGER NOT NULL,
+            first_ts TIMESTAMP NOT NULL,
+            last_ts TIMESTAMP NOT NULL,
+            PRIMARY KEY (symbol, minute)
+        );
+        """
+
+        self.stock_article_lsh = """
+        CREATE TABLE IF NOT EXISTS stock_article_lsh (
+            band SMALLINT NOT NULL,
+            bucket BIGINT NOT NULL,
+            id VARCHAR NOT NULL,
+            PRIMARY KEY (band, bucket, id)
+        );
+        """
+
     def create_table(self):
         with open('postgresql.json', 'r') as psql:
             config = json.load(psql)
@@ -97,15 +400,253 @@ class TableCreation:
         cur = conn.cursor()
 
         cur.execute(self.stock_info)
+        cur.execute(self.stock_info_history)
         cur.execute(self.stock_price)
+        cur.execute(self.stock_price_ohlc)
         cur.execute(self.stock_reddit_sentiment)
         cur.execute(self.stock_twitter_sentiment)
         cur.execute(self.stock_articles)
+        cur.execute(self.article_contents)
+        ArticleStore().migrate(cur)
+        cur.execute(self.stock_articles_hash_index)
+        cur.execute(self.article_contents_search)
+        cur.execute(self.stock_sentiment_daily)
+        cur.execute(self.stock_sentiment_weekly)
+        cur.execute(self.stock_price_analytics)
+        cur.execute(self.stock_features)
+        cur.execute(self.stock_article_sentiment)
+        cur.execute(self.stock_article_clusters)
+        cur.execute(self.stock_article_lsh)
+        cur.execute(self.stock_price_adjustments)
+        cur.execute(self.stock_price_bars)
+        cur.execute(self.stock_trades)
+        cur.execute(self.stock_trade_bars)
+
+        if self.partitioned:
+            for table_id in self.partitioned_tables:
+                self.convert_partitioned(cur, table_id)
+                self.ensure_partitions(cur, table_id)
+            cur.execute(self.stock_articles_hash_index)
 
         cur.close()
 
         conn.commit()
 
+    def create_partitions(self, cur, table_id, months):
+        # Monthly range partitions, named <table>_<yyyy>_<mm>, of a table
+        # partitioned by range. Any dates of a month stand for the month.
+        starts = {dt.date(month.year, month.month, 1) for month in months}
+        partition_ids = {
+            f'{table_id}_{start:%Y_%m}': start for start in starts
+        }
+
+        # Existing ones are left alone, a detached partition as well. A load
+        # into months that have their partitions costs one round trip.
+        cur.execute(
+            """
+            SELECT
+                a.attname,
+                d.relname,
+                ARRAY(
+                    SELECT name FROM UNNEST(%s::TEXT[]) name
+                    WHERE TO_REGCLASS(name) IS NULL
+                )
+            FROM pg_partitioned_table p
+            JOIN pg_attribute a
+                ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+            LEFT JOIN pg_class d ON d.oid = p.partdefid
+            WHERE p.partrelid = TO_REGCLASS(%s);
+            """,
+            (list(partition_ids), table_id),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return
+        column, default_id, missing = row
+
+        for partition_id in sorted(missing):
+            start = partition_ids[partition_id]
+            end = (start + dt.timedelta(days=32)).replace(day=1)
+
+            # Loads and retention runs create partitions one at a time
+            cur.execute(
+                'SELECT PG_ADVISORY_XACT_LOCK(HASHTEXT(%s));', (table_id,)
+            )
+            cur.execute('SELECT TO_REGCLASS(%s);', (partition_id,))
+            if cur.fetchone()[0] is not None:
+                continue
+
+            moved = False
+            if default_id is not None:
+                # Rows of the month in the default partition are moved into
+                # the new one, postgres refuses to create it otherwise
+                cur.execute(
+                    sql.SQL('LOCK TABLE {} IN EXCLUSIVE MODE;').format(
+                        sql.Identifier(default_id)
+                    )
+                )
+                cur.execute(
+                    sql.SQL(
+                        'SELECT EXISTS (SELECT 1 FROM {default} '
+                        'WHERE {column} >= %s AND {column} < %s);'
+                    ).format(
+                        default=sql.Identifier(default_id),
+                        column=sql.Identifier(column),
+                    ),
+                    (start, end),
+                )
+                moved = cur.fetchone()[0]
+
+            if not moved:
+                cur.execute(
+                    sql.SQL(
+                        'CREATE TABLE {} PARTITION OF {} '
+                        'FOR VALUES FROM (%s) TO (%s);'
+                    ).format(
+                        sql.Identifier(partition_id),
+                        sql.Identifier(table_id),
+                    ),
+                    (start, end),
+                )
+                continue
+
+            cur.execute(
+                sql.SQL(
+                    """
+                    CREATE TABLE {partition} (
+                        LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                    );
+                    WITH moved AS (
+                        DELETE FROM {default}
+                        WHERE {column} >= %(start)s AND {column} < %(end)s
+                        RETURNING *
+                    )
+                    INSERT INTO {partition} SELECT * FROM moved;
+                    ALTER TABLE {table} ATTACH PARTITION {partition}
+                        FOR VALUES FROM (%(start)s) TO (%(end)s);
+                    """
+                ).format(
+                    partition=sql.Identifier(partition_id),
+                    table=sql.Identifier(table_id),
+                    default=sql.Identifier(default_id),
+                    column=sql.Identifier(column),
+                ),
+                {'start': start, 'end': end},
+            )
+
+    def ensure_partitions(self, cur, table_id, months_ahead=3, since=None):
+        # The coming months, the months since a date with rows in the
+        # default partition, and a default partition for rows of any month
+        # without one
+        month = dt.date.today().replace(day=1)
+        months = [month]
+        for _ in range(months_ahead):
+            month = (month + dt.timedelta(days=32)).replace(day=1)
+            months.append(month)
+        if since is not None and self.has_default(cur, table_id):
+            cur.execute(
+                sql.SQL(
+                    "SELECT DISTINCT DATE_TRUNC('month', date)::DATE "
+                    'FROM {} WHERE date >= %s;'
+                ).format(sql.Identifier(f'{table_id}_default')),
+                (since,),
+            )
+            months += [row[0] for row in cur.fetchall()]
+        self.create_partitions(cur, table_id, months)
+
+        cur.execute(
+            sql.SQL(
+                'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;'
+            ).format(
+                sql.Identifier(f'{table_id}_default'),
+                sql.Identifier(table_id),
+            )
+        )
+
+    def has_default(self, cur, table_id):
+        cur.execute(
+            'SELECT TO_REGCLASS(%s) IS NOT NULL;', (f'{table_id}_default',)
+        )
+
+        return cur.fetchone()[0]
+
+    def convert_partitioned(self, cur, table_id):
+        # Move the rows of a table created unpartitioned into a partitioned
+        # one, a partition per month with rows
+        cur.execute(
+            'SELECT relkind FROM pg_class WHERE oid = TO_REGCLASS(%s);',
+            (table_id,),
+        )
+        if cur.fetchone()[0] == 'p':
+            return False
+
+        unpartitioned_id = f'{table_id}_unpartitioned'
+        cur.execute(
+            sql.SQL('ALTER TABLE {} RENAME TO {};').format(
+                sql.Identifier(table_id),
+                sql.Identifier(unpartitioned_id),
+            )
+        )
+        # Index names are kept on rename, free them for the new table
+        cur.execute(
+            'SELECT indexname FROM pg_indexes WHERE tablename = %s;',
+            (unpartitioned_id,),
+        )
+        for (index_id,) in cur.fetchall():
+            cur.execute(
+                sql.SQL('ALTER INDEX {} RENAME TO {};').format(
+                    sql.Identifier(index_id),
+                    sql.Identifier(f'{index_id[:48]}_unpartitioned'),
+                )
+            )
+
+        cur.execute(getattr(self, table_id))
+        cur.execute(
+            sql.SQL(
+                "SELECT DISTINCT DATE_TRUNC('month', date)::DATE FROM {};"
+            ).format(sql.Identifier(unpartitioned_id))
+        )
+        self.create_partitions(
+            cur, table_id, [row[0] for row in cur.fetchall()]
+        )
+
+        cur.execute(
+            """
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name = %s
+            ORDER BY ordinal_position;
+            """,
+            (table_id,),
+        )
+        columns = sql.SQL(', ').join(
+            sql.Identifier(row[0]) for row in cur.fetchall()
+        )
+        cur.execute(
+            sql.SQL('INSERT INTO {} ({}) SELECT {} FROM {};').format(
+                sql.Identifier(table_id),
+                columns,
+                columns,
+                sql.Identifier(unpartitioned_id),
+            )
+        )
+        cur.execute(
+            sql.SQL('DROP TABLE {};').format(sql.Identifier(unpartitioned_id))
+        )
+
+        return True
+
 
 if __name__ == '__main__':
-    TableCreation().create_table()
+    parser = argparse.ArgumentParser(
+        description='Create the tables of the pipeline',
+    )
+    parser.add_argument(
+        '--partitioned',
+        action='store_true',
+        help='keep sentiment and article tables in monthly partitions, '
+        'converting existing ones',
+    )
+    args = parser.parse_args()
+
+    TableCreation(args.partitioned).create_table()
@@ -0,0 +1,111 @@
+"""
+rollups: daily and weekly sentiment per symbol and platform
+"""
+
+from psycopg2 import sql
+
+
+class SentimentRollup:
+
+    platforms = (
+        'reddit',
+        'twitter',
+    )
+
+    def __init__(self, platform):
+        if platform not in self.platforms:
+            raise ValueError(f'platform must be one of {self.platforms}')
+
+        self.platform = platform
+        self.table_id = f'stock_{platform}_sentiment'
+
+    def update(self, cur, symbol, dates):
+        # Recompute the days just loaded from the hourly rows, then the
+        # weeks containing them from the daily rows
+        dates = sorted(set(str(date)[:10] for date in dates))
+        if len(dates) == 0:
+            return
+
+        cur.execute(
+            sql.SQL(
+                """
+                INSERT INTO stock_sentiment_daily (
+                    symbol, platform, date, hours, total_mention,
+                    positive_mention, negative_mention, mean_score,
+                    weighted_score
+                )
+                SELECT
+                    symbol,
+                    %(platform)s,
+                    date,
+                    COUNT(*),
+                    SUM(mention),
+                    SUM(positive_mention),
+                    SUM(negative_mention),
+                    AVG(sentiment_score),
+                    SUM(sentiment_score * mention)
+                    / NULLIF(SUM(mention), 0)
+                FROM {}
+                WHERE symbol = %(symbol)s AND date = ANY(%(dates)s::DATE[])
+                GROUP BY symbol, date
+                ON CONFLICT (symbol, platform, date) DO UPDATE SET
+                    hours = EXCLUDED.hours,
+                    total_mention = EXCLUDED.total_mention,
+                    positive_mention = EXCLUDED.positive_mention,
+                    negative_mention = EXCLUDED.negative_mention,
+                    mean_score = EXCLUDED.mean_score,
+                    weighted_score = EXCLUDED.weighted_score;
+                """
+            ).format(sql.Identifier(self.table_id)),
+            {
+                'platform': self.platform,
+                'symbol': symbol,
+                'dates': dates,
+            },
+        )
+
+        cur.execute(
+            """
+            INSERT INTO stock_sentiment_weekly (
+                symbol, platform, week, hours, total_mention,
+                positive_mention, negative_mention, mean_score,
+                weighted_score
+            )
+            SELECT
+                symbol,
+                platform,
+                DATE_TRUNC('week', date)::DATE,
+                SUM(hours),
+                SUM(total_mention),
+                SUM(positive_mention),
+                SUM(negative_mention),
+                SUM(mean_score * hours) / SUM(hours),
+                SUM(weighted_score * total_mention)
+                / NULLIF(SUM(total_mention), 0)
+            FROM stock_sentiment_daily
+            WHERE symbol = %(symbol)s
+                AND platform = %(platform)s
+                AND date >= DATE_TRUNC('week', %(first_date)s::DATE)
+                AND date < DATE_TRUNC('week', %(last_date)s::DATE)
+                    + INTERVAL '1 week'
+                AND DATE_TRUNC('week', date) IN (
+                    SELECT DATE_TRUNC('week', d)
+                    FROM UNNEST(%(dates)s::DATE[]) AS d
+                )
+            GROUP BY symbol, platform, DATE_TRUNC('week', date)
+            ON CONFLICT (symbol, platform, week) DO UPDATE SET
+                hours = EXCLUDED.hours,
+                total_mention = EXCLUDED.total_mention,
+                positive_mention = EXCLUDED.positive_mention,
+                negative_mention = EXCLUDED.negative_mention,
+                mean_score = EXCLUDED.mean_score,
+                weighted_score = EXCLUDED.weighted_score;
+            """,
+            {
+                'platform': self.platform,
+                'symbol': symbol,
+                'dates': dates,
+                'first_date': min(dates),
+                'last_date': max(dates),
+            },
+        )
@@ -0,0 +1,98 @@
+"""
+point-in-time: stock_info values as of any date, from stock_info_history
+"""
+
+import argparse
+import datetime as dt
+
+import polars as pl
+
+from fast_read import FastReader
+
+
+class StockInfoAsOf:
+
+    history_table_id = 'stock_info_history'
+
+    value_columns = [
+        'market_capitalization',
+        'share_outstanding',
+        'country',
+        'currency',
+        'exchange',
+        'industry',
+        'ipo_date',
+        'name',
+    ]
+
+    def __init__(self, reader=None):
+        self.reader = reader or FastReader()
+        self.history = None
+
+    def read_history(self):
+        # Every version of every symbol, read once and kept sorted for the
+        # as-of joins. The (symbol, valid_from) primary key serves the scan.
+        if self.history is None:
+            self.history = self.reader.query(
+                'SELECT symbol, valid_from, {} FROM {} '
+                'ORDER BY valid_from'.format(
+                    ', '.join(self.value_columns),
+                    self.history_table_id,
+                )
+            ).with_columns(
+                pl.col('valid_from').cast(pl.Datetime('us'))
+            )
+
+        return self.history
+
+    def refresh(self):
+        self.history = None
+
+    def lookup(self, pairs, columns=None):
+        # pairs has a symbol and a date column, a date is answered with the
+        # version in effect at the end of that day
+        columns = columns or self.value_columns
+        history = self.read_history().select(
+            ['symbol', 'valid_from'] + columns
+        )
+
+        df = pairs.with_row_count('row').with_columns(
+            (
+                pl.col('date').cast(pl.Date).cast(pl.Datetime('us'))
+                + pl.duration(days=1)
+                - pl.duration(microseconds=1)
+            ).alias('as_of')
+        ).sort('as_of')
+
+        return df.join_asof(
+            history,
+            left_on='as_of',
+            right_on='valid_from',
+            by='symbol',
+            strategy='backward',
+        ).sort('row').drop(['row', 'as_of'])
+
+    def snapshot(self, date, symbols=None, columns=None):
+        if symbols is None:
+            symbols = self.read_history()['symbol'].unique().sort().to_list()
+
+        return self.lookup(
+            pl.DataFrame(
+                {
+                    'symbol': symbols,
+                    'date': [dt.date.fromisoformat(str(date))] * len(symbols),
+                }
+            ),
+            columns,
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print stock_info values as of a date',
+    )
+    parser.add_argument('date', help='YYYY-MM-DD')
+    parser.add_argument('--symbols', nargs='+')
+    args = parser.parse_args()
+
+    print(StockInfoAsOf().snapshot(args.date, args.symbols))
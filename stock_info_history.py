@@ -0,0 +1,136 @@
+"""
+snapshots: stock_info rows written only on change, versioned with valid_from/to
+"""
+
+import hashlib
+
+import polars as pl
+from psycopg2 import extras, sql
+
+
+class StockInfoHistory:
+
+    table_id = 'stock_info'
+    history_table_id = 'stock_info_history'
+
+    columns = [
+        'symbol',
+        'country',
+        'currency',
+        'estimate_currency',
+        'exchange',
+        'industry',
+        'ipo_date',
+        'logo',
+        'market_capitalization',
+        'name',
+        'phone',
+        'share_outstanding',
+        'web_url',
+    ]
+
+    def with_fingerprints(self, df):
+        # Dates compare as days whatever type the transform produced
+        return df.select(self.columns).with_columns(
+            pl.col('ipo_date').cast(pl.Date)
+        ).with_columns(
+            pl.concat_str(
+                [pl.col(column).cast(pl.Utf8) for column in self.columns],
+                separator='\x1f',
+            ).apply(
+                lambda x: hashlib.sha256(x.encode('utf-8')).hexdigest()
+            ).alias('row_hash')
+        )
+
+    def current_fingerprints(self, cur, symbols):
+        # Read on every load, rows changed by other writers are seen
+        cur.execute(
+            sql.SQL(
+                """
+                SELECT symbol, row_hash
+                FROM {}
+                WHERE valid_to IS NULL AND symbol = ANY(%s);
+                """
+            ).format(sql.Identifier(self.history_table_id)),
+            (symbols,),
+        )
+
+        return dict(cur.fetchall())
+
+    def changed_rows(self, cur, df):
+        df = self.with_fingerprints(df)
+        fingerprints = self.current_fingerprints(
+            cur, df['symbol'].to_list()
+        )
+
+        return df.filter(
+            pl.struct(['symbol', 'row_hash']).apply(
+                lambda row: fingerprints.get(row['symbol']) != row['row_hash']
+            )
+        )
+
+    def load(self, cur, df):
+        changed = self.changed_rows(cur, df)
+        if changed.height == 0:
+            return changed
+
+        columns = sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                'INSERT INTO {} ({}) VALUES %s '
+                'ON CONFLICT (symbol) DO UPDATE SET {};'
+            ).format(
+                sql.Identifier(self.table_id),
+                columns,
+                sql.SQL(', ').join(
+                    sql.SQL('{} = EXCLUDED.{}').format(
+                        sql.Identifier(column), sql.Identifier(column)
+                    )
+                    for column in self.columns[1:]
+                ),
+            ),
+            changed.select(self.columns).rows(),
+        )
+
+        # Close the current versions, then open the new ones at the same
+        # transaction timestamp
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                """
+                UPDATE {} AS h
+                SET valid_to = NOW() AT TIME ZONE 'UTC'
+                FROM (VALUES %s) AS new (symbol, row_hash)
+                WHERE h.symbol = new.symbol
+                    AND h.valid_to IS NULL
+                    AND h.row_hash <> new.row_hash;
+                """
+            ).format(sql.Identifier(self.history_table_id)),
+            changed.select(['symbol', 'row_hash']).rows(),
+        )
+        # The new versions are copied from the rows just written, typed
+        # by the table
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                """
+                INSERT INTO {history} ({columns}, row_hash, valid_from)
+                SELECT s.*, new.row_hash, NOW() AT TIME ZONE 'UTC'
+                FROM (VALUES %s) AS new (symbol, row_hash)
+                JOIN (SELECT {columns} FROM {table}) s USING (symbol)
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {history} h
+                    WHERE h.symbol = new.symbol
+                        AND h.valid_to IS NULL
+                );
+                """
+            ).format(
+                history=sql.Identifier(self.history_table_id),
+                columns=columns,
+                table=sql.Identifier(self.table_id),
+            ),
+            changed.select(['symbol', 'row_hash']).rows(),
+        )
+
+        return changed
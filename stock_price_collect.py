@@ -2,41 +2,112 @@
 daily: to_time = from_time + 1 day
 """
 
+import datetime as dt
+
+import pandas as pd
 from pandas_datareader import data as pdr
 import yfinance as yf
 
 
 class StockPriceCollector:
 
+    # Longest range Yahoo serves per request for each intraday interval
+    bar_chunk_days = {
+        '1m': 7,
+        '5m': 60,
+        '1h': 730,
+    }
+
     def __init__(self, stock_symbol, from_time, to_time):
         self.from_time = from_time
         self.to_time = to_time
         self.stock_symbol = stock_symbol
+        self.daily = None
+        # Requests sent to the provider, for the ingest metrics
+        self.downloads = 0
 
         yf.pdr_override()
 
+    def get_daily(self):
+        # One download serves every column, later calls reuse it
+        if self.daily is None:
+            self.downloads += 1
+            daily = pdr.get_data_yahoo(
+                self.stock_symbol,
+                self.from_time,
+                self.to_time,
+            )
+            if isinstance(daily.columns, pd.MultiIndex):
+                daily.columns = daily.columns.get_level_values(0)
+            daily.index = [
+                date.strftime('%Y-%m-%d') for date in daily.index
+            ]
+            self.daily = daily.fillna(value=999999)
+
+        return self.daily
+
+    def get_ohlcv(self):
+        daily = self.get_daily()
+
+        return {
+            'open': daily['Open'].to_dict(),
+            'high': daily['High'].to_dict(),
+            'low': daily['Low'].to_dict(),
+            'close': daily['Close'].to_dict(),
+            'price': daily['Adj Close'].to_dict(),
+            'volume': daily['Volume'].to_dict(),
+        }
+
     def get_price(self):
-        price = pdr.get_data_yahoo(
-            self.stock_symbol,
-            self.from_time,
-            self.to_time,
-        )['Adj Close']
-        price.index = [
-            date.strftime('%Y-%m-%d') for date in price.index
-        ]
-        price = price.fillna(value=999999)
-
-        return price.to_dict()
+        return self.get_daily()['Adj Close'].to_dict()
 
     def get_volume(self):
-        volume = pdr.get_data_yahoo(
-            self.stock_symbol,
-            self.from_time,
-            self.to_time
-        )['Volume']
-        volume.index = [
-            date.strftime('%Y-%m-%d') for date in volume.index
-        ]
-        volume = volume.fillna(value=999999)
-        
-        return volume.to_dict()
+        return self.get_daily()['Volume'].to_dict()
+
+    def get_bars(self, interval):
+        start = dt.datetime.strptime(self.from_time, '%Y-%m-%d')
+        end = dt.datetime.strptime(self.to_time, '%Y-%m-%d')
+
+        # Request the range in chunks the provider accepts
+        chunks = list()
+        while start < end:
+            chunk_end = min(
+                start + dt.timedelta(days=self.bar_chunk_days[interval]),
+                end,
+            )
+            self.downloads += 1
+            chunks.append(
+                pdr.get_data_yahoo(
+                    self.stock_symbol,
+                    start.strftime('%Y-%m-%d'),
+                    chunk_end.strftime('%Y-%m-%d'),
+                    interval=interval,
+                )
+            )
+            start = chunk_end
+
+        if len(chunks) == 0:
+            chunks.append(
+                pd.DataFrame(
+                    columns=['Open', 'High', 'Low', 'Close', 'Volume']
+                )
+            )
+        bars = pd.concat(chunks)
+        if isinstance(bars.columns, pd.MultiIndex):
+            bars.columns = bars.columns.get_level_values(0)
+        bars = bars.dropna()
+        bars = bars[~bars.index.duplicated()]
+
+        # Timestamps in UTC
+        index = bars.index
+        if getattr(index, 'tz', None) is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+
+        return {
+            'ts': [ts.strftime('%Y-%m-%d %H:%M:%S') for ts in index],
+            'open': bars['Open'].tolist(),
+            'high': bars['High'].tolist(),
+            'low': bars['Low'].tolist(),
+            'close': bars['Close'].tolist(),
+            'volume': bars['Volume'].tolist(),
+        }
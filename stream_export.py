@@ -0,0 +1,202 @@
+"""
+export: stream a table of any size to parquet or csv in fixed-size batches
+"""
+
+import argparse
+import json
+import uuid
+
+import psycopg2
+from psycopg2 import sql
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from article_store import ArticleStore
+
+# Postgres type oid -> arrow type of the exported column
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    25: pa.string(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1083: pa.time64('us'),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us', tz='UTC'),
+}
+
+
+class StreamingExporter:
+
+    def __init__(self, table_id, columns=None, where=None, params=None,
+                 batch_size=10000, with_contents=True):
+        self.table_id = table_id
+        self.columns = columns
+        self.where = where
+        self.params = params
+        self.batch_size = batch_size
+        self.with_contents = with_contents
+
+    def get_connection(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        return psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+    def select_query(self):
+        if self.table_id == ArticleStore.table_id and self.with_contents:
+            return self.articles_query()
+
+        if self.columns is None:
+            columns = sql.SQL('*')
+        else:
+            columns = sql.SQL(',').join(
+                sql.Identifier(name) for name in self.columns
+            )
+
+        query = sql.SQL('SELECT {} FROM {}').format(
+            columns,
+            sql.Identifier(self.table_id),
+        )
+        if self.where is not None:
+            query += sql.SQL(' WHERE ') + sql.SQL(self.where)
+
+        return query
+
+    def articles_query(self):
+        # The bodies are stored once in article_contents, joined back like
+        # FastReader.read_articles does
+        columns = self.columns or ArticleStore.reference_columns
+        if 'content_hash' in columns:
+            columns = list(columns) + [
+                c for c in ArticleStore.body_columns if c not in columns
+            ]
+
+        query = sql.SQL('SELECT {} FROM {} LEFT JOIN {} USING ({})').format(
+            sql.SQL(',').join(sql.Identifier(name) for name in columns),
+            sql.Identifier(self.table_id),
+            sql.Identifier(ArticleStore.contents_table_id),
+            sql.Identifier('content_hash'),
+        )
+        if self.where is not None:
+            query += sql.SQL(' WHERE ') + sql.SQL(self.where)
+
+        return query
+
+    def export_csv(self, path):
+        conn = self.get_connection()
+        cur = conn.cursor()
+
+        # COPY streams the rows straight from the server into the file
+        select = cur.mogrify(self.select_query(), self.params).decode()
+        copy_query = sql.SQL(
+            'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'
+        ).format(sql.SQL(select))
+
+        with open(path, 'w') as csv_file:
+            cur.copy_expert(copy_query, csv_file)
+
+        cur.close()
+        conn.close()
+
+    def export_parquet(self, path):
+        conn = self.get_connection()
+
+        # A named cursor keeps the result set on the server, only one batch
+        # at a time is held in client memory
+        cur = conn.cursor(name=f'stream_export_{uuid.uuid4().hex}')
+        cur.itersize = self.batch_size
+        cur.execute(self.select_query(), self.params)
+
+        writer = None
+        total_rows = 0
+        while True:
+            rows = cur.fetchmany(self.batch_size)
+            if len(rows) == 0:
+                break
+
+            if writer is None:
+                schema = arrow_schema(cur.description)
+                writer = pq.ParquetWriter(path, schema, compression='zstd')
+
+            writer.write_table(to_arrow(rows, schema))
+            total_rows += len(rows)
+
+        if writer is None:
+            schema = arrow_schema(cur.description)
+            writer = pq.ParquetWriter(path, schema, compression='zstd')
+        writer.close()
+
+        cur.close()
+        conn.close()
+
+        return total_rows
+
+    def export(self, path, file_format='parquet'):
+        if file_format == 'csv':
+            return self.export_csv(path)
+
+        return self.export_parquet(path)
+
+
+def arrow_schema(description):
+    return pa.schema(
+        [
+            pa.field(
+                column.name,
+                ARROW_TYPES.get(column.type_code, pa.string()),
+            )
+            for column in description
+        ]
+    )
+
+
+def to_arrow(rows, schema):
+    columns = list(zip(*rows))
+    arrays = list()
+    for field, values in zip(schema, columns):
+        if field.type == pa.string():
+            values = [None if v is None else str(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stream a table to a Parquet or CSV file',
+    )
+    parser.add_argument('table_id')
+    parser.add_argument('path')
+    parser.add_argument(
+        '--format',
+        choices=['parquet', 'csv'],
+        default='parquet',
+    )
+    parser.add_argument('--columns', nargs='+')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument(
+        '--without-contents',
+        action='store_true',
+        help='export stock_articles without the article bodies',
+    )
+    args = parser.parse_args()
+
+    StreamingExporter(
+        args.table_id,
+        columns=args.columns,
+        batch_size=args.batch_size,
+        with_contents=not args.without_contents,
+    ).export(args.path, args.format)
@@ -0,0 +1,453 @@
+"""
+streaming: finnhub trades websocket -> ring buffer -> micro-batched COPY
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import signal
+import time
+
+import numpy as np
+import polars as pl
+import psycopg2
+from psycopg2 import extras, sql
+import websockets
+
+logger = logging.getLogger('trade_stream')
+
+FINNHUB_URL = 'wss://ws.finnhub.io?token={}'
+
+
+class TickBuffer:
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.symbol = np.zeros(capacity, dtype=np.int16)
+        self.ts = np.zeros(capacity, dtype=np.int64)
+        self.price = np.zeros(capacity, dtype=np.float64)
+        self.volume = np.zeros(capacity, dtype=np.float64)
+
+        self.start = 0
+        self.size = 0
+        self.dropped = 0
+
+    def push(self, symbol, ts, price, volume):
+        # A full buffer overwrites its oldest tick
+        end = (self.start + self.size) % self.capacity
+        self.symbol[end] = symbol
+        self.ts[end] = ts
+        self.price[end] = price
+        self.volume[end] = volume
+
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.dropped += 1
+        else:
+            self.size += 1
+
+    def drain(self):
+        index = (self.start + np.arange(self.size)) % self.capacity
+        ticks = (
+            self.symbol[index],
+            self.ts[index],
+            self.price[index],
+            self.volume[index],
+        )
+        self.start = 0
+        self.size = 0
+
+        return ticks
+
+
+class TradeStreamIngester:
+
+    table_id = 'stock_trades'
+    bars_table_id = 'stock_trade_bars'
+
+    def __init__(self, symbols, url=None, batch_ms=500, batch_rows=5000,
+                 capacity=65536, record_path=None):
+        self.symbols = list(symbols)
+        self.codes = {symbol: code for code, symbol in enumerate(self.symbols)}
+        self.url = url or self.finnhub_url()
+        self.batch_ms = batch_ms
+        self.batch_rows = batch_rows
+        self.record_path = record_path
+
+        self.buffer = TickBuffer(max(capacity, 2 * batch_rows))
+        self.full = asyncio.Event()
+
+        # Drained ticks not loaded yet, kept until a load commits them
+        self.pending = list()
+        self.loading = None
+        self.started = None
+
+        self.conn = None
+        self.websocket = None
+        self.stopping = False
+        self.ticks_loaded = 0
+
+    @staticmethod
+    def finnhub_url():
+        with open('finhub_api.json', 'r') as api:
+            return FINNHUB_URL.format(json.load(api)['api_key'])
+
+    def get_connection(self):
+        # Get config for the database
+        with open('postgresql.json', 'r') as psql:
+            config = json.load(psql)
+
+        return psycopg2.connect(
+            host=config['host'],
+            database=config['database'],
+            user=config['user'],
+            password=config['password'],
+            port=config['port'],
+        )
+
+    def handle(self, message):
+        message = json.loads(message)
+        if message.get('type') != 'trade':
+            return
+
+        for trade in message['data']:
+            code = self.codes.get(trade['s'])
+            if code is not None:
+                self.buffer.push(code, trade['t'], trade['p'], trade['v'])
+
+        if self.buffer.size >= self.batch_rows:
+            self.full.set()
+
+    def to_frame(self, ticks):
+        codes, ts, price, volume = ticks
+
+        return pl.DataFrame(
+            {
+                'symbol': pl.Series(self.symbols).take(codes),
+                'ts': ts,
+                'price': price,
+                'volume': volume,
+            }
+        ).with_columns(
+            pl.from_epoch('ts', time_unit='ms')
+        )
+
+    def to_bars(self, df):
+        # Bars of one batch, merged with the stored ones by first/last tick
+        return df.sort('ts').groupby(
+            ['symbol', pl.col('ts').dt.truncate('1m').alias('minute')]
+        ).agg(
+            [
+                pl.col('price').first().alias('open'),
+                pl.col('price').max().alias('high'),
+                pl.col('price').min().alias('low'),
+                pl.col('price').last().alias('close'),
+                pl.col('volume').sum().alias('volume'),
+                pl.count().alias('trades'),
+                pl.col('ts').min().alias('first_ts'),
+                pl.col('ts').max().alias('last_ts'),
+            ]
+        )
+
+    def load(self, ticks):
+        df = self.to_frame(ticks)
+        bars = self.to_bars(df)
+
+        if self.conn is None or self.conn.closed:
+            self.conn = self.get_connection()
+        try:
+            self.write(df, bars)
+        except Exception:
+            # The next load starts over on a new connection
+            self.conn.close()
+            raise
+
+        return df.height
+
+    def write(self, df, bars):
+        cur = self.conn.cursor()
+
+        data = io.BytesIO()
+        df.write_csv(data, has_header=False)
+        data.seek(0)
+        cur.copy_expert(
+            sql.SQL(
+                'COPY {} (symbol, ts, price, volume) '
+                'FROM STDIN WITH (FORMAT csv);'
+            ).format(sql.Identifier(self.table_id)),
+            data,
+        )
+
+        extras.execute_values(
+            cur,
+            sql.SQL(
+                """
+                INSERT INTO {} AS b (
+                    symbol, minute, open, high, low, close, volume, trades,
+                    first_ts, last_ts
+                ) VALUES %s
+                ON CONFLICT (symbol, minute) DO UPDATE SET
+                    open = CASE WHEN EXCLUDED.first_ts < b.first_ts
+                        THEN EXCLUDED.open ELSE b.open END,
+                    close = CASE WHEN EXCLUDED.last_ts >= b.last_ts
+                        THEN EXCLUDED.close ELSE b.close END,
+                    high = GREATEST(b.high, EXCLUDED.high),
+                    low = LEAST(b.low, EXCLUDED.low),
+                    volume = b.volume + EXCLUDED.volume,
+                    trades = b.trades + EXCLUDED.trades,
+                    first_ts = LEAST(b.first_ts, EXCLUDED.first_ts),
+                    last_ts = GREATEST(b.last_ts, EXCLUDED.last_ts);
+                """
+            ).format(sql.Identifier(self.bars_table_id)),
+            bars.select(
+                [
+                    'symbol',
+                    'minute',
+                    'open',
+                    'high',
+                    'low',
+                    'close',
+                    'volume',
+                    'trades',
+                    'first_ts',
+                    'last_ts',
+                ]
+            ).rows(),
+            page_size=1000,
+        )
+
+        cur.close()
+        self.conn.commit()
+
+    def pending_ticks(self):
+        ticks = tuple(
+            np.concatenate(column) for column in zip(*self.pending)
+        )
+
+        # Batches kept through failed loads are capped like the buffer,
+        # the oldest ticks go first
+        excess = len(ticks[0]) - self.buffer.capacity
+        if excess > 0:
+            ticks = tuple(column[excess:] for column in ticks)
+            self.buffer.dropped += excess
+        self.pending = [ticks]
+
+        return ticks
+
+    async def flush(self):
+        if self.buffer.size != 0:
+            self.pending.append(self.buffer.drain())
+            self.full.clear()
+        if len(self.pending) == 0:
+            return
+
+        # The receive loop keeps filling the buffer while the batch loads.
+        # A cancelled flush leaves the load running, run() waits for it.
+        self.started = time.perf_counter()
+        self.loading = asyncio.get_running_loop().run_in_executor(
+            None, self.load, self.pending_ticks()
+        )
+        try:
+            rows = await asyncio.shield(self.loading)
+        except Exception:
+            self.loading = None
+            raise
+        self.loaded(rows)
+
+    def loaded(self, rows):
+        self.loading = None
+        self.pending = list()
+        self.ticks_loaded += rows
+        logger.info(
+            json.dumps(
+                {
+                    'rows': rows,
+                    'seconds': round(time.perf_counter() - self.started, 4),
+                    'buffered': self.buffer.size,
+                    'dropped': self.buffer.dropped,
+                    'loaded': self.ticks_loaded,
+                }
+            )
+        )
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.full.wait(), timeout=self.batch_ms / 1000
+                )
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                # The batch is kept and loaded again with the next one
+                logger.exception(
+                    f'Loading {len(self.pending[0][0])} ticks failed, '
+                    f'retrying in {self.batch_ms}ms'
+                )
+                await asyncio.sleep(self.batch_ms / 1000)
+
+    async def receive(self, websocket, record):
+        for symbol in self.symbols:
+            await websocket.send(
+                json.dumps({'type': 'subscribe', 'symbol': symbol})
+            )
+
+        async for message in websocket:
+            if record is not None:
+                record.write(message + '\n')
+            self.handle(message)
+
+    def stop(self):
+        # Shutdown requested, the stream ends without reconnecting
+        self.stopping = True
+        if self.websocket is not None:
+            asyncio.ensure_future(self.websocket.close())
+
+    async def run(self):
+        record = None
+        if self.record_path is not None:
+            record = open(self.record_path, 'a')
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+
+        flusher = asyncio.create_task(self.flush_loop())
+        backoff = 1
+        try:
+            while not self.stopping:
+                try:
+                    async with websockets.connect(self.url) as websocket:
+                        self.websocket = websocket
+                        backoff = 1
+                        await self.receive(websocket, record)
+                    # The server ended the stream without an error
+                    reason = 'connection closed'
+                except (OSError, websockets.ConnectionClosed) as error:
+                    reason = error
+                finally:
+                    self.websocket = None
+                if self.stopping:
+                    break
+                logger.warning(f'Reconnecting in {backoff}s: {reason}')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+        finally:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+
+            # A batch still loading in the executor is awaited before the
+            # last flush and before its connection is closed
+            if self.loading is not None:
+                try:
+                    self.loaded(await self.loading)
+                except Exception:
+                    self.loading = None
+                    logger.exception('Loading the in-flight batch failed')
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(
+                    f'Loading the last {len(self.pending[0][0])} ticks failed'
+                )
+
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            if record is not None:
+                record.close()
+            if self.conn is not None:
+                self.conn.close()
+
+
+class ReplayServer:
+
+    def __init__(self, record_path, rate=5000, host='localhost', port=8765,
+                 loop=False):
+        self.rate = rate
+        self.host = host
+        self.port = port
+        self.loop = loop
+
+        # One recorded message per line, as received from Finnhub
+        with open(record_path, 'r') as record:
+            self.messages = [
+                (line, len(json.loads(line).get('data', ())))
+                for line in record
+                if line.strip()
+            ]
+
+    async def handler(self, websocket):
+        # Ticks are sent as recorded, paced to the requested ticks per second
+        started = time.perf_counter()
+        sent = 0
+        while True:
+            for message, ticks in self.messages:
+                await websocket.send(message)
+                sent += ticks
+                ahead = sent / self.rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+            if not self.loop:
+                break
+
+    async def serve(self):
+        async with websockets.serve(self.handler, self.host, self.port):
+            await asyncio.Future()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stream Finnhub trades into the database',
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest')
+    ingest_parser.add_argument('--symbols', nargs='+', required=True)
+    ingest_parser.add_argument(
+        '--url',
+        help='websocket to read instead of Finnhub, e.g. a replay server',
+    )
+    ingest_parser.add_argument('--batch-ms', type=int, default=500)
+    ingest_parser.add_argument('--batch-rows', type=int, default=5000)
+    ingest_parser.add_argument(
+        '--record',
+        help='append every received message to this file for replays',
+    )
+
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('record')
+    replay_parser.add_argument(
+        '--rate',
+        type=int,
+        default=5000,
+        help='ticks per second',
+    )
+    replay_parser.add_argument('--host', default='localhost')
+    replay_parser.add_argument('--port', type=int, default=8765)
+    replay_parser.add_argument('--loop', action='store_true')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'ingest':
+        ingester = TradeStreamIngester(
+            args.symbols,
+            url=args.url,
+            batch_ms=args.batch_ms,
+            batch_rows=args.batch_rows,
+            record_path=args.record,
+        )
+        asyncio.run(ingester.run())
+    else:
+        server = ReplayServer(
+            args.record,
+            rate=args.rate,
+            host=args.host,
+            port=args.port,
+            loop=args.loop,
+        )
+        asyncio.run(server.serve())
@@ -0,0 +1,196 @@
+"""
+backfill: transform independent (symbol, window) chunks on a process pool
+"""
+
+import io
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import polars as pl
+
+import ingest_transforms
+
+
+class TransformExecutor:
+
+    # Ingest classes whose transform only depends on one symbol and window
+    windowed_ingests = (
+        'StockPriceIngest',
+        'StockRedditIngest',
+        'StockTwitterIngest',
+        'StockArticleIngest',
+    )
+
+    def __init__(self, max_workers=None, polars_threads=None):
+        cpu_count = os.cpu_count() or 1
+
+        self.max_workers = max_workers or cpu_count
+        # Cap the threads of each worker so that the pool as a whole
+        # does not use more threads than there are cores
+        self.polars_threads = polars_threads or max(
+            1, cpu_count // self.max_workers
+        )
+        self.executor = None
+        self.previous_threads = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    @staticmethod
+    def encode_raw(class_name, raw_data, interval='1d'):
+        # Daily prices are dicts of date -> value per column, every other
+        # payload is column lists or records
+        if class_name == 'StockPriceIngest' and interval == '1d':
+            dates = list(raw_data['price'].keys())
+            df = pl.DataFrame(
+                {
+                    'date': dates,
+                    **{
+                        column: [values[d] for d in dates]
+                        for column, values in raw_data.items()
+                    },
+                }
+            )
+        else:
+            df = pl.DataFrame(raw_data)
+
+        return TransformExecutor.to_arrow_buffer(df)
+
+    @staticmethod
+    def decode_raw(class_name, buffer, interval='1d'):
+        df = TransformExecutor.from_arrow_buffer(buffer)
+
+        if class_name == 'StockPriceIngest':
+            if interval != '1d':
+                return df.to_dict(as_series=False)
+            return {
+                column: dict(zip(df['date'], df[column]))
+                for column in df.columns
+                if column != 'date'
+            }
+
+        return df.to_dicts()
+
+    @staticmethod
+    def to_arrow_buffer(df):
+        buffer = io.BytesIO()
+        df.write_ipc(buffer)
+
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_arrow_buffer(buffer):
+        return pl.read_ipc(io.BytesIO(buffer))
+
+    def start(self):
+        # One pool for every dataset of a backfill. Forking a process that
+        # already runs polars threads can deadlock, so the workers are
+        # always spawned.
+        if self.executor is not None:
+            return
+
+        # Workers are spawned on demand and inherit the environment then,
+        # before polars is imported and sizes its thread pool
+        self.previous_threads = os.environ.get('POLARS_MAX_THREADS')
+        os.environ['POLARS_MAX_THREADS'] = str(self.polars_threads)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=mp.get_context('spawn'),
+        )
+
+    def shutdown(self):
+        if self.executor is None:
+            return
+
+        self.executor.shutdown()
+        self.executor = None
+        if self.previous_threads is None:
+            del os.environ['POLARS_MAX_THREADS']
+        else:
+            os.environ['POLARS_MAX_THREADS'] = self.previous_threads
+
+    def submit(self, ingest_class, symbol, raw_data, interval='1d'):
+        # Transform of one (symbol, window) chunk, submitted as soon as it
+        # is extracted. The future yields the encoded frame and the time
+        # the worker spent on it.
+        class_name = ingest_class.__name__
+        if class_name not in self.windowed_ingests:
+            raise ValueError(
+                f'{class_name} can not be split into symbol windows'
+            )
+
+        if len(raw_data) == 0:
+            future = Future()
+            future.set_result((None, 0.0))
+            return future
+
+        return self.executor.submit(
+            transform_chunk,
+            class_name,
+            symbol,
+            self.encode_raw(class_name, raw_data, interval),
+            interval,
+        )
+
+    def result(self, future):
+        # The frame of a chunk, False where there was nothing to load
+        buffer, seconds = future.result()
+        if buffer is None:
+            return False, seconds
+
+        return self.from_arrow_buffer(buffer), seconds
+
+    def transform_chunks(self, ingest_class, chunks, interval='1d'):
+        started = self.executor is None
+        self.start()
+        try:
+            futures = [
+                self.submit(ingest_class, symbol, raw_data, interval)
+                for symbol, _, _, raw_data in chunks
+            ]
+
+            # One result per chunk, False where there was nothing to load
+            return [self.result(future)[0] for future in futures]
+        finally:
+            if started:
+                self.shutdown()
+
+    def transform(self, ingest_class, chunks, interval='1d'):
+        frames = [
+            frame
+            for frame in self.transform_chunks(ingest_class, chunks, interval)
+            if frame is not False
+        ]
+
+        if len(frames) == 0:
+            return False
+
+        # Merge the chunks and keep the ordering of a single transform
+        sort_column = 'ts' if 'ts' in frames[0].columns else 'id'
+
+        return pl.concat(frames).sort(sort_column)
+
+
+def transform_chunk(class_name, symbol, buffer, interval='1d'):
+    start = time.perf_counter()
+    raw_data = TransformExecutor.decode_raw(class_name, buffer, interval)
+
+    transformed_data = ingest_transforms.transform(
+        class_name,
+        raw_data,
+        symbol,
+        interval,
+    )
+    if transformed_data is False:
+        return None, time.perf_counter() - start
+
+    return (
+        TransformExecutor.to_arrow_buffer(transformed_data),
+        time.perf_counter() - start,
+    )